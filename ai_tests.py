@@ -29,46 +29,53 @@ def test_calculate_late_fee_for_book_overdue(monkeypatch):
 
 
 def test_get_patron_status_report_with_fees_and_history(monkeypatch):
-    # Arrange: stub get_patron_borrowed_books and get_patron_borrow_count and calculate_late_fee_for_book
+    # Arrange: stub get_patron_loans with one overdue current loan and one returned loan
     now = datetime.now()
     due_date = now - timedelta(days=2)
 
-    fake_borrowed = [
-        {'book_id': 2, 'title': 'Test Book', 'due_date': due_date, 'return_date': None}
+    fake_loans = [
+        {'record_id': 1, 'book_id': 1, 'title': 'Old Book', 'author': 'A',
+         'borrow_date': now - timedelta(days=40), 'due_date': now - timedelta(days=26),
+         'return_date': now - timedelta(days=30)},
+        {'record_id': 2, 'book_id': 2, 'title': 'Test Book', 'author': 'B',
+         'borrow_date': due_date - timedelta(days=14), 'due_date': due_date, 'return_date': None},
     ]
+    calls = []
 
-    def fake_get_borrowed(patron_id):
-        return fake_borrowed
+    def fake_get_loans(patron_id):
+        calls.append(patron_id)
+        return fake_loans
 
-    def fake_get_borrow_count(patron_id):
-        return 4
-
-    def fake_calc_fee(patron_id, book_id):
-        return {'fee_amount': 1.0, 'days_overdue': 2, 'status': 'success'}
-
-    monkeypatch.setattr(library_service, 'get_patron_borrowed_books', fake_get_borrowed)
-    monkeypatch.setattr(library_service, 'get_patron_borrow_count', fake_get_borrow_count)
-    monkeypatch.setattr(library_service, 'calculate_late_fee_for_book', fake_calc_fee)
+    monkeypatch.setattr(library_service, 'get_patron_loans', fake_get_loans)
 
     # Act
     report = library_service.get_patron_status_report('654321')
 
-    # Assert
+    # Assert: one query for the whole report
+    assert calls == ['654321']
     assert report['patron_id'] == '654321'
-    assert report['borrowed_books'] == fake_borrowed
-    # Note: function returns total_late_fees as a string formatting bug; check it's the placeholder string
-    assert isinstance(report['total_late_fees'], str)
-    assert report['borrowing_history'] == 4
+    assert [b['book_id'] for b in report['borrowed_books']] == [2]
+    assert report['borrowed_books'][0]['days_overdue'] == 2
+    assert report['currently_borrowed'] == 1
+    assert report['total_late_fees'] == 1.0
+    assert [h['book_id'] for h in report['borrowing_history']] == [1, 2]
 
 
 def test_search_books_in_catalog_filters(monkeypatch):
-    # Arrange: stub get_all_books
+    # Arrange: stub search_books (the indexed database query) and record how it is called
     books = [
         {'book_id': 1, 'title': 'Python Programming', 'author': 'Alice', 'isbn': '1111111111111'},
         {'book_id': 2, 'title': 'Advanced C', 'author': 'Bob', 'isbn': '2222222222222'},
     ]
+    calls = []
+
+    def fake_search_books(search_term, search_type, limit):
+        calls.append((search_term, search_type, limit))
+        if search_type == 'isbn':
+            return [b for b in books if b['isbn'] == search_term]
+        return [b for b in books if search_term.lower() in b[search_type].lower()]
 
-    monkeypatch.setattr(library_service, 'get_all_books', lambda: books)
+    monkeypatch.setattr(library_service, 'search_books', fake_search_books)
 
     # Act & Assert
     res_title = library_service.search_books_in_catalog('python', 'title')
@@ -83,27 +90,20 @@ def test_search_books_in_catalog_filters(monkeypatch):
     assert len(res_isbn) == 1
     assert res_isbn[0]['book_id'] == 2
 
+    assert calls[0] == ('python', 'title', library_service.SEARCH_RESULT_LIMIT)
 
-def test_return_book_by_patron_success(monkeypatch):
-    # Arrange: stub borrow_book_by_patron to return (True, ...), update_book_availability and update_borrow_record_return_date and calculate_late_fee_for_book
-    monkeypatch.setattr(library_service, 'borrow_book_by_patron', lambda pid, bid: (True, 'borrowed'))
-    called = {'update_avail': False, 'update_record': False, 'calc_fee': False}
-
-    def fake_update_availability(book_id, delta):
-        called['update_avail'] = True
-        return True
 
-    def fake_calc_fee(patron_id, book_id):
-        called['calc_fee'] = True
-        return {'fee_amount': 0.0, 'days_overdue': 0, 'status': 'success'}
+def test_return_book_by_patron_success(monkeypatch):
+    # Arrange: stub return_book_transaction to report an on-time return of an active loan
+    calls = []
 
-    def fake_update_record(patron_id, book_id, return_date):
-        called['update_record'] = True
-        return True
+    def fake_return_transaction(patron_id, book_id, return_date, hold_expires_at):
+        calls.append((patron_id, book_id))
+        return 'success', {'record_id': 1, 'title': 'Test Book',
+                           'borrow_date': return_date - timedelta(days=3),
+                           'due_date': return_date + timedelta(days=11), 'hold_id': None}
 
-    monkeypatch.setattr(library_service, 'update_book_availability', fake_update_availability)
-    monkeypatch.setattr(library_service, 'calculate_late_fee_for_book', fake_calc_fee)
-    monkeypatch.setattr(library_service, 'update_borrow_record_return_date', fake_update_record)
+    monkeypatch.setattr(library_service, 'return_book_transaction', fake_return_transaction)
 
     # Act
     success, message = library_service.return_book_by_patron('123456', 1)
@@ -111,4 +111,4 @@ def test_return_book_by_patron_success(monkeypatch):
     # Assert
     assert success is True
     assert message == 'Book returned successfully.'
-    assert called['update_avail'] and called['calc_fee'] and called['update_record']
+    assert calls == [('123456', 1)]
@@ -6,19 +6,40 @@ Routes are organized in separate blueprint modules in the routes package.
 """
 
 from flask import Flask
-from database import init_database, add_sample_data
+from database import init_database, add_sample_data, configure_database
 from routes import register_blueprints
+from commands import register_commands
+from services.job_queue import start_job_worker, JOB_WORKERS
+from instrumentation import init_instrumentation, INSTRUMENTATION_ENABLED
 
 
-def create_app():
+def create_app(config=None):
     """
     Application factory function to create and configure Flask app.
     
+    Args:
+        config: Optional mapping of config overrides. DATABASE, DB_POOL_SIZE,
+            DB_POOL_TIMEOUT and SQLITE_PRAGMAS are passed to the database layer;
+            anything not given falls back to the LIBRARY_* environment variables.
+            JOB_WORKERS sets the background job threads a serving process
+            starts with its first request (not under TESTING).
+            INSTRUMENTATION turns on request metrics and slow-request profiling.
+    
     Returns:
         Flask: Configured Flask application instance
     """
     app = Flask(__name__)
     app.secret_key = "super secret key"
+    if config:
+        app.config.update(config)
+    
+    # Point the database layer at the configured file, pool and pragmas
+    configure_database(
+        database=app.config.get('DATABASE'),
+        pool_size=app.config.get('DB_POOL_SIZE'),
+        pool_timeout=app.config.get('DB_POOL_TIMEOUT'),
+        pragmas=app.config.get('SQLITE_PRAGMAS'),
+    )
     
     # Initialize the database
     init_database()
@@ -29,6 +50,22 @@ def create_app():
     # Register all route blueprints
     register_blueprints(app)
     
+    # Opt-in per-route latency, SQL and profiling metrics, served at /metrics
+    if app.config.get('INSTRUMENTATION', INSTRUMENTATION_ENABLED):
+        init_instrumentation(app)
+    
+    # Register maintenance CLI commands
+    register_commands(app)
+    
+    # Job worker threads start with the first request, so only serving
+    # processes (flask run, python app.py, gunicorn workers) run them: a CLI
+    # command would exit without finishing the jobs it claimed. Tests run
+    # their jobs themselves.
+    if not app.testing:
+        @app.before_request
+        def start_job_workers():
+            start_job_worker(app.config.get('JOB_WORKERS', JOB_WORKERS))
+    
     return app
 
 
@@ -0,0 +1,6 @@
+"""
+Benchmarks Package - Timing of the library service hot paths
+Generates a synthetic catalog and loan history at 1k/100k/1M scale, times the
+service functions and routes on it, and compares the results with a baseline.
+Run with `python -m benchmarks`.
+"""
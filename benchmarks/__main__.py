@@ -0,0 +1,114 @@
+"""
+Benchmark command line
+
+    python -m benchmarks run --scale 1k --output baseline.json
+    python -m benchmarks run --scale 1k --output results.json --baseline baseline.json
+    python -m benchmarks compare results.json baseline.json --threshold 0.25
+    python -m benchmarks generate --scale 100k
+    python -m benchmarks load --scale 1k --threads 32 --duration 30 --mix borrow=3,return=3,api_search=1
+
+`run` exits with status 1 when a baseline is given and a case regressed;
+`load` exits with status 1 when an invariant was violated.
+"""
+
+import argparse
+import json
+import sys
+
+from benchmarks.datagen import DEFAULT_SEED, SCALES
+from benchmarks.harness import (
+    DEFAULT_ITERATIONS, DEFAULT_THRESHOLD, DEFAULT_WARMUP, compare, format_comparison, load_results, save_results
+)
+from benchmarks.loadgen import (
+    DEFAULT_DURATION, DEFAULT_HOT_BOOKS, DEFAULT_MIX, DEFAULT_PATRONS, DEFAULT_THREADS,
+    format_report, parse_mix, run_load
+)
+from benchmarks.runner import DATA_DIR, prepare_database, run_benchmarks
+
+
+def _print_case(name, summary):
+    print(f"{name:<50} median {summary['median_ms']:>9.3f} ms  p95 {summary['p95_ms']:>9.3f} ms  "
+          f"{summary['ops_per_sec']:>10.1f} ops/s", flush=True)
+
+def _compare(results, baseline_path, threshold) -> int:
+    baseline = load_results(baseline_path)
+    if baseline['meta'].get('scale') != results['meta'].get('scale'):
+        print(f"Baseline is for scale {baseline['meta'].get('scale')}, not {results['meta'].get('scale')}.",
+              file=sys.stderr)
+        return 2
+    report = compare(results, baseline, threshold)
+    print(format_comparison(report, threshold))
+    return 1 if report['regressions'] else 0
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(prog='python -m benchmarks', description="Library service benchmarks.")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run = commands.add_parser('run', help="time the service functions and routes")
+    run.add_argument('--scale', choices=sorted(SCALES), default='1k')
+    run.add_argument('--iterations', type=int, default=DEFAULT_ITERATIONS, help="timed calls per case")
+    run.add_argument('--warmup', type=int, default=DEFAULT_WARMUP, help="untimed calls per case first")
+    run.add_argument('--only', action='append', metavar='PATTERN', help="glob of case names to run (repeatable)")
+    run.add_argument('--seed', type=int, default=DEFAULT_SEED)
+    run.add_argument('--data-dir', default=DATA_DIR)
+    run.add_argument('--regenerate', action='store_true', help="generate the dataset again")
+    run.add_argument('--output', help="write the results as JSON")
+    run.add_argument('--baseline', help="results JSON to compare with")
+    run.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                     help="relative median slowdown that counts as a regression")
+
+    comparison = commands.add_parser('compare', help="compare a results file with a baseline")
+    comparison.add_argument('results')
+    comparison.add_argument('baseline')
+    comparison.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD)
+
+    generate = commands.add_parser('generate', help="generate the dataset for a scale")
+    generate.add_argument('--scale', choices=sorted(SCALES), default='1k')
+    generate.add_argument('--seed', type=int, default=DEFAULT_SEED)
+    generate.add_argument('--data-dir', default=DATA_DIR)
+
+    load = commands.add_parser('load', help="drive a local server with concurrent patrons")
+    load.add_argument('--scale', choices=sorted(SCALES), default='1k')
+    load.add_argument('--seed', type=int, default=DEFAULT_SEED)
+    load.add_argument('--data-dir', default=DATA_DIR)
+    load.add_argument('--threads', type=int, default=DEFAULT_THREADS)
+    load.add_argument('--duration', type=float, default=DEFAULT_DURATION, help="seconds of traffic")
+    load.add_argument('--patrons', type=int, default=DEFAULT_PATRONS)
+    load.add_argument('--hot-books', type=int, default=DEFAULT_HOT_BOOKS,
+                      help="borrows pick from the first N books")
+    load.add_argument('--mix', type=parse_mix, default=DEFAULT_MIX,
+                      help="request weights, e.g. borrow=3,return=3,search=2,api_search=2,late_fee=1")
+    load.add_argument('--pool-size', type=int, help="database connections (default LIBRARY_DB_POOL_SIZE)")
+    load.add_argument('--output', help="write the report as JSON")
+
+    args = parser.parse_args(argv)
+    if args.command == 'generate':
+        dataset = prepare_database(args.scale, args.seed, args.data_dir, regenerate=True)
+        print(f"Generated {dataset['books']} books and {dataset['loans']} loans "
+              f"({dataset['active_loans']} active) in {args.data_dir}.")
+        return 0
+
+    if args.command == 'load':
+        dataset = prepare_database(args.scale, args.seed, args.data_dir)
+        report = run_load(dataset['path'], args.mix, args.threads, args.duration, args.patrons, args.hot_books,
+                          args.seed, {'DB_POOL_SIZE': args.pool_size} if args.pool_size else None)
+        print(format_report(report))
+        if args.output:
+            with open(args.output, 'w', encoding='utf-8') as f:
+                json.dump(report, f, indent=2)
+        return 1 if report['violations'] else 0
+
+    if args.command == 'compare':
+        return _compare(load_results(args.results), args.baseline, args.threshold)
+
+    results = run_benchmarks(args.scale, args.iterations, args.warmup, args.only, args.seed,
+                             args.data_dir, args.regenerate, progress=_print_case)
+    if args.output:
+        save_results(results, args.output)
+    if args.baseline:
+        return _compare(results, args.baseline, args.threshold)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
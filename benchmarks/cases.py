@@ -0,0 +1,155 @@
+"""
+Benchmark cases
+Each case prepares its arguments from the generated data and returns the call
+to time. Cases that write (borrows, returns) use each copy or loan only once,
+so every timed call takes the same code path.
+"""
+
+import itertools
+import random
+from typing import Callable, Dict, Iterator, List, Tuple
+
+import database
+from benchmarks.datagen import WORDS, LAST_NAMES
+from services.library_service import (
+    CATALOG_PAGE_SIZE, borrow_book_by_patron, calculate_late_fee_for_book, encode_catalog_cursor,
+    get_catalog_page, get_patron_status_report, return_book_by_patron, search_books_in_catalog
+)
+
+SAMPLE_SIZE = 500  # distinct arguments cycled through by the read cases
+
+
+class BenchContext:
+    """The generated database and app a run's cases share."""
+
+    def __init__(self, client, dataset: Dict, seed: int, calls_per_case: int):
+        self.client = client
+        self.dataset = dataset
+        self.rng = random.Random(seed)
+        self.calls_per_case = calls_per_case
+        self._fresh_patrons = itertools.count(900000)
+
+    def fresh_patron(self) -> str:
+        """A patron ID with no loans in the generated data."""
+        return str(next(self._fresh_patrons))
+
+    def query(self, sql: str, params: Tuple = ()) -> List[Tuple]:
+        conn = database.get_db_connection()
+        try:
+            return [tuple(row) for row in conn.execute(sql, params).fetchall()]
+        finally:
+            conn.close()
+
+    def sample(self, rows: List, size: int = SAMPLE_SIZE) -> List:
+        return self.rng.sample(rows, min(size, len(rows)))
+
+    def active_loans(self) -> List[Tuple[str, int]]:
+        return self.query('''
+            SELECT patron_id, book_id FROM borrow_records
+            WHERE return_date IS NULL ORDER BY id
+        ''')
+
+    def available_copies(self) -> Iterator[int]:
+        """Book IDs, one per copy on the shelf, in a fixed shuffled order; each can be borrowed once."""
+        copies = [book_id for book_id, available in
+                  self.query('SELECT id, available_copies FROM books WHERE available_copies > 0 ORDER BY id')
+                  for _ in range(available)]
+        self.rng.shuffle(copies)
+        if len(copies) < self.calls_per_case:
+            raise RuntimeError(f"Only {len(copies)} copies on the shelf for {self.calls_per_case} borrows.")
+        return iter(copies)
+
+    def catalog_cursors(self) -> List[str]:
+        """Cursors of pages spread over the whole catalog."""
+        books = self.query('SELECT id, title FROM books ORDER BY id')
+        return [encode_catalog_cursor({'id': book_id, 'title': title}) for book_id, title in self.sample(books)]
+
+
+# Case name -> factory(ctx) returning the call to time
+CASES: Dict[str, Callable[[BenchContext], Callable[[], object]]] = {}
+
+def case(name: str):
+    def register(factory):
+        CASES[name] = factory
+        return factory
+    return register
+
+def cycle(items: List) -> Callable[[], object]:
+    return itertools.cycle(items).__next__
+
+
+@case('service.get_all_books.first_page')
+def _first_page(ctx):
+    return lambda: database.get_all_books(limit=CATALOG_PAGE_SIZE + 1)
+
+@case('service.get_catalog_page.deep')
+def _deep_page(ctx):
+    cursors = cycle(ctx.catalog_cursors())
+    return lambda: get_catalog_page(cursors())
+
+@case('service.search_books_in_catalog.title')
+def _search_title(ctx):
+    terms = cycle(ctx.sample(list(WORDS)))
+    return lambda: search_books_in_catalog(terms(), 'title')
+
+@case('service.search_books_in_catalog.author')
+def _search_author(ctx):
+    terms = cycle(ctx.sample(list(LAST_NAMES)))
+    return lambda: search_books_in_catalog(terms(), 'author')
+
+@case('service.search_books_in_catalog.isbn')
+def _search_isbn(ctx):
+    isbns = cycle(ctx.sample([isbn for (isbn,) in ctx.query('SELECT isbn FROM books ORDER BY id')]))
+    return lambda: search_books_in_catalog(isbns(), 'isbn')
+
+@case('service.calculate_late_fee_for_book')
+def _late_fee(ctx):
+    loans = cycle(ctx.sample(ctx.active_loans()))
+    return lambda: calculate_late_fee_for_book(*loans())
+
+@case('service.get_patron_status_report')
+def _status_report(ctx):
+    patrons = cycle(ctx.sample(sorted({patron for patron, _ in ctx.active_loans()})))
+    return lambda: get_patron_status_report(patrons())
+
+@case('service.borrow_book_by_patron')
+def _borrow(ctx):
+    copies = ctx.available_copies()
+    return lambda: borrow_book_by_patron(ctx.fresh_patron(), next(copies))
+
+@case('service.return_book_by_patron')
+def _return(ctx):
+    loans = ctx.active_loans()
+    ctx.rng.shuffle(loans)
+    if len(loans) < ctx.calls_per_case:
+        raise RuntimeError(f"Only {len(loans)} active loans for {ctx.calls_per_case} returns.")
+    loans = iter(loans)
+    return lambda: return_book_by_patron(*next(loans))
+
+@case('route.GET /catalog')
+def _catalog_route(ctx):
+    return lambda: ctx.client.get('/catalog')
+
+@case('route.GET /api/catalog?cursor=')
+def _catalog_api_route(ctx):
+    cursors = cycle(ctx.catalog_cursors())
+    return lambda: ctx.client.get('/api/catalog', query_string={'cursor': cursors()})
+
+@case('route.GET /api/search')
+def _search_route(ctx):
+    terms = cycle(ctx.sample(list(WORDS)))
+    return lambda: ctx.client.get('/api/search', query_string={'q': terms()})
+
+@case('route.GET /api/late_fee')
+def _late_fee_route(ctx):
+    loans = cycle(ctx.sample(ctx.active_loans()))
+
+    def call():
+        patron_id, book_id = loans()
+        return ctx.client.get(f'/api/late_fee/{patron_id}/{book_id}')
+    return call
+
+@case('route.POST /borrow')
+def _borrow_route(ctx):
+    copies = ctx.available_copies()
+    return lambda: ctx.client.post('/borrow', data={'patron_id': ctx.fresh_patron(), 'book_id': next(copies)})
@@ -0,0 +1,129 @@
+"""
+Synthetic data generator for the benchmarks
+Fills a fresh database with deterministic books and borrow records, so runs
+at the same scale and seed always measure the same data
+"""
+
+import os
+import random
+import sqlite3
+from datetime import datetime, timedelta
+from typing import Dict, Optional
+
+import database
+
+# Scale name -> (books, borrow records)
+SCALES = {
+    '1k': (1_000, 1_000),
+    '100k': (100_000, 100_000),
+    '1m': (1_000_000, 1_000_000),
+}
+DEFAULT_SEED = 7754
+LOANS_PER_PATRON = 10    # borrow records per patron, so patron histories grow with the scale
+ACTIVE_LOAN_RATE = 0.3   # share of borrow records still out; the rest are returned
+INSERT_CHUNK_SIZE = 10_000
+
+WORDS = (
+    'river shadow garden winter empire silent golden broken secret glass city night house light '
+    'stone paper ocean forest mirror summer iron crown storm island letter journey memory fire '
+    'orchard harbor desert lantern valley thunder whisper kingdom violet scarlet northern hidden '
+    'last little lost wild ancient quiet burning distant hollow endless falling crimson wandering '
+    'song tale story history voyage promise echo garden bridge tower road window door clock '
+    'king queen child stranger daughter son mother father sister brother friend enemy soldier'
+).split()
+FIRST_NAMES = ('Ada Alan Grace Toni James Zadie Ursula Kazuo Chinua Jane Leo Maya Octavia '
+               'Gabriel Virginia Haruki Isabel Salman Doris Italo').split()
+LAST_NAMES = ('Morrison Baldwin Smith Okri Ishiguro Achebe Austen Tolstoy Angelou Butler '
+              'Marquez Woolf Murakami Allende Rushdie Lessing Calvino Hopper Turing Lovelace').split()
+
+
+def title_for(rng: random.Random) -> str:
+    return ' '.join(rng.choice(WORDS) for _ in range(rng.randint(2, 5))).title()
+
+def author_for(rng: random.Random) -> str:
+    return f"{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}"
+
+def patron_for(index: int) -> str:
+    return f"{200000 + index:06d}"
+
+def generate(path: str, books: int, loans: int, seed: int = DEFAULT_SEED,
+             now: Optional[datetime] = None) -> Dict:
+    """
+    Create a database at `path` (replacing any file there) with `books`
+    books and `loans` borrow records.
+
+    Records are spread over loans / LOANS_PER_PATRON patrons and borrowed
+    within the last year; about ACTIVE_LOAN_RATE of them are still out
+    (never more than MAX_BORROWED_BOOKS per patron, nor more than a book's
+    copies), and a part of those are overdue. available_copies and the
+    patron counters match the generated loans. Leaves database.py
+    configured to use `path`.
+
+    Returns:
+        dict: books, loans, active_loans, patrons and seed
+    """
+    from services.library_service import LOAN_PERIOD_DAYS, MAX_BORROWED_BOOKS
+
+    now = now or datetime.now().replace(microsecond=0)
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+    database.configure_database(database=path)
+    database.init_database()
+    database.close_pool()
+
+    rng = random.Random(seed)
+    copies = [rng.randint(1, 5) for _ in range(books)]
+    available = list(copies)
+    patrons = max(1, loans // LOANS_PER_PATRON)
+    active_per_patron = [0] * patrons
+    active = 0
+
+    conn = sqlite3.connect(path)
+    try:
+        conn.execute('PRAGMA journal_mode = WAL')
+        conn.execute('PRAGMA synchronous = OFF')
+        for start in range(0, books, INSERT_CHUNK_SIZE):
+            conn.executemany('''
+                INSERT INTO books (id, title, author, isbn, total_copies, available_copies)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', [(i + 1, title_for(rng), author_for(rng), f"{9790000000000 + i}", copies[i], copies[i])
+                  for i in range(start, min(start + INSERT_CHUNK_SIZE, books))])
+            conn.commit()
+
+        for start in range(0, loans, INSERT_CHUNK_SIZE):
+            rows = []
+            for i in range(start, min(start + INSERT_CHUNK_SIZE, loans)):
+                patron = i % patrons
+                book = rng.randrange(books)
+                borrow_date = now - timedelta(days=rng.randint(0, 365), minutes=rng.randint(0, 1439))
+                due_date = borrow_date + timedelta(days=LOAN_PERIOD_DAYS)
+                if (rng.random() < ACTIVE_LOAN_RATE and available[book] > 0
+                        and active_per_patron[patron] < MAX_BORROWED_BOOKS):
+                    available[book] -= 1
+                    active_per_patron[patron] += 1
+                    active += 1
+                    return_date = None
+                else:
+                    return_date = min(borrow_date + timedelta(days=rng.randint(1, 30)), now).isoformat()
+                rows.append((patron_for(patron), book + 1, borrow_date.isoformat(),
+                             due_date.isoformat(), return_date))
+            conn.executemany('''
+                INSERT INTO borrow_records (patron_id, book_id, borrow_date, due_date, return_date)
+                VALUES (?, ?, ?, ?, ?)
+            ''', rows)
+            conn.commit()
+
+        conn.executemany('UPDATE books SET available_copies = ? WHERE id = ?',
+                         [(available[i], i + 1) for i in range(books) if available[i] != copies[i]])
+        conn.commit()
+        conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    finally:
+        conn.close()
+
+    return {'books': books, 'loans': loans, 'active_loans': active, 'patrons': patrons, 'seed': seed}
+
+def generate_scale(path: str, scale: str, seed: int = DEFAULT_SEED) -> Dict:
+    """generate() with the book and loan counts of a named scale ('1k', '100k' or '1m')."""
+    books, loans = SCALES[scale]
+    return dict(generate(path, books, loans, seed), scale=scale)
@@ -0,0 +1,105 @@
+"""
+Benchmark harness
+Times benchmark cases call by call, summarizes the timings, and compares a
+run's results with a stored baseline
+"""
+
+import json
+import math
+import statistics
+import time
+from typing import Callable, Dict, List
+
+DEFAULT_ITERATIONS = 200
+DEFAULT_WARMUP = 20
+DEFAULT_THRESHOLD = 0.25  # a case regresses when its median is this much slower than the baseline's
+
+
+def summarize(durations: List[float]) -> Dict:
+    """Summary statistics, in milliseconds, of per-call durations given in seconds."""
+    ordered = sorted(durations)
+
+    def percentile(p: float) -> float:
+        return ordered[min(len(ordered) - 1, math.ceil(p / 100 * len(ordered)) - 1)]
+
+    mean = statistics.fmean(ordered)
+    return {
+        'iterations': len(ordered),
+        'min_ms': round(ordered[0] * 1000, 4),
+        'median_ms': round(statistics.median(ordered) * 1000, 4),
+        'mean_ms': round(mean * 1000, 4),
+        'p95_ms': round(percentile(95) * 1000, 4),
+        'p99_ms': round(percentile(99) * 1000, 4),
+        'stdev_ms': round(statistics.pstdev(ordered) * 1000, 4),
+        'ops_per_sec': round(1 / mean, 1) if mean > 0 else None,
+    }
+
+def time_calls(call: Callable[[], object], iterations: int = DEFAULT_ITERATIONS,
+               warmup: int = DEFAULT_WARMUP) -> Dict:
+    """
+    Run `call` warmup times untimed, then `iterations` times, timing each
+    call on its own, and summarize the timed calls.
+    """
+    for _ in range(warmup):
+        call()
+    durations = []
+    clock = time.perf_counter
+    for _ in range(iterations):
+        start = clock()
+        call()
+        durations.append(clock() - start)
+    return summarize(durations)
+
+def compare(results: Dict, baseline: Dict, threshold: float = DEFAULT_THRESHOLD) -> Dict:
+    """
+    Compare the median of every case in a run with the baseline run.
+
+    Args:
+        results: Output of a benchmark run ({'meta': ..., 'results': {case: summary}})
+        baseline: A stored run to compare against
+        threshold: Relative slowdown of the median that counts as a regression
+
+    Returns:
+        dict: regressions, improvements and unchanged as lists of
+        {case, baseline_ms, current_ms, change} (change is relative, +0.3 =
+        30% slower), plus the cases missing from either run
+    """
+    current, previous = results['results'], baseline['results']
+    report = {'regressions': [], 'improvements': [], 'unchanged': [],
+              'new': sorted(set(current) - set(previous)),
+              'missing': sorted(set(previous) - set(current))}
+    for case in sorted(set(current) & set(previous)):
+        before, after = previous[case]['median_ms'], current[case]['median_ms']
+        change = (after - before) / before if before > 0 else 0.0
+        entry = {'case': case, 'baseline_ms': before, 'current_ms': after, 'change': round(change, 4)}
+        if change > threshold:
+            report['regressions'].append(entry)
+        elif change < -threshold:
+            report['improvements'].append(entry)
+        else:
+            report['unchanged'].append(entry)
+    return report
+
+def format_comparison(report: Dict, threshold: float) -> str:
+    """Text table of a compare() report."""
+    lines = []
+    for label in ('regressions', 'improvements', 'unchanged'):
+        for entry in report[label]:
+            lines.append(f"{label[:-1] if label != 'unchanged' else 'ok':<11} {entry['case']:<50} "
+                         f"{entry['baseline_ms']:>10.3f} ms -> {entry['current_ms']:>10.3f} ms "
+                         f"({entry['change']:+.0%})")
+    for case in report['new']:
+        lines.append(f"{'new':<11} {case}")
+    for case in report['missing']:
+        lines.append(f"{'missing':<11} {case}")
+    lines.append(f"{len(report['regressions'])} regressions over {threshold:.0%}.")
+    return '\n'.join(lines)
+
+def load_results(path: str) -> Dict:
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+def save_results(results: Dict, path: str):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+        f.write('\n')
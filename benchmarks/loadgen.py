@@ -0,0 +1,293 @@
+"""
+Load generator
+Serves create_app() on a local port and drives it with many concurrent
+simulated patrons replaying a weighted mix of borrow, return, search and late
+fee requests, then reports throughput, latency percentiles and any broken
+invariants in the data
+"""
+
+import random
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+import requests
+from werkzeug.serving import WSGIRequestHandler, make_server
+
+import database
+from benchmarks.datagen import WORDS
+from benchmarks.harness import summarize
+from services.library_service import MAX_BORROWED_BOOKS
+
+# Request kind -> relative weight in the traffic mix
+DEFAULT_MIX = {'borrow': 3, 'return': 3, 'search': 2, 'api_search': 2, 'late_fee': 1}
+DEFAULT_THREADS = 16
+DEFAULT_DURATION = 10.0      # seconds of traffic
+DEFAULT_PATRONS = 200        # simulated patrons, split between the threads
+DEFAULT_HOT_BOOKS = 50       # borrows pick from the first N books, so patrons compete for the last copies
+INVARIANT_CHECK_INTERVAL = 1.0  # seconds between invariant checks while the load runs
+REQUEST_TIMEOUT = 30.0
+
+
+class _QuietRequestHandler(WSGIRequestHandler):
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+def parse_mix(text: str) -> Dict[str, int]:
+    """Parse 'borrow=3,return=3,search=1' into a mix; kinds left out get weight 0."""
+    mix = {}
+    for part in text.split(','):
+        kind, _, weight = part.partition('=')
+        kind = kind.strip()
+        if kind not in DEFAULT_MIX:
+            raise ValueError(f"Unknown request kind: {kind}")
+        mix[kind] = int(weight or 1)
+    if not any(mix.values()):
+        raise ValueError("The mix needs at least one request kind with a positive weight.")
+    return mix
+
+def check_invariants(max_borrowed: int = MAX_BORROWED_BOOKS) -> List[str]:
+    """
+    Check the catalog and loans for states no sequence of requests should
+    produce; each query reads one consistent snapshot.
+
+    Returns:
+        list: A description of every violation found (empty if none)
+    """
+    conn = database.get_db_connection()
+    try:
+        violations = []
+        for book_id, available, total in conn.execute('''
+            SELECT id, available_copies, total_copies FROM books
+            WHERE available_copies < 0 OR available_copies > total_copies
+        '''):
+            violations.append(f"Book {book_id} has {available} of {total} copies available.")
+        # Every copy is on the shelf, out on loan, or set aside for a ready hold
+        for book_id, available, out, held, total in conn.execute('''
+            SELECT b.id, b.available_copies, COALESCE(l.n, 0), COALESCE(h.n, 0), b.total_copies
+            FROM books b
+            LEFT JOIN (SELECT book_id, COUNT(*) AS n FROM borrow_records
+                       WHERE return_date IS NULL GROUP BY book_id) l ON l.book_id = b.id
+            LEFT JOIN (SELECT book_id, COUNT(*) AS n FROM holds
+                       WHERE status = 'ready' GROUP BY book_id) h ON h.book_id = b.id
+            WHERE b.available_copies + COALESCE(l.n, 0) + COALESCE(h.n, 0) != b.total_copies
+        '''):
+            violations.append(f"Book {book_id}: {available} available + {out} on loan + {held} held "
+                              f"!= {total} copies.")
+        for patron_id, loans in conn.execute('''
+            SELECT patron_id, COUNT(*) FROM borrow_records
+            WHERE return_date IS NULL GROUP BY patron_id HAVING COUNT(*) > ?
+        ''', (max_borrowed,)):
+            violations.append(f"Patron {patron_id} has {loans} books out (limit {max_borrowed}).")
+        return violations
+    finally:
+        conn.close()
+
+
+class _Patron:
+    """A simulated patron and the books it believes it has out."""
+
+    def __init__(self, patron_id: str):
+        self.patron_id = patron_id
+        self.loans: List[int] = []
+
+
+class LoadRun:
+    """One load test: the server, the client threads and what they recorded."""
+
+    def __init__(self, app, mix: Dict[str, int], threads: int, duration: float, patrons: int,
+                 hot_books: int, seed: int):
+        if patrons < threads:
+            raise ValueError("Every thread needs at least one patron.")
+        self.app = app
+        self.kinds = [kind for kind, weight in mix.items() if weight > 0]
+        self.weights = [mix[kind] for kind in self.kinds]
+        self.threads = threads
+        self.duration = duration
+        self.patrons = [_Patron(f"{700000 + n}") for n in range(patrons)]
+        self.hot_books = hot_books
+        self.seed = seed
+        self.base_url = None
+        self._serializer = app.session_interface.get_signing_serializer(app)
+        self._lock = threading.Lock()
+        self._samples: Dict[str, List[float]] = {kind: [] for kind in self.kinds}
+        self._outcomes: Dict[str, Dict[str, int]] = {kind: {'ok': 0, 'rejected': 0, 'error': 0}
+                                                     for kind in self.kinds}
+        self._errors: List[str] = []
+        self.violations: List[str] = []
+
+    def _flashes(self, response) -> List[Tuple[str, str]]:
+        cookie = response.cookies.get(self.app.config['SESSION_COOKIE_NAME'])
+        if not cookie:
+            return []
+        return [tuple(flash) for flash in self._serializer.loads(cookie).get('_flashes', [])]
+
+    def _request(self, http: requests.Session, rng: random.Random, patron: _Patron, kind: str) -> str:
+        """Send one request of `kind`; returns 'ok' or 'rejected' (a business rule said no)."""
+        if kind == 'borrow':
+            book_id = rng.randint(1, self.hot_books)
+            response = http.post(f"{self.base_url}/borrow", data={'patron_id': patron.patron_id, 'book_id': book_id},
+                                 allow_redirects=False, timeout=REQUEST_TIMEOUT)
+            http.cookies.clear()  # flashes are read from this response only
+            response.raise_for_status()
+            if any(category == 'success' for category, _ in self._flashes(response)):
+                patron.loans.append(book_id)
+                return 'ok'
+            return 'rejected'
+
+        if kind == 'return':
+            book_id = patron.loans.pop(rng.randrange(len(patron.loans))) if patron.loans \
+                else rng.randint(1, self.hot_books)
+            response = http.post(f"{self.base_url}/return", data={'patron_id': patron.patron_id, 'book_id': book_id},
+                                 timeout=REQUEST_TIMEOUT)
+            http.cookies.clear()
+            response.raise_for_status()
+            return 'ok' if 'class="flash-success"' in response.text else 'rejected'
+
+        if kind in ('search', 'api_search'):
+            path = '/search' if kind == 'search' else '/api/search'
+            response = http.get(f"{self.base_url}{path}", params={'q': rng.choice(WORDS), 'type': 'title'},
+                                timeout=REQUEST_TIMEOUT)
+            http.cookies.clear()
+            response.raise_for_status()
+            return 'ok'
+
+        book_id = rng.choice(patron.loans) if patron.loans else rng.randint(1, self.hot_books)
+        response = http.get(f"{self.base_url}/api/late_fee/{patron.patron_id}/{book_id}", timeout=REQUEST_TIMEOUT)
+        response.raise_for_status()
+        return 'ok' if response.json().get('status') == 'success' else 'rejected'
+
+    def _client(self, number: int, deadline: float):
+        rng = random.Random(self.seed + number)
+        patrons = self.patrons[number::self.threads]
+        samples = {kind: [] for kind in self.kinds}
+        outcomes = {kind: {'ok': 0, 'rejected': 0, 'error': 0} for kind in self.kinds}
+        errors = []
+        with requests.Session() as http:
+            while time.monotonic() < deadline:
+                kind = rng.choices(self.kinds, self.weights)[0]
+                patron = rng.choice(patrons)
+                start = time.perf_counter()
+                try:
+                    outcome = self._request(http, rng, patron, kind)
+                except Exception as e:
+                    outcome = 'error'
+                    errors.append(f"{kind}: {e}")
+                samples[kind].append(time.perf_counter() - start)
+                outcomes[kind][outcome] += 1
+        with self._lock:
+            for kind in self.kinds:
+                self._samples[kind].extend(samples[kind])
+                for outcome, count in outcomes[kind].items():
+                    self._outcomes[kind][outcome] += count
+            self._errors.extend(errors)
+
+    def _watch_invariants(self, stop: threading.Event):
+        while not stop.wait(INVARIANT_CHECK_INTERVAL):
+            self._record_violations(check_invariants())
+
+    def _record_violations(self, violations: List[str]):
+        with self._lock:
+            for violation in violations:
+                if violation not in self.violations:
+                    self.violations.append(violation)
+
+    def run(self) -> Dict:
+        """Start the server, run the clients for `duration` seconds and report."""
+        server = make_server('127.0.0.1', 0, self.app, threaded=True, request_handler=_QuietRequestHandler)
+        self.base_url = f"http://127.0.0.1:{server.server_port}"
+        server_thread = threading.Thread(target=server.serve_forever, name='load-server', daemon=True)
+        server_thread.start()
+        stop_watching = threading.Event()
+        watcher = threading.Thread(target=self._watch_invariants, args=(stop_watching,),
+                                   name='load-invariants', daemon=True)
+        try:
+            watcher.start()
+            started = time.monotonic()
+            deadline = started + self.duration
+            clients = [threading.Thread(target=self._client, args=(number, deadline), name=f'load-client-{number}')
+                       for number in range(self.threads)]
+            for client in clients:
+                client.start()
+            for client in clients:
+                client.join()
+            elapsed = time.monotonic() - started
+        finally:
+            stop_watching.set()
+            watcher.join()
+            server.shutdown()
+            server_thread.join()
+
+        self._record_violations(check_invariants())
+        self._record_violations([f"Patron {drift['patron_id']} counters {drift['stored']} != {drift['actual']}."
+                                 for drift in database.verify_patron_counters()])
+        return self.report(elapsed)
+
+    def report(self, elapsed: float) -> Dict:
+        total = sum(len(samples) for samples in self._samples.values())
+        by_kind = {}
+        for kind in self.kinds:
+            if self._samples[kind]:
+                by_kind[kind] = dict(summarize(self._samples[kind]), **self._outcomes[kind],
+                                     requests_per_sec=round(len(self._samples[kind]) / elapsed, 1))
+        all_samples = [sample for samples in self._samples.values() for sample in samples]
+        return {
+            'threads': self.threads,
+            'duration': round(elapsed, 2),
+            'requests': total,
+            'requests_per_sec': round(total / elapsed, 1) if elapsed else 0.0,
+            'errors': sum(outcomes['error'] for outcomes in self._outcomes.values()),
+            'latency': summarize(all_samples) if all_samples else None,
+            'by_kind': by_kind,
+            'error_samples': self._errors[:20],
+            'violations': self.violations,
+        }
+
+
+def run_load(database_path: str, mix: Optional[Dict[str, int]] = None, threads: int = DEFAULT_THREADS,
+             duration: float = DEFAULT_DURATION, patrons: int = DEFAULT_PATRONS,
+             hot_books: int = DEFAULT_HOT_BOOKS, seed: int = 0, config: Optional[Dict] = None) -> Dict:
+    """
+    Run a load test against an app serving `database_path`.
+
+    Args:
+        database_path: SQLite file to serve (it is written to)
+        mix: Request kind -> weight; kinds are borrow, return, search,
+            api_search and late_fee
+        threads: Concurrent clients, each with its own share of the patrons
+        duration: Seconds of traffic
+        patrons: Simulated patrons (IDs from 700000, so they start with no loans)
+        hot_books: Borrows and stray returns pick from book IDs 1..hot_books
+        seed: Seed of the clients' choices
+        config: Extra create_app config (e.g. DB_POOL_SIZE)
+
+    Returns:
+        dict: throughput, overall and per-kind latency summaries (ms) with
+        ok/rejected/error counts, and the invariant violations found
+    """
+    from app import create_app
+
+    # The mix queues no jobs, so no job worker threads polling alongside it
+    app = create_app(dict({'DATABASE': database_path, 'JOB_WORKERS': 0}, **(config or {})))
+    return LoadRun(app, mix or DEFAULT_MIX, threads, duration, patrons, hot_books, seed).run()
+
+def format_report(report: Dict) -> str:
+    """Text summary of a run_load() report."""
+    lines = [f"{report['requests']} requests in {report['duration']}s from {report['threads']} threads: "
+             f"{report['requests_per_sec']} req/s, {report['errors']} errors"]
+    if report['latency']:
+        latency = report['latency']
+        lines.append(f"{'all':<12} p50 {latency['median_ms']:>8.2f} ms  p95 {latency['p95_ms']:>8.2f} ms  "
+                     f"p99 {latency['p99_ms']:>8.2f} ms")
+    for kind, summary in report['by_kind'].items():
+        lines.append(f"{kind:<12} p50 {summary['median_ms']:>8.2f} ms  p95 {summary['p95_ms']:>8.2f} ms  "
+                     f"p99 {summary['p99_ms']:>8.2f} ms  {summary['requests_per_sec']:>8.1f} req/s  "
+                     f"ok {summary['ok']}  rejected {summary['rejected']}  errors {summary['error']}")
+    for error in report['error_samples']:
+        lines.append(f"error: {error}")
+    for violation in report['violations']:
+        lines.append(f"INVARIANT VIOLATED: {violation}")
+    if not report['violations']:
+        lines.append("All invariants held.")
+    return '\n'.join(lines)
@@ -0,0 +1,94 @@
+"""
+Benchmark runner
+Prepares a working copy of the generated database for a scale, runs the cases
+against it and collects the results
+"""
+
+import fnmatch
+import os
+import platform
+import shutil
+import sqlite3
+from datetime import datetime
+from typing import Dict, Iterable, Optional
+
+import database
+from benchmarks.cases import CASES, BenchContext
+from benchmarks.datagen import DEFAULT_SEED, generate_scale
+from benchmarks.harness import DEFAULT_ITERATIONS, DEFAULT_WARMUP, time_calls
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), 'data')
+
+
+def prepare_database(scale: str, seed: int = DEFAULT_SEED, data_dir: str = DATA_DIR,
+                     regenerate: bool = False) -> Dict:
+    """
+    Generate the dataset for a scale once (kept in data_dir and reused by
+    later runs) and copy it to a working file the run may write to, so
+    every run starts from the same data.
+
+    Returns:
+        dict: the dataset description, with the working copy's path
+    """
+    os.makedirs(data_dir, exist_ok=True)
+    pristine = os.path.join(data_dir, f'{scale}-{seed}.db')
+    working = os.path.join(data_dir, f'{scale}-{seed}.run.db')
+    if regenerate or not os.path.exists(pristine):
+        dataset = generate_scale(pristine, scale, seed)
+        database.close_pool()
+    else:
+        conn = sqlite3.connect(pristine)
+        try:
+            books, loans = conn.execute('''
+                SELECT (SELECT COUNT(*) FROM books), (SELECT COUNT(*) FROM borrow_records)
+            ''').fetchone()
+        finally:
+            conn.close()
+        dataset = {'scale': scale, 'books': books, 'loans': loans, 'seed': seed}
+
+    for suffix in ('-wal', '-shm'):
+        if os.path.exists(working + suffix):
+            os.remove(working + suffix)
+    shutil.copyfile(pristine, working)
+    return dict(dataset, path=working)
+
+def run_benchmarks(scale: str = '1k', iterations: int = DEFAULT_ITERATIONS, warmup: int = DEFAULT_WARMUP,
+                   only: Optional[Iterable[str]] = None, seed: int = DEFAULT_SEED, data_dir: str = DATA_DIR,
+                   regenerate: bool = False, progress=None) -> Dict:
+    """
+    Run the benchmark cases (those matching one of the `only` glob patterns,
+    if given) against the dataset of a scale.
+
+    Returns:
+        dict: {'meta': run description, 'results': {case: summary}}
+    """
+    from app import create_app
+
+    dataset = prepare_database(scale, seed, data_dir, regenerate)
+    app = create_app({'DATABASE': dataset['path'], 'TESTING': True})
+    ctx = BenchContext(app.test_client(), dataset, seed, warmup + iterations)
+
+    results = {}
+    for name, factory in CASES.items():
+        if only and not any(fnmatch.fnmatch(name, pattern) for pattern in only):
+            continue
+        results[name] = time_calls(factory(ctx), iterations, warmup)
+        if progress:
+            progress(name, results[name])
+    database.close_pool()
+
+    return {
+        'meta': {
+            'scale': scale,
+            'books': dataset['books'],
+            'loans': dataset['loans'],
+            'seed': seed,
+            'iterations': iterations,
+            'warmup': warmup,
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'platform': platform.platform(),
+            'created_at': datetime.now().isoformat(timespec='seconds'),
+        },
+        'results': results,
+    }
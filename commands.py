@@ -0,0 +1,115 @@
+"""
+CLI Commands - Maintenance commands registered on the Flask app
+
+Run them through the Flask CLI, e.g. `flask --app app import-books books.csv`.
+"""
+
+import csv
+import json
+import os
+
+import click
+
+from database import requeue_jobs, rebuild_patron_counters, verify_patron_counters
+from services.catalog_import import import_books, IMPORT_CHUNK_SIZE, IMPORT_FORMATS
+from services.job_queue import run_pending_jobs
+from services.library_service import expire_holds, sweep_overdue_loans, OVERDUE_SWEEP_CHUNK_SIZE
+
+
+@click.command('import-books')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'file_format', type=click.Choice(IMPORT_FORMATS),
+              help='Input format (default: taken from the file extension).')
+@click.option('--chunk-size', default=IMPORT_CHUNK_SIZE, show_default=True,
+              help='Rows inserted per transaction.')
+def import_books_command(path, file_format, chunk_size):
+    """Bulk-add books from a CSV (with header row) or JSONL file."""
+    if file_format is None:
+        file_format = 'jsonl' if os.path.splitext(path)[1].lower() in ('.jsonl', '.ndjson') else 'csv'
+    
+    with open(path, newline='', encoding='utf-8') as stream:
+        report = import_books(stream, file_format, chunk_size)
+    
+    for error in report['errors']:
+        click.echo(f"line {error['line']}: {error['message']} (ISBN: {error['isbn']})", err=True)
+    click.echo(f"Imported {report['imported']} of {report['rows']} rows; {report['failed']} failed.")
+
+
+@click.command('overdue-sweep')
+@click.option('--format', 'output_format', type=click.Choice(['jsonl', 'csv']), default='jsonl',
+              show_default=True, help='Output format.')
+@click.option('--output', type=click.File('w'), default='-', help='Output file (default: stdout).')
+@click.option('--chunk-size', default=OVERDUE_SWEEP_CHUNK_SIZE, show_default=True,
+              help='Loans read per query.')
+def overdue_sweep_command(output_format, output, chunk_size):
+    """List every overdue loan with its late fee, most overdue first."""
+    fields = ['record_id', 'patron_id', 'book_id', 'title', 'due_date', 'days_overdue', 'fee_amount']
+    writer = csv.DictWriter(output, fields) if output_format == 'csv' else None
+    if writer:
+        writer.writeheader()
+    
+    count, total = 0, 0.0
+    for loan in sweep_overdue_loans(chunk_size=chunk_size):
+        if writer:
+            writer.writerow(loan)
+        else:
+            output.write(json.dumps(loan) + '\n')
+        count += 1
+        total += loan['fee_amount']
+    click.echo(f"{count} overdue loans; ${total:.2f} in late fees.", err=True)
+
+
+@click.group('jobs')
+def jobs_command():
+    """Inspect and drive the background payment job queue."""
+
+@jobs_command.command('run')
+@click.option('--limit', type=int, help='Stop after this many jobs.')
+def run_jobs_command(limit):
+    """Run queued jobs that are due in this process, then exit."""
+    click.echo(f"Ran {run_pending_jobs(limit)} jobs.")
+
+@jobs_command.command('requeue-dead')
+def requeue_dead_jobs_command():
+    """Give dead-lettered jobs another round of attempts."""
+    click.echo(f"Requeued {requeue_jobs('dead')} jobs.")
+
+
+@click.group('holds')
+def holds_command():
+    """Maintain the holds queue."""
+
+@holds_command.command('expire')
+def expire_holds_command():
+    """Expire uncollected ready holds and pass their copies to the next patrons in line."""
+    click.echo(f"Expired {expire_holds()} holds.")
+
+
+@click.group('patrons')
+def patrons_command():
+    """Check and repair the per-patron loan and fee counters."""
+
+@patrons_command.command('verify')
+def verify_patrons_command():
+    """Report patrons whose counters differ from their loans and payments."""
+    drift = verify_patron_counters()
+    for patron in drift:
+        click.echo(f"{patron['patron_id']}: stored (active, total, fees) {patron['stored']}, "
+                   f"actual {patron['actual']}", err=True)
+    click.echo(f"{len(drift)} patrons with drifted counters.")
+    if drift:
+        raise SystemExit(1)
+
+@patrons_command.command('rebuild')
+def rebuild_patrons_command():
+    """Recompute every patron's counters from their loans and payments."""
+    click.echo(f"Rebuilt counters for {rebuild_patron_counters()} patrons.")
+
+
+def register_commands(app):
+    """Register all CLI commands with the Flask app."""
+    app.cli.add_command(import_books_command)
+    app.cli.add_command(overdue_sweep_command)
+    app.cli.add_command(jobs_command)
+    app.cli.add_command(holds_command)
+    app.cli.add_command(patrons_command)
@@ -1,201 +1,1724 @@
-"""
-Database module for Library Management System
-Handles all database operations and connections
-"""
-
-import sqlite3
-from datetime import datetime, timedelta
-from typing import Dict, List, Optional, Tuple
-
-# Database configuration
-DATABASE = 'library.db'
-
-def get_db_connection():
-    """Get a database connection."""
-    conn = sqlite3.connect(DATABASE)
-    conn.row_factory = sqlite3.Row  # This enables column access by name
-    return conn
-
-def init_database():
-    """Initialize the database with required tables."""
-    conn = get_db_connection()
-    
-    # Create books table
-    conn.execute('''
-        CREATE TABLE IF NOT EXISTS books (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            title TEXT NOT NULL,
-            author TEXT NOT NULL,
-            isbn TEXT UNIQUE NOT NULL,
-            total_copies INTEGER NOT NULL,
-            available_copies INTEGER NOT NULL
-        )
-    ''')
-    
-    # Create borrow_records table
-    conn.execute('''
-        CREATE TABLE IF NOT EXISTS borrow_records (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            patron_id TEXT NOT NULL,
-            book_id INTEGER NOT NULL,
-            borrow_date TEXT NOT NULL,
-            due_date TEXT NOT NULL,
-            return_date TEXT,
-            FOREIGN KEY (book_id) REFERENCES books (id)
-        )
-    ''')
-    
-    conn.commit()
-    conn.close()
-
-def add_sample_data():
-    """Add sample data to the database if it's empty."""
-    conn = get_db_connection()
-    book_count = conn.execute('SELECT COUNT(*) as count FROM books').fetchone()['count']
-    
-    if book_count == 0:
-        # Add sample books
-        sample_books = [
-            ('The Great Gatsby', 'F. Scott Fitzgerald', '9780743273565', 3),
-            ('To Kill a Mockingbird', 'Harper Lee', '9780061120084', 2),
-            ('1984', 'George Orwell', '9780451524935', 1)
-        ]
-        
-        for title, author, isbn, copies in sample_books:
-            conn.execute('''
-                INSERT INTO books (title, author, isbn, total_copies, available_copies)
-                VALUES (?, ?, ?, ?, ?)
-            ''', (title, author, isbn, copies, copies))
-        
-        # Make 1984 unavailable by adding a borrow record
-        conn.execute('''
-            INSERT INTO borrow_records (patron_id, book_id, borrow_date, due_date)
-            VALUES (?, ?, ?, ?)
-        ''', ('123456', 3, 
-              (datetime.now() - timedelta(days=5)).isoformat(),
-              (datetime.now() + timedelta(days=9)).isoformat()))
-        
-        # Update available copies for 1984
-        conn.execute('UPDATE books SET available_copies = 0 WHERE id = 3')
-        
-        conn.commit()
-    
-    conn.close()
-
-# Helper Functions for Database Operations
-
-def get_all_books() -> List[Dict]:
-    """Get all books from the database."""
-    conn = get_db_connection()
-    books = conn.execute('SELECT * FROM books ORDER BY title').fetchall()
-    conn.close()
-    return [dict(book) for book in books]
-
-def get_book_by_id(book_id: int) -> Optional[Dict]:
-    """Get a specific book by ID."""
-    conn = get_db_connection()
-    book = conn.execute('SELECT * FROM books WHERE id = ?', (book_id,)).fetchone()
-    conn.close()
-    return dict(book) if book else None
-
-def get_book_by_isbn(isbn: str) -> Optional[Dict]:
-    """Get a specific book by ISBN."""
-    conn = get_db_connection()
-    book = conn.execute('SELECT * FROM books WHERE isbn = ?', (isbn,)).fetchone()
-    conn.close()
-    return dict(book) if book else None
-
-def get_patron_borrowed_books(patron_id: str) -> List[Dict]:
-    """Get currently borrowed books for a patron."""
-    conn = get_db_connection()
-    records = conn.execute('''
-        SELECT br.*, b.title, b.author 
-        FROM borrow_records br 
-        JOIN books b ON br.book_id = b.id 
-        WHERE br.patron_id = ? AND br.return_date IS NULL
-        ORDER BY br.borrow_date
-    ''', (patron_id,)).fetchall()
-    conn.close()
-    
-    borrowed_books = []
-    for record in records:
-        borrowed_books.append({
-            'book_id': record['book_id'],
-            'title': record['title'],
-            'author': record['author'],
-            'borrow_date': datetime.fromisoformat(record['borrow_date']),
-            'due_date': datetime.fromisoformat(record['due_date']),
-            'is_overdue': datetime.now() > datetime.fromisoformat(record['due_date'])
-        })
-    
-    return borrowed_books
-
-def get_patron_borrow_count(patron_id: str) -> int:
-    """Get the number of books currently borrowed by a patron."""
-    conn = get_db_connection()
-    count = conn.execute('''
-        SELECT COUNT(*) as count FROM borrow_records 
-        WHERE patron_id = ? AND return_date IS NULL
-    ''', (patron_id,)).fetchone()['count']
-    conn.close()
-    return count
-
-def insert_book(title: str, author: str, isbn: str, total_copies: int, available_copies: int) -> bool:
-    """Insert a new book into the database."""
-    conn = get_db_connection()
-    try:
-        conn.execute('''
-            INSERT INTO books (title, author, isbn, total_copies, available_copies)
-            VALUES (?, ?, ?, ?, ?)
-        ''', (title, author, isbn, total_copies, available_copies))
-        conn.commit()
-        conn.close()
-        return True
-    except Exception as e:
-        conn.close()
-        return False
-
-def insert_borrow_record(patron_id: str, book_id: int, borrow_date: datetime, due_date: datetime) -> bool:
-    """Insert a new borrow record into the database."""
-    conn = get_db_connection()
-    try:
-        conn.execute('''
-            INSERT INTO borrow_records (patron_id, book_id, borrow_date, due_date)
-            VALUES (?, ?, ?, ?)
-        ''', (patron_id, book_id, borrow_date.isoformat(), due_date.isoformat()))
-        conn.commit()
-        conn.close()
-        return True
-    except Exception as e:
-        conn.close()
-        return False
-
-def update_book_availability(book_id: int, change: int) -> bool:
-    """Update the available copies of a book by a given amount (+1 for return, -1 for borrow)."""
-    conn = get_db_connection()
-    try:
-        conn.execute('''
-            UPDATE books SET available_copies = available_copies + ? WHERE id = ?
-        ''', (change, book_id))
-        conn.commit()
-        conn.close()
-        return True
-    except Exception as e:
-        conn.close()
-        return False
-
-def update_borrow_record_return_date(patron_id: str, book_id: int, return_date: datetime) -> bool:
-    """Update the return date for a borrow record."""
-    conn = get_db_connection()
-    try:
-        conn.execute('''
-            UPDATE borrow_records 
-            SET return_date = ? 
-            WHERE patron_id = ? AND book_id = ? AND return_date IS NULL
-        ''', (return_date.isoformat(), patron_id, book_id))
-        conn.commit()
-        conn.close()
-        return True
-    except Exception as e:
-        conn.close()
-        return False
+"""
+Database module for Library Management System
+Handles all database operations and connections
+"""
+
+import os
+import queue
+import re
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Optional, Tuple
+
+from cache import TTLCache
+
+# Database configuration
+# Every setting can be overridden from the environment, or at startup through
+# configure_database() (create_app passes the Flask app config through it).
+DATABASE = os.environ.get('LIBRARY_DATABASE', 'library.db')
+
+# Connection pool configuration
+POOL_SIZE = int(os.environ.get('LIBRARY_DB_POOL_SIZE', 5))            # maximum open connections
+POOL_TIMEOUT = float(os.environ.get('LIBRARY_DB_POOL_TIMEOUT', 5.0))  # seconds to wait for a free one
+
+# Pragmas applied to every new connection. WAL lets catalog reads proceed while
+# a borrow is committing; NORMAL sync is durable across crashes in WAL mode.
+# Each one can be overridden with LIBRARY_SQLITE_<NAME>, e.g. LIBRARY_SQLITE_CACHE_SIZE.
+DEFAULT_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'busy_timeout': 5000,       # milliseconds to wait on a locked database
+    'cache_size': -16000,       # negative = KiB, so roughly 16 MB of page cache
+    'mmap_size': 268435456,     # 256 MB of memory-mapped I/O
+}
+SQLITE_PRAGMAS = {
+    name: os.environ.get(f'LIBRARY_SQLITE_{name.upper()}', value)
+    for name, value in DEFAULT_PRAGMAS.items()
+}
+
+# Read-through cache for get_book_by_id / get_book_by_isbn. Book metadata
+# rarely changes and every write path invalidates the entry it touches; the
+# TTL bounds staleness from writers in other processes.
+BOOK_CACHE_SIZE = int(os.environ.get('LIBRARY_BOOK_CACHE_SIZE', 1024))
+BOOK_CACHE_TTL = float(os.environ.get('LIBRARY_BOOK_CACHE_TTL', 30.0))
+_book_cache = TTLCache(BOOK_CACHE_SIZE, BOOK_CACHE_TTL)
+
+# Callables invoked as listener(sql, parameters, seconds) after every statement
+# run through a pooled connection or its cursors (see add_query_listener).
+# Empty by default, in which case statements are not timed at all.
+_query_listeners: Tuple[Callable[[str, object, float], None], ...] = ()
+
+
+class _TimedCursor(sqlite3.Cursor):
+    """Cursor whose statements are timed for the registered query listeners."""
+
+    def execute(self, sql: str, parameters=()) -> sqlite3.Cursor:
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            _notify_query_listeners(sql, parameters, time.perf_counter() - start)
+
+    def executemany(self, sql: str, seq_of_parameters) -> sqlite3.Cursor:
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            _notify_query_listeners(sql, seq_of_parameters, time.perf_counter() - start)
+
+
+class PooledConnection:
+    """
+    Thin wrapper around a pooled sqlite3 connection.
+
+    Behaves like the underlying connection, except that close() hands the
+    connection back to its pool instead of closing it, so the existing
+    helpers can keep their get_db_connection()/conn.close() pattern.
+    """
+
+    def __init__(self, pool: 'ConnectionPool', conn: sqlite3.Connection):
+        self._pool = pool
+        self._conn = conn
+
+    def __getattr__(self, name):
+        if self._conn is None:
+            raise sqlite3.ProgrammingError("Cannot operate on a closed database.")
+        return getattr(self._conn, name)
+
+    def _checked_out(self) -> sqlite3.Connection:
+        if self._conn is None:
+            raise sqlite3.ProgrammingError("Cannot operate on a closed database.")
+        return self._conn
+
+    def execute(self, sql: str, parameters=()) -> sqlite3.Cursor:
+        """sqlite3.Connection.execute, timed for any registered query listeners."""
+        if not _query_listeners:
+            return self._checked_out().execute(sql, parameters)
+        start = time.perf_counter()
+        try:
+            return self._checked_out().execute(sql, parameters)
+        finally:
+            _notify_query_listeners(sql, parameters, time.perf_counter() - start)
+
+    def executemany(self, sql: str, seq_of_parameters) -> sqlite3.Cursor:
+        """sqlite3.Connection.executemany, timed for any registered query listeners."""
+        if not _query_listeners:
+            return self._checked_out().executemany(sql, seq_of_parameters)
+        start = time.perf_counter()
+        try:
+            return self._checked_out().executemany(sql, seq_of_parameters)
+        finally:
+            _notify_query_listeners(sql, seq_of_parameters, time.perf_counter() - start)
+
+    def cursor(self) -> sqlite3.Cursor:
+        """sqlite3.Connection.cursor; its statements are timed too while query listeners are registered."""
+        if not _query_listeners:
+            return self._checked_out().cursor()
+        return self._checked_out().cursor(_TimedCursor)
+
+    def close(self):
+        """Return the connection to the pool (safe to call more than once)."""
+        if self._conn is not None:
+            conn, self._conn = self._conn, None
+            self._pool.release(conn)
+
+    def __del__(self):
+        # A helper that raised before closing must not leak a pool slot.
+        self.close()
+
+
+class ConnectionPool:
+    """
+    Bounded, thread-safe pool of SQLite connections to a single database file.
+
+    Idle connections are kept in a LIFO queue so the most recently used (and
+    therefore warmest) connection is handed out first. At most `size`
+    connections are ever open; once they are all checked out, callers wait
+    up to `timeout` seconds for one to be returned.
+    """
+
+    def __init__(self, database: str, size: int = POOL_SIZE, timeout: float = POOL_TIMEOUT,
+                 pragmas: Optional[Dict] = None):
+        if size <= 0:
+            raise ValueError("Pool size must be a positive integer.")
+        self.database = database
+        self.size = size
+        self.timeout = timeout
+        self.pragmas = dict(pragmas or {})
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._open = 0
+        self._in_use = 0
+        self._closed = False
+        self._stats = {'hits': 0, 'misses': 0, 'waits': 0, 'timeouts': 0,
+                       'discarded': 0, 'high_water': 0}
+
+    def _connect(self) -> sqlite3.Connection:
+        # Connections are handed between threads, but only ever used by one
+        # thread at a time, so sqlite3's same-thread check can be disabled.
+        conn = sqlite3.connect(self.database, check_same_thread=False)
+        conn.row_factory = sqlite3.Row  # This enables column access by name
+        try:
+            for name, value in self.pragmas.items():
+                conn.execute(f'PRAGMA {name} = {value}')
+        except sqlite3.Error:
+            conn.close()
+            raise
+        return conn
+
+    @staticmethod
+    def _is_healthy(conn: sqlite3.Connection) -> bool:
+        try:
+            conn.execute('SELECT 1').fetchone()
+            return True
+        except sqlite3.Error:
+            return False
+
+    def _discard(self, conn: sqlite3.Connection):
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+        with self._lock:
+            self._open -= 1
+            self._stats['discarded'] += 1
+
+    def acquire(self) -> PooledConnection:
+        """Check a connection out of the pool, opening a new one if allowed."""
+        while True:
+            conn = None
+            with self._lock:
+                if self._closed:
+                    raise sqlite3.ProgrammingError("Connection pool is closed.")
+                try:
+                    conn = self._idle.get_nowait()
+                    self._stats['hits'] += 1
+                except queue.Empty:
+                    if self._open < self.size:
+                        self._open += 1
+                        self._stats['misses'] += 1
+                    else:
+                        self._stats['waits'] += 1
+                        conn = False  # must wait for a release
+
+            if conn is None:
+                try:
+                    conn = self._connect()
+                except sqlite3.Error:
+                    with self._lock:
+                        self._open -= 1
+                    raise
+            elif conn is False:
+                try:
+                    conn = self._idle.get(timeout=self.timeout)
+                except queue.Empty:
+                    with self._lock:
+                        self._stats['timeouts'] += 1
+                    raise sqlite3.OperationalError(
+                        f"Timed out after {self.timeout}s waiting for a database connection.")
+
+            if not self._is_healthy(conn):
+                self._discard(conn)
+                continue
+
+            with self._lock:
+                self._in_use += 1
+                self._stats['high_water'] = max(self._stats['high_water'], self._in_use)
+            return PooledConnection(self, conn)
+
+    def release(self, conn: sqlite3.Connection):
+        """Return a connection to the pool, rolling back any open transaction."""
+        with self._lock:
+            self._in_use -= 1
+            closed = self._closed
+        if closed:
+            self._discard(conn)
+            return
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            self._discard(conn)
+            return
+        self._idle.put(conn)
+
+    def close(self):
+        """Close every idle connection; checked-out ones are closed on release."""
+        with self._lock:
+            self._closed = True
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._discard(conn)
+
+    def stats(self) -> Dict:
+        """Return a snapshot of the pool counters."""
+        with self._lock:
+            return dict(self._stats, size=self.size, open=self._open, in_use=self._in_use,
+                        idle=self._idle.qsize())
+
+
+_pool: Optional[ConnectionPool] = None
+_pool_lock = threading.Lock()
+
+def get_pool() -> ConnectionPool:
+    """Get the connection pool for the configured DATABASE, creating it on first use."""
+    global _pool
+    pool = _pool
+    if pool is None or pool.database != DATABASE:
+        with _pool_lock:
+            if _pool is None or _pool.database != DATABASE:
+                if _pool is not None:
+                    _pool.close()
+                _book_cache.clear()  # cached rows belong to the previous database
+                _pool = ConnectionPool(DATABASE, POOL_SIZE, POOL_TIMEOUT, SQLITE_PRAGMAS)
+            pool = _pool
+    return pool
+
+def close_pool():
+    """Close the current connection pool; the next connection request opens a new one."""
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+            _pool = None
+        _book_cache.clear()
+
+def configure_database(database: Optional[str] = None, pool_size: Optional[int] = None,
+                       pool_timeout: Optional[float] = None, pragmas: Optional[Dict] = None):
+    """
+    Override the database path, pool settings and/or pragmas at startup.
+
+    Arguments left as None keep their current value. Pragmas are merged into
+    the current set. The existing pool is closed so the next connection picks
+    up the new settings.
+    """
+    global DATABASE, POOL_SIZE, POOL_TIMEOUT
+    if database is not None:
+        DATABASE = database
+    if pool_size is not None:
+        POOL_SIZE = int(pool_size)
+    if pool_timeout is not None:
+        POOL_TIMEOUT = float(pool_timeout)
+    if pragmas:
+        SQLITE_PRAGMAS.update(pragmas)
+    close_pool()
+
+def get_pool_stats() -> Dict:
+    """Get connection pool statistics (hits, misses, waits, high-water mark, ...)."""
+    return get_pool().stats()
+
+def get_book_cache_stats() -> Dict:
+    """Get book cache statistics (hits, misses, evictions, expirations, ...)."""
+    return _book_cache.stats()
+
+def add_query_listener(listener: Callable[[str, object, float], None]):
+    """
+    Call listener(sql, parameters, seconds) after every statement executed
+    through a pooled connection or its cursors (for executemany, parameters is the sequence
+    of parameter sets). Listeners run in the thread that ran the statement
+    and must not raise; the time measured is that of execute() itself, not
+    of fetching the rows.
+    """
+    global _query_listeners
+    with _pool_lock:
+        if listener not in _query_listeners:
+            _query_listeners = _query_listeners + (listener,)
+
+def remove_query_listener(listener: Callable[[str, object, float], None]):
+    """Stop calling a listener registered with add_query_listener."""
+    global _query_listeners
+    with _pool_lock:
+        _query_listeners = tuple(l for l in _query_listeners if l is not listener)
+
+def _notify_query_listeners(sql: str, parameters, seconds: float):
+    for listener in _query_listeners:
+        listener(sql, parameters, seconds)
+
+def get_db_connection():
+    """Get a database connection from the pool. Call close() to return it."""
+    return get_pool().acquire()
+
+def init_database():
+    """Initialize the database with required tables."""
+    directory = os.path.dirname(DATABASE)
+    if directory and DATABASE != ':memory:':
+        os.makedirs(directory, exist_ok=True)
+    
+    conn = get_db_connection()
+    
+    # Create books table
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS books (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            title TEXT NOT NULL,
+            author TEXT NOT NULL,
+            isbn TEXT UNIQUE NOT NULL,
+            total_copies INTEGER NOT NULL,
+            available_copies INTEGER NOT NULL
+        )
+    ''')
+    
+    # Create borrow_records table
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS borrow_records (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            patron_id TEXT NOT NULL,
+            book_id INTEGER NOT NULL,
+            borrow_date TEXT NOT NULL,
+            due_date TEXT NOT NULL,
+            return_date TEXT,
+            FOREIGN KEY (book_id) REFERENCES books (id)
+        )
+    ''')
+    
+    conn.commit()
+    
+    try:
+        migrate_database(conn)
+        _ensure_books_fts(conn)
+    finally:
+        conn.close()
+
+def _ensure_books_fts(conn):
+    """
+    Create the books_fts index if it is missing: the migration that adds it is
+    recorded as applied even when SQLite lacked FTS5 at the time, so a runtime
+    that has gained FTS5 builds the index on its next start.
+    """
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'books_fts'").fetchone():
+        return
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        _create_books_fts(conn)
+        conn.commit()
+    except sqlite3.Error:
+        conn.rollback()
+        raise
+
+def _create_books_fts(conn):
+    """Create the books_fts index and the triggers keeping it in sync with books."""
+    try:
+        conn.execute('''
+            CREATE VIRTUAL TABLE IF NOT EXISTS books_fts USING fts5(
+                title, author, content='books', content_rowid='id', prefix='2 3'
+            )
+        ''')
+    except sqlite3.OperationalError as e:
+        if 'no such module' not in str(e):
+            raise
+        return  # SQLite built without FTS5: search_books falls back to LIKE
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS books_fts_insert AFTER INSERT ON books BEGIN
+            INSERT INTO books_fts (rowid, title, author) VALUES (new.id, new.title, new.author);
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS books_fts_delete AFTER DELETE ON books BEGIN
+            INSERT INTO books_fts (books_fts, rowid, title, author)
+            VALUES ('delete', old.id, old.title, old.author);
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS books_fts_update AFTER UPDATE OF title, author ON books BEGIN
+            INSERT INTO books_fts (books_fts, rowid, title, author)
+            VALUES ('delete', old.id, old.title, old.author);
+            INSERT INTO books_fts (rowid, title, author) VALUES (new.id, new.title, new.author);
+        END
+    ''')
+    conn.execute("INSERT INTO books_fts (books_fts) VALUES ('rebuild')")
+
+# Each patron's counters recomputed from borrow_records and the payments
+# ledger: what the patrons table should hold.
+_PATRON_COUNTERS_SQL = '''
+    SELECT patron_id, SUM(active_loans) AS active_loans, SUM(total_loans) AS total_loans,
+           ROUND(SUM(fees_paid), 2) AS fees_paid
+    FROM (
+        SELECT patron_id, SUM(return_date IS NULL) AS active_loans, COUNT(*) AS total_loans,
+               0 AS fees_paid
+        FROM borrow_records GROUP BY patron_id
+        UNION ALL
+        SELECT patron_id, 0, 0, SUM(CASE kind WHEN 'refund' THEN -amount ELSE amount END)
+        FROM payments WHERE status = 'completed' AND patron_id != '' GROUP BY patron_id
+    )
+    GROUP BY patron_id
+'''
+
+def _create_patron_counters(conn):
+    """
+    Create the patrons table of per-patron counters, fill it, and add the
+    triggers that keep it in step with borrow_records and payments inside
+    the same transaction as every write.
+    """
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS patrons (
+            patron_id TEXT PRIMARY KEY,
+            active_loans INTEGER NOT NULL DEFAULT 0,
+            total_loans INTEGER NOT NULL DEFAULT 0,
+            fees_paid REAL NOT NULL DEFAULT 0
+        ) WITHOUT ROWID
+    ''')
+    conn.execute('DELETE FROM patrons')
+    conn.execute(f'INSERT INTO patrons (patron_id, active_loans, total_loans, fees_paid) {_PATRON_COUNTERS_SQL}')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS patrons_loan_insert AFTER INSERT ON borrow_records BEGIN
+            INSERT INTO patrons (patron_id, active_loans, total_loans)
+            VALUES (new.patron_id, new.return_date IS NULL, 1)
+            ON CONFLICT (patron_id) DO UPDATE
+            SET active_loans = active_loans + excluded.active_loans, total_loans = total_loans + 1;
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS patrons_loan_update AFTER UPDATE OF patron_id, return_date ON borrow_records BEGIN
+            UPDATE patrons SET active_loans = active_loans - (old.return_date IS NULL), total_loans = total_loans - 1
+            WHERE patron_id = old.patron_id;
+            INSERT INTO patrons (patron_id, active_loans, total_loans)
+            VALUES (new.patron_id, new.return_date IS NULL, 1)
+            ON CONFLICT (patron_id) DO UPDATE
+            SET active_loans = active_loans + excluded.active_loans, total_loans = total_loans + 1;
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS patrons_loan_delete AFTER DELETE ON borrow_records BEGIN
+            UPDATE patrons SET active_loans = active_loans - (old.return_date IS NULL), total_loans = total_loans - 1
+            WHERE patron_id = old.patron_id;
+        END
+    ''')
+    # Ledger entries count once they complete; refunds are subtracted
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS patrons_payment_insert AFTER INSERT ON payments
+        WHEN new.status = 'completed' AND new.patron_id != '' BEGIN
+            INSERT INTO patrons (patron_id, fees_paid)
+            VALUES (new.patron_id, CASE new.kind WHEN 'refund' THEN -new.amount ELSE new.amount END)
+            ON CONFLICT (patron_id) DO UPDATE SET fees_paid = ROUND(fees_paid + excluded.fees_paid, 2);
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS patrons_payment_complete AFTER UPDATE OF status ON payments
+        WHEN new.status = 'completed' AND old.status != 'completed' AND new.patron_id != '' BEGIN
+            INSERT INTO patrons (patron_id, fees_paid)
+            VALUES (new.patron_id, CASE new.kind WHEN 'refund' THEN -new.amount ELSE new.amount END)
+            ON CONFLICT (patron_id) DO UPDATE SET fees_paid = ROUND(fees_paid + excluded.fees_paid, 2);
+        END
+    ''')
+
+# Schema migrations, applied in order on top of the tables created by
+# init_database(). The database's PRAGMA user_version records how many have
+# run, so each one is applied exactly once. Each step is either a SQL
+# statement or a callable taking the connection. Never edit or reorder an
+# entry that has shipped; append a new one instead.
+SCHEMA_MIGRATIONS: List[Tuple[str, list]] = [
+    ('index active loans by patron, by book and by due date', [
+        '''CREATE INDEX IF NOT EXISTS idx_borrow_records_patron_active
+           ON borrow_records (patron_id, borrow_date) WHERE return_date IS NULL''',
+        '''CREATE INDEX IF NOT EXISTS idx_borrow_records_book_active
+           ON borrow_records (book_id, patron_id) WHERE return_date IS NULL''',
+        '''CREATE INDEX IF NOT EXISTS idx_borrow_records_due_active
+           ON borrow_records (due_date) WHERE return_date IS NULL''',
+    ]),
+    ('full-text index over book titles and authors', [
+        _create_books_fts,
+    ]),
+    ('index books by title for keyset pagination', [
+        'CREATE INDEX IF NOT EXISTS idx_books_title ON books (title)',
+    ]),
+    ('index all loans by patron, not just active ones, for borrowing history', [
+        # (patron_id, return_date, ...) still answers "active loans of a
+        # patron" as a two-column equality, so it replaces the partial index.
+        '''CREATE INDEX IF NOT EXISTS idx_borrow_records_patron
+           ON borrow_records (patron_id, return_date, borrow_date)''',
+        'DROP INDEX IF EXISTS idx_borrow_records_patron_active',
+    ]),
+    ('record late fee payments and the loans each one covers', [
+        '''CREATE TABLE IF NOT EXISTS payments (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            patron_id TEXT NOT NULL,
+            transaction_id TEXT,
+            amount REAL NOT NULL,
+            description TEXT NOT NULL,
+            created_at TEXT NOT NULL
+        )''',
+        '''CREATE TABLE IF NOT EXISTS payment_loans (
+            payment_id INTEGER NOT NULL,
+            borrow_record_id INTEGER NOT NULL,
+            amount REAL NOT NULL,
+            PRIMARY KEY (payment_id, borrow_record_id),
+            FOREIGN KEY (payment_id) REFERENCES payments (id),
+            FOREIGN KEY (borrow_record_id) REFERENCES borrow_records (id)
+        )''',
+        '''CREATE INDEX IF NOT EXISTS idx_payment_loans_record
+           ON payment_loans (borrow_record_id)''',
+    ]),
+    ('turn payments into an idempotent ledger of charges and refunds', [
+        "ALTER TABLE payments ADD COLUMN kind TEXT NOT NULL DEFAULT 'charge'",
+        "ALTER TABLE payments ADD COLUMN status TEXT NOT NULL DEFAULT 'completed'",
+        'ALTER TABLE payments ADD COLUMN idempotency_key TEXT',
+        'ALTER TABLE payments ADD COLUMN message TEXT',
+        'ALTER TABLE payments ADD COLUMN updated_at TEXT',
+        '''CREATE UNIQUE INDEX IF NOT EXISTS idx_payments_idempotency_key
+           ON payments (idempotency_key)''',
+        'CREATE INDEX IF NOT EXISTS idx_payments_transaction ON payments (transaction_id)',
+        'CREATE INDEX IF NOT EXISTS idx_payments_patron ON payments (patron_id)',
+    ]),
+    ('add the background job queue', [
+        '''CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'queued',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            max_attempts INTEGER NOT NULL,
+            run_at TEXT NOT NULL,
+            result TEXT,
+            last_error TEXT,
+            created_at TEXT NOT NULL,
+            updated_at TEXT NOT NULL
+        )''',
+        """CREATE INDEX IF NOT EXISTS idx_jobs_queued
+           ON jobs (run_at) WHERE status = 'queued'""",
+        'CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status, updated_at)',
+    ]),
+    ('add per-patron loan and fee counters', [
+        _create_patron_counters,
+    ]),
+    ('add the holds queue and patron notifications', [
+        '''CREATE TABLE IF NOT EXISTS holds (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            patron_id TEXT NOT NULL,
+            book_id INTEGER NOT NULL,
+            status TEXT NOT NULL DEFAULT 'waiting',
+            created_at TEXT NOT NULL,
+            ready_at TEXT,
+            expires_at TEXT,
+            updated_at TEXT NOT NULL,
+            FOREIGN KEY (book_id) REFERENCES books (id)
+        )''',
+        """CREATE INDEX IF NOT EXISTS idx_holds_waiting
+           ON holds (book_id, created_at) WHERE status = 'waiting'""",
+        """CREATE INDEX IF NOT EXISTS idx_holds_ready_expiry
+           ON holds (expires_at) WHERE status = 'ready'""",
+        """CREATE UNIQUE INDEX IF NOT EXISTS idx_holds_active
+           ON holds (patron_id, book_id) WHERE status IN ('waiting', 'ready')""",
+        'CREATE INDEX IF NOT EXISTS idx_holds_patron ON holds (patron_id, created_at)',
+        '''CREATE TABLE IF NOT EXISTS notifications (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            patron_id TEXT NOT NULL,
+            hold_id INTEGER,
+            kind TEXT NOT NULL,
+            message TEXT NOT NULL,
+            created_at TEXT NOT NULL,
+            sent_at TEXT,
+            FOREIGN KEY (hold_id) REFERENCES holds (id)
+        )''',
+        'CREATE INDEX IF NOT EXISTS idx_notifications_patron ON notifications (patron_id, created_at)',
+    ]),
+]
+
+def get_schema_version(conn) -> int:
+    """Get the number of schema migrations applied to the database."""
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+def migrate_database(conn) -> int:
+    """
+    Apply any pending schema migrations in a single transaction.
+    
+    Returns:
+        int: Number of migrations applied
+    """
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        version = get_schema_version(conn)
+        pending = SCHEMA_MIGRATIONS[version:]
+        for _description, statements in pending:
+            for statement in statements:
+                if callable(statement):
+                    statement(conn)
+                else:
+                    conn.execute(statement)
+        if pending:
+            conn.execute(f'PRAGMA user_version = {len(SCHEMA_MIGRATIONS)}')
+        conn.commit()
+        return len(pending)
+    except sqlite3.Error:
+        conn.rollback()
+        raise
+
+def explain_query_plan(sql: str, params: Tuple = ()) -> List[str]:
+    """Get the EXPLAIN QUERY PLAN details for a query, one string per plan step."""
+    conn = get_db_connection()
+    try:
+        rows = conn.execute(f'EXPLAIN QUERY PLAN {sql}', params).fetchall()
+    finally:
+        conn.close()
+    return [row['detail'] for row in rows]
+
+def add_sample_data():
+    """Add sample data to the database if it's empty."""
+    conn = get_db_connection()
+    book_count = conn.execute('SELECT COUNT(*) as count FROM books').fetchone()['count']
+    
+    if book_count == 0:
+        # Add sample books
+        sample_books = [
+            ('The Great Gatsby', 'F. Scott Fitzgerald', '9780743273565', 3),
+            ('To Kill a Mockingbird', 'Harper Lee', '9780061120084', 2),
+            ('1984', 'George Orwell', '9780451524935', 1)
+        ]
+        
+        for title, author, isbn, copies in sample_books:
+            conn.execute('''
+                INSERT INTO books (title, author, isbn, total_copies, available_copies)
+                VALUES (?, ?, ?, ?, ?)
+            ''', (title, author, isbn, copies, copies))
+        
+        # Make 1984 unavailable by adding a borrow record
+        conn.execute('''
+            INSERT INTO borrow_records (patron_id, book_id, borrow_date, due_date)
+            VALUES (?, ?, ?, ?)
+        ''', ('123456', 3, 
+              (datetime.now() - timedelta(days=5)).isoformat(),
+              (datetime.now() + timedelta(days=9)).isoformat()))
+        
+        # Update available copies for 1984
+        conn.execute('UPDATE books SET available_copies = 0 WHERE id = 3')
+        
+        conn.commit()
+    
+    conn.close()
+
+# Helper Functions for Database Operations
+
+def get_all_books(limit: Optional[int] = None, after: Optional[Tuple[str, int]] = None) -> List[Dict]:
+    """
+    Get books from the database ordered by (title, id).
+    
+    With no arguments every book is returned. For keyset pagination pass
+    `limit`, and `after` as the (title, id) of the last book of the previous
+    page; the next page is then read straight off the title index.
+    """
+    conn = get_db_connection()
+    try:
+        if after is None:
+            books = conn.execute('SELECT * FROM books ORDER BY title, id LIMIT ?',
+                                 (-1 if limit is None else limit,)).fetchall()
+        else:
+            books = conn.execute('''
+                SELECT * FROM books WHERE (title, id) > (?, ?)
+                ORDER BY title, id LIMIT ?
+            ''', (after[0], after[1], -1 if limit is None else limit)).fetchall()
+    finally:
+        conn.close()
+    return [dict(book) for book in books]
+
+def _invalidate_book(book_id: int):
+    """Drop a book from the lookup cache after a write to its row."""
+    _book_cache.invalidate(('id', book_id))
+
+def get_book_by_id(book_id: int) -> Optional[Dict]:
+    """
+    Get a specific book by ID (served from the book cache when possible).
+    
+    Do not use the cached availability to decide a borrow; the borrow path
+    re-reads the row inside its own transaction.
+    """
+    cached = _book_cache.get(('id', book_id))
+    if cached is not None:
+        return dict(cached)
+    
+    generation = _book_cache.generation
+    conn = get_db_connection()
+    try:
+        book = conn.execute('SELECT * FROM books WHERE id = ?', (book_id,)).fetchone()
+    finally:
+        conn.close()
+    if not book:
+        return None
+    book = dict(book)
+    _book_cache.set(('id', book_id), book, generation)
+    return dict(book)
+
+def get_book_by_isbn(isbn: str) -> Optional[Dict]:
+    """Get a specific book by ISBN (served from the book cache when possible)."""
+    # ISBNs are unique and never reassigned, so ISBN -> ID can be cached
+    # separately and the row itself shared with get_book_by_id.
+    book_id = _book_cache.get(('isbn', isbn))
+    if book_id is not None:
+        cached = _book_cache.get(('id', book_id))
+        if cached is not None:
+            return dict(cached)
+    
+    generation = _book_cache.generation
+    conn = get_db_connection()
+    try:
+        book = conn.execute('SELECT * FROM books WHERE isbn = ?', (isbn,)).fetchone()
+    finally:
+        conn.close()
+    if not book:
+        return None
+    book = dict(book)
+    _book_cache.set(('isbn', isbn), book['id'])
+    _book_cache.set(('id', book['id']), book, generation)
+    return dict(book)
+
+def _fts_query(search_term: str, column: str) -> str:
+    """Build an FTS5 MATCH expression requiring every word as a prefix in one column."""
+    tokens = re.findall(r'\w+', search_term.lower())
+    return ' '.join(f'{column}:"{token}"*' for token in tokens)
+
+def search_books(search_term: str, search_type: str, limit: int) -> List[Dict]:
+    """
+    Search books by title or author (word-prefix match, best matches first)
+    or by exact ISBN, returning at most `limit` rows.
+    """
+    conn = get_db_connection()
+    try:
+        if search_type == 'isbn':
+            books = conn.execute('SELECT * FROM books WHERE isbn = ? LIMIT ?',
+                                 (search_term, limit)).fetchall()
+            return [dict(book) for book in books]
+        
+        query = _fts_query(search_term, search_type)
+        if not query:
+            return []
+        try:
+            books = conn.execute('''
+                SELECT b.* FROM books_fts
+                JOIN books b ON b.id = books_fts.rowid
+                WHERE books_fts MATCH ?
+                ORDER BY books_fts.rank, b.title
+                LIMIT ?
+            ''', (query, limit)).fetchall()
+        except sqlite3.OperationalError as e:
+            if 'no such table' not in str(e):
+                raise
+            # No FTS5 in this SQLite build: fall back to a substring scan
+            pattern = '%' + re.sub(r'([%_\\])', r'\\\1', search_term) + '%'
+            books = conn.execute(f'''
+                SELECT * FROM books WHERE {search_type} LIKE ? ESCAPE '\\'
+                ORDER BY title LIMIT ?
+            ''', (pattern, limit)).fetchall()
+    finally:
+        conn.close()
+    return [dict(book) for book in books]
+
+def get_patron_borrowed_books(patron_id: str) -> List[Dict]:
+    """Get currently borrowed books for a patron."""
+    conn = get_db_connection()
+    try:
+        records = conn.execute('''
+            SELECT br.*, b.title, b.author 
+            FROM borrow_records br 
+            JOIN books b ON br.book_id = b.id 
+            WHERE br.patron_id = ? AND br.return_date IS NULL
+            ORDER BY br.borrow_date
+        ''', (patron_id,)).fetchall()
+    finally:
+        conn.close()
+    
+    borrowed_books = []
+    for record in records:
+        borrowed_books.append({
+            'book_id': record['book_id'],
+            'title': record['title'],
+            'author': record['author'],
+            'borrow_date': datetime.fromisoformat(record['borrow_date']),
+            'due_date': datetime.fromisoformat(record['due_date']),
+            'is_overdue': datetime.now() > datetime.fromisoformat(record['due_date'])
+        })
+    
+    return borrowed_books
+
+def get_patron_loans(patron_id: str) -> List[Dict]:
+    """Get every borrow record of a patron (current and returned), oldest first."""
+    conn = get_db_connection()
+    try:
+        records = conn.execute('''
+            SELECT br.id, br.book_id, br.borrow_date, br.due_date, br.return_date, b.title, b.author
+            FROM borrow_records br
+            JOIN books b ON br.book_id = b.id
+            WHERE br.patron_id = ?
+            ORDER BY br.borrow_date
+        ''', (patron_id,)).fetchall()
+    finally:
+        conn.close()
+    
+    return [{
+        'record_id': record['id'],
+        'book_id': record['book_id'],
+        'title': record['title'],
+        'author': record['author'],
+        'borrow_date': datetime.fromisoformat(record['borrow_date']),
+        'due_date': datetime.fromisoformat(record['due_date']),
+        'return_date': datetime.fromisoformat(record['return_date']) if record['return_date'] else None
+    } for record in records]
+
+def get_active_loan_due_dates(pairs: Optional[List[Tuple[str, int]]] = None) -> List[Tuple[str, int, str]]:
+    """
+    Get (patron_id, book_id, due_date) for active loans.
+    
+    With `pairs`, only loans matching those (patron_id, book_id) pairs are
+    returned, oldest borrow first; otherwise every active loan is, in no
+    particular order. Rows are plain tuples, skipping the sqlite3.Row
+    factory, because this feeds batch jobs over very many loans.
+    """
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.row_factory = None
+        if pairs is None:
+            return cursor.execute('''
+                SELECT patron_id, book_id, due_date FROM borrow_records
+                WHERE return_date IS NULL
+            ''').fetchall()
+        
+        result = []
+        # Two bound parameters per pair; stay well below SQLite's limit
+        for start in range(0, len(pairs), 400):
+            batch = pairs[start:start + 400]
+            values = ', '.join('(?, ?)' for _ in batch)
+            params = [value for pair in batch for value in pair]
+            result.extend(cursor.execute(f'''
+                WITH wanted (patron_id, book_id) AS (VALUES {values})
+                SELECT br.patron_id, br.book_id, br.due_date
+                FROM wanted
+                JOIN borrow_records br
+                  ON br.patron_id = wanted.patron_id AND br.book_id = wanted.book_id
+                WHERE br.return_date IS NULL
+                ORDER BY br.borrow_date
+            ''', params).fetchall())
+        return result
+    finally:
+        conn.close()
+
+def get_overdue_loans(due_before: datetime, limit: int,
+                      after: Optional[Tuple[str, int]] = None) -> List[Tuple[int, str, int, str, str]]:
+    """
+    Get one chunk of active loans due before `due_before`, ordered by
+    (due_date, id), as (record_id, patron_id, book_id, title, due_date) tuples.
+    
+    Pass the (due_date, id) of the last loan of the previous chunk as `after`
+    to continue; each chunk is a range scan of the active-loan due_date index.
+    """
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.row_factory = None
+        return cursor.execute('''
+            SELECT br.id, br.patron_id, br.book_id, b.title, br.due_date
+            FROM borrow_records br
+            JOIN books b ON br.book_id = b.id
+            WHERE br.return_date IS NULL AND br.due_date < ? AND (br.due_date, br.id) > (?, ?)
+            ORDER BY br.due_date, br.id
+            LIMIT ?
+        ''', (due_before.isoformat(), *(after or ('', 0)), limit)).fetchall()
+    finally:
+        conn.close()
+
+def get_patron_fee_loans(patron_id: str) -> List[Dict]:
+    """
+    Get a patron's active loans together with the late fees already paid on
+    each, oldest borrow first. Completed refunds of a charge are taken off
+    its loans in proportion to their shares, so the loans' paid amounts add
+    up to the patron's fees_paid counter.
+    """
+    conn = get_db_connection()
+    try:
+        records = conn.execute('''
+            SELECT br.id, br.book_id, br.due_date, b.title,
+                   ROUND(COALESCE(SUM(CASE WHEN p.status = 'completed' THEN pl.amount * MAX(0, 1 - COALESCE((
+                       SELECT SUM(r.amount) FROM payments r
+                       WHERE r.transaction_id = p.transaction_id AND r.kind = 'refund' AND r.status = 'completed'
+                   ), 0) / p.amount) END), 0), 2) AS paid
+            FROM borrow_records br
+            JOIN books b ON br.book_id = b.id
+            LEFT JOIN payment_loans pl ON pl.borrow_record_id = br.id
+            LEFT JOIN payments p ON p.id = pl.payment_id AND p.kind = 'charge'
+            WHERE br.patron_id = ? AND br.return_date IS NULL
+            GROUP BY br.id
+            ORDER BY br.borrow_date
+        ''', (patron_id,)).fetchall()
+    finally:
+        conn.close()
+    
+    return [{
+        'record_id': record['id'],
+        'book_id': record['book_id'],
+        'title': record['title'],
+        'due_date': datetime.fromisoformat(record['due_date']),
+        'paid': record['paid']
+    } for record in records]
+
+def get_payment_by_key(idempotency_key: str) -> Optional[Dict]:
+    """Get a ledger entry by its idempotency key."""
+    conn = get_db_connection()
+    try:
+        payment = conn.execute('SELECT * FROM payments WHERE idempotency_key = ?',
+                               (idempotency_key,)).fetchone()
+    finally:
+        conn.close()
+    return dict(payment) if payment else None
+
+def get_payment_by_transaction(transaction_id: str) -> Optional[Dict]:
+    """Get the completed charge with the given gateway transaction ID."""
+    conn = get_db_connection()
+    try:
+        payment = conn.execute('''
+            SELECT * FROM payments
+            WHERE transaction_id = ? AND kind = 'charge' AND status = 'completed'
+        ''', (transaction_id,)).fetchone()
+    finally:
+        conn.close()
+    return dict(payment) if payment else None
+
+def begin_payment(idempotency_key: str, kind: str, patron_id: str, amount: float, description: str,
+                  loans: List[Tuple[int, float]] = (), transaction_id: Optional[str] = None,
+                  stale_before: Optional[datetime] = None) -> Tuple[str, Optional[Dict]]:
+    """
+    Claim an idempotency key in the payments ledger before calling the gateway.
+    
+    A new key gets a 'pending' entry, with the (borrow_record_id, amount) share
+    applied to each loan. A key whose previous attempt (of the same kind, for
+    the same patron) failed is reclaimed for a retry, as is one still pending
+    since before `stale_before` (its process died before recording the outcome).
+    
+    Returns:
+        tuple: (state, payment) where state is 'new' (go ahead and call the
+        gateway), 'existing' (a completed or in-flight entry already holds the
+        key; return its outcome) or 'error'
+    """
+    now = datetime.now().isoformat()
+    conn = get_db_connection()
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        payment = conn.execute('SELECT * FROM payments WHERE idempotency_key = ?',
+                               (idempotency_key,)).fetchone()
+        abandoned = (payment and payment['status'] == 'pending' and stale_before is not None
+                     and payment['updated_at'] < stale_before.isoformat())
+        if payment and ((payment['status'] != 'failed' and not abandoned) or payment['kind'] != kind
+                        or payment['patron_id'] != patron_id):
+            conn.rollback()
+            return 'existing', dict(payment)
+        
+        if payment:
+            payment_id = payment['id']
+            conn.execute('''
+                UPDATE payments SET status = 'pending', amount = ?, description = ?, message = NULL,
+                                    updated_at = ?
+                WHERE id = ?
+            ''', (amount, description, now, payment_id))
+            conn.execute('DELETE FROM payment_loans WHERE payment_id = ?', (payment_id,))
+        else:
+            payment_id = conn.execute('''
+                INSERT INTO payments (idempotency_key, kind, status, patron_id, transaction_id, amount,
+                                      description, created_at, updated_at)
+                VALUES (?, ?, 'pending', ?, ?, ?, ?, ?, ?)
+            ''', (idempotency_key, kind, patron_id, transaction_id, amount, description, now, now)).lastrowid
+        conn.executemany('''
+            INSERT INTO payment_loans (payment_id, borrow_record_id, amount) VALUES (?, ?, ?)
+        ''', [(payment_id, record_id, share) for record_id, share in loans])
+        payment = conn.execute('SELECT * FROM payments WHERE id = ?', (payment_id,)).fetchone()
+        conn.commit()
+        return 'new', dict(payment)
+    except sqlite3.Error:
+        conn.rollback()
+        return 'error', None
+    finally:
+        conn.close()
+
+def finish_payment(payment_id: int, status: str, message: str, transaction_id: Optional[str] = None) -> bool:
+    """Record the outcome ('completed' or 'failed') of a pending ledger entry."""
+    conn = get_db_connection()
+    try:
+        conn.execute('''
+            UPDATE payments
+            SET status = ?, message = ?, transaction_id = COALESCE(?, transaction_id), updated_at = ?
+            WHERE id = ?
+        ''', (status, message, transaction_id, datetime.now().isoformat(), payment_id))
+        conn.commit()
+        return True
+    except sqlite3.Error:
+        conn.rollback()
+        return False
+    finally:
+        conn.close()
+
+def get_payment_loans(payment_id: int) -> List[Dict]:
+    """Get the loans covered by a payment."""
+    conn = get_db_connection()
+    try:
+        rows = conn.execute('''
+            SELECT borrow_record_id, amount FROM payment_loans WHERE payment_id = ?
+            ORDER BY borrow_record_id
+        ''', (payment_id,)).fetchall()
+    finally:
+        conn.close()
+    return [dict(row) for row in rows]
+
+def get_patron_borrow_count(patron_id: str) -> int:
+    """Get the number of books currently borrowed by a patron (a primary key read of its counters)."""
+    conn = get_db_connection()
+    try:
+        patron = conn.execute('SELECT active_loans FROM patrons WHERE patron_id = ?',
+                              (patron_id,)).fetchone()
+    finally:
+        conn.close()
+    return patron['active_loans'] if patron else 0
+
+def get_patron_counters(patron_id: str) -> Dict:
+    """Get a patron's active_loans, total_loans and fees_paid counters (zeros for a new patron)."""
+    conn = get_db_connection()
+    try:
+        patron = conn.execute('SELECT * FROM patrons WHERE patron_id = ?', (patron_id,)).fetchone()
+    finally:
+        conn.close()
+    if not patron:
+        return {'patron_id': patron_id, 'active_loans': 0, 'total_loans': 0, 'fees_paid': 0.0}
+    return dict(patron)
+
+def verify_patron_counters() -> List[Dict]:
+    """
+    Compare the patrons table with counters recomputed from borrow_records and
+    payments.
+    
+    Returns:
+        list: One dict per patron whose counters have drifted, with patron_id
+        and the 'stored' and 'actual' (active_loans, total_loans, fees_paid)
+    """
+    conn = get_db_connection()
+    try:
+        rows = conn.execute(f'''
+            WITH actual AS ({_PATRON_COUNTERS_SQL})
+            SELECT a.patron_id, p.active_loans, p.total_loans, p.fees_paid,
+                   a.active_loans AS actual_active, a.total_loans AS actual_total, a.fees_paid AS actual_fees
+            FROM actual a LEFT JOIN patrons p ON p.patron_id = a.patron_id
+            UNION ALL
+            SELECT p.patron_id, p.active_loans, p.total_loans, p.fees_paid, 0, 0, 0
+            FROM patrons p WHERE p.patron_id NOT IN (SELECT patron_id FROM actual)
+        ''').fetchall()
+    finally:
+        conn.close()
+    
+    drift = []
+    for row in rows:
+        stored = (row['active_loans'] or 0, row['total_loans'] or 0, round(row['fees_paid'] or 0, 2))
+        actual = (row['actual_active'], row['actual_total'], round(row['actual_fees'] or 0, 2))
+        if stored != actual:
+            drift.append({'patron_id': row['patron_id'], 'stored': stored, 'actual': actual})
+    return drift
+
+def rebuild_patron_counters() -> int:
+    """
+    Recompute every patron's counters from borrow_records and payments,
+    in one write transaction.
+    
+    Returns:
+        int: Number of patrons with counters
+    """
+    conn = get_db_connection()
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        conn.execute('DELETE FROM patrons')
+        count = conn.execute(f'''
+            INSERT INTO patrons (patron_id, active_loans, total_loans, fees_paid) {_PATRON_COUNTERS_SQL}
+        ''').rowcount
+        conn.commit()
+        return count
+    except sqlite3.Error:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+def insert_book(title: str, author: str, isbn: str, total_copies: int, available_copies: int) -> bool:
+    """Insert a new book into the database."""
+    conn = get_db_connection()
+    try:
+        conn.execute('''
+            INSERT INTO books (title, author, isbn, total_copies, available_copies)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (title, author, isbn, total_copies, available_copies))
+        conn.commit()
+        conn.close()
+        _book_cache.invalidate(('isbn', isbn))
+        return True
+    except Exception as e:
+        conn.close()
+        return False
+
+def get_existing_isbns(isbns: List[str]) -> set:
+    """Get the subset of the given ISBNs that are already in the catalog."""
+    existing = set()
+    conn = get_db_connection()
+    try:
+        # Stay well below SQLite's bound-parameter limit
+        for start in range(0, len(isbns), 500):
+            batch = isbns[start:start + 500]
+            placeholders = ', '.join('?' * len(batch))
+            rows = conn.execute(f'SELECT isbn FROM books WHERE isbn IN ({placeholders})', batch).fetchall()
+            existing.update(row['isbn'] for row in rows)
+    finally:
+        conn.close()
+    return existing
+
+def insert_books_bulk(books: List[Tuple[str, str, str, int, int]]) -> bool:
+    """
+    Insert many (title, author, isbn, total_copies, available_copies) rows in
+    one transaction. Either every row is inserted or none is.
+    """
+    conn = get_db_connection()
+    try:
+        conn.executemany('''
+            INSERT INTO books (title, author, isbn, total_copies, available_copies)
+            VALUES (?, ?, ?, ?, ?)
+        ''', books)
+        conn.commit()
+        for book in books:
+            _book_cache.invalidate(('isbn', book[2]))
+        return True
+    except sqlite3.Error:
+        conn.rollback()
+        return False
+    finally:
+        conn.close()
+
+def insert_borrow_record(patron_id: str, book_id: int, borrow_date: datetime, due_date: datetime) -> bool:
+    """Insert a new borrow record into the database."""
+    conn = get_db_connection()
+    try:
+        conn.execute('''
+            INSERT INTO borrow_records (patron_id, book_id, borrow_date, due_date)
+            VALUES (?, ?, ?, ?)
+        ''', (patron_id, book_id, borrow_date.isoformat(), due_date.isoformat()))
+        conn.commit()
+        conn.close()
+        return True
+    except Exception as e:
+        conn.close()
+        return False
+
+def update_book_availability(book_id: int, change: int) -> bool:
+    """Update the available copies of a book by a given amount (+1 for return, -1 for borrow)."""
+    conn = get_db_connection()
+    try:
+        conn.execute('''
+            UPDATE books SET available_copies = available_copies + ? WHERE id = ?
+        ''', (change, book_id))
+        conn.commit()
+        conn.close()
+        _invalidate_book(book_id)
+        return True
+    except Exception as e:
+        conn.close()
+        return False
+
+def update_borrow_record_return_date(patron_id: str, book_id: int, return_date: datetime) -> bool:
+    """Update the return date for a borrow record."""
+    conn = get_db_connection()
+    try:
+        conn.execute('''
+            UPDATE borrow_records 
+            SET return_date = ? 
+            WHERE patron_id = ? AND book_id = ? AND return_date IS NULL
+        ''', (return_date.isoformat(), patron_id, book_id))
+        conn.commit()
+        conn.close()
+        return True
+    except Exception as e:
+        conn.close()
+        return False
+
+def _release_copies(conn, book_id: int, copies: int, now: datetime, hold_expires_at: datetime) -> List[int]:
+    """
+    Hand freed copies of a book to the oldest waiting holds, one copy each,
+    and put any copies left over back on the shelf. Each hold made ready
+    gets a notification. Runs inside the caller's transaction; each copy
+    costs one lookup on the waiting-holds (book_id, created_at) index.
+
+    Returns:
+        list: IDs of the holds made ready, in allocation order
+    """
+    ready = []
+    for _ in range(copies):
+        hold = conn.execute('''
+            SELECT id, patron_id FROM holds WHERE book_id = ? AND status = 'waiting'
+            ORDER BY created_at, id LIMIT 1
+        ''', (book_id,)).fetchone()
+        if not hold:
+            break
+        conn.execute('''
+            UPDATE holds SET status = 'ready', ready_at = ?, expires_at = ?, updated_at = ?
+            WHERE id = ?
+        ''', (now.isoformat(), hold_expires_at.isoformat(), now.isoformat(), hold['id']))
+        conn.execute('''
+            INSERT INTO notifications (patron_id, hold_id, kind, message, created_at)
+            SELECT ?, ?, 'hold_ready',
+                   'Your hold on "' || title || '" is ready. Pick it up by ' || ? || '.', ?
+            FROM books WHERE id = ?
+        ''', (hold['patron_id'], hold['id'], hold_expires_at.strftime('%Y-%m-%d'), now.isoformat(), book_id))
+        ready.append(hold['id'])
+
+    if copies > len(ready):
+        conn.execute('''
+            UPDATE books SET available_copies = MIN(available_copies + ?, total_copies)
+            WHERE id = ?
+        ''', (copies - len(ready), book_id))
+    return ready
+
+def borrow_book_transaction(patron_id: str, book_id: int, borrow_date: datetime, due_date: datetime,
+                            max_borrowed: int) -> Tuple[str, Optional[Dict]]:
+    """
+    Borrow a book in a single write transaction.
+
+    The availability check, the patron's borrowing limit, the availability
+    decrement and the borrow record insert all happen under one
+    BEGIN IMMEDIATE lock and are committed once, so two patrons can never
+    both take the last copy. A patron whose hold on the book is ready takes
+    the copy set aside for them, and the hold is fulfilled.
+
+    Returns:
+        tuple: (status, book) where status is one of 'success', 'not_found',
+        'unavailable', 'limit_reached' or 'error', and book is the book row
+        as it was before the borrow (None if not found).
+    """
+    conn = get_db_connection()
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        book = conn.execute('SELECT * FROM books WHERE id = ?', (book_id,)).fetchone()
+        if not book:
+            conn.rollback()
+            return 'not_found', None
+        book = dict(book)
+
+        hold = conn.execute('''
+            SELECT id FROM holds WHERE patron_id = ? AND book_id = ? AND status = 'ready'
+        ''', (patron_id, book_id)).fetchone()
+        if not hold and book['available_copies'] <= 0:
+            conn.rollback()
+            return 'unavailable', book
+
+        patron = conn.execute('SELECT active_loans FROM patrons WHERE patron_id = ?',
+                              (patron_id,)).fetchone()
+        if patron and patron['active_loans'] >= max_borrowed:
+            conn.rollback()
+            return 'limit_reached', book
+
+        if hold:
+            conn.execute('''
+                UPDATE holds SET status = 'fulfilled', updated_at = ? WHERE id = ?
+            ''', (borrow_date.isoformat(), hold['id']))
+        else:
+            updated = conn.execute('''
+                UPDATE books SET available_copies = available_copies - 1
+                WHERE id = ? AND available_copies > 0
+            ''', (book_id,)).rowcount
+            if updated == 0:
+                conn.rollback()
+                return 'unavailable', book
+
+        conn.execute('''
+            INSERT INTO borrow_records (patron_id, book_id, borrow_date, due_date)
+            VALUES (?, ?, ?, ?)
+        ''', (patron_id, book_id, borrow_date.isoformat(), due_date.isoformat()))
+        conn.commit()
+        _invalidate_book(book_id)
+        return 'success', book
+    except sqlite3.Error:
+        conn.rollback()
+        return 'error', None
+    finally:
+        conn.close()
+
+def return_book_transaction(patron_id: str, book_id: int, return_date: datetime,
+                            hold_expires_at: datetime) -> Tuple[str, Optional[Dict]]:
+    """
+    Return a borrowed book in a single write transaction.
+
+    The patron's oldest active loan of the book is found through the
+    (patron_id, return_date) index and stamped with the return date, and
+    the copy goes to the oldest waiting hold (ready for pickup until
+    hold_expires_at) or back on the shelf, under one BEGIN IMMEDIATE lock
+    with one commit.
+
+    Returns:
+        tuple: (status, loan) where status is one of 'success', 'not_found'
+        (no active loan of this book for this patron) or 'error', and loan
+        has record_id, title, borrow_date and due_date (datetimes), and
+        hold_id (the hold the copy went to, or None)
+    """
+    conn = get_db_connection()
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        loan = conn.execute('''
+            SELECT br.id, br.borrow_date, br.due_date, b.title
+            FROM borrow_records br
+            JOIN books b ON br.book_id = b.id
+            WHERE br.patron_id = ? AND br.book_id = ? AND br.return_date IS NULL
+            ORDER BY br.borrow_date
+            LIMIT 1
+        ''', (patron_id, book_id)).fetchone()
+        if not loan:
+            conn.rollback()
+            return 'not_found', None
+
+        conn.execute('UPDATE borrow_records SET return_date = ? WHERE id = ?',
+                     (return_date.isoformat(), loan['id']))
+        ready = _release_copies(conn, book_id, 1, return_date, hold_expires_at)
+        conn.commit()
+        _invalidate_book(book_id)
+        return 'success', {
+            'record_id': loan['id'],
+            'title': loan['title'],
+            'borrow_date': datetime.fromisoformat(loan['borrow_date']),
+            'due_date': datetime.fromisoformat(loan['due_date']),
+            'hold_id': ready[0] if ready else None
+        }
+    except sqlite3.Error:
+        conn.rollback()
+        return 'error', None
+    finally:
+        conn.close()
+
+def return_books_batch(items: List[Tuple[str, int]], return_date: datetime,
+                       hold_expires_at: datetime) -> Optional[List[Optional[Dict]]]:
+    """
+    Return many borrowed books in a single write transaction.
+
+    Active loans for all the (patron_id, book_id) items are looked up a few
+    hundred pairs per query; an item listed twice closes the pair's two
+    oldest loans. The loans are then closed with one UPDATE per chunk of
+    IDs and each book's returned copies go to its waiting holds, oldest
+    first, with the rest put back on the shelf by one UPDATE per book, all
+    under one BEGIN IMMEDIATE lock with one commit.
+
+    Returns:
+        Optional[list]: Per item, in order, the closed loan (record_id, title,
+        borrow_date, due_date) or None if the item had no active loan; None
+        overall on a database error
+    """
+    pairs = list(dict.fromkeys(items))
+    conn = get_db_connection()
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        loans_by_pair: Dict[Tuple[str, int], List] = {}
+        for start in range(0, len(pairs), 400):
+            batch = pairs[start:start + 400]
+            values = ', '.join('(?, ?)' for _ in batch)
+            params = [value for pair in batch for value in pair]
+            for loan in conn.execute(f'''
+                WITH wanted (patron_id, book_id) AS (VALUES {values})
+                SELECT br.id, br.patron_id, br.book_id, br.borrow_date, br.due_date, b.title
+                FROM wanted
+                JOIN borrow_records br
+                  ON br.patron_id = wanted.patron_id AND br.book_id = wanted.book_id
+                JOIN books b ON br.book_id = b.id
+                WHERE br.return_date IS NULL
+                ORDER BY br.borrow_date
+            ''', params):
+                loans_by_pair.setdefault((loan['patron_id'], loan['book_id']), []).append(loan)
+
+        results: List[Optional[Dict]] = []
+        returned_copies: Dict[int, int] = {}
+        for pair in items:
+            loans = loans_by_pair.get(pair)
+            if not loans:
+                results.append(None)
+                continue
+            loan = loans.pop(0)
+            returned_copies[pair[1]] = returned_copies.get(pair[1], 0) + 1
+            results.append({
+                'record_id': loan['id'],
+                'title': loan['title'],
+                'borrow_date': datetime.fromisoformat(loan['borrow_date']),
+                'due_date': datetime.fromisoformat(loan['due_date'])
+            })
+
+        record_ids = [result['record_id'] for result in results if result]
+        for start in range(0, len(record_ids), 500):
+            batch = record_ids[start:start + 500]
+            conn.execute(f'''
+                UPDATE borrow_records SET return_date = ?
+                WHERE id IN ({', '.join('?' for _ in batch)})
+            ''', [return_date.isoformat(), *batch])
+        for book_id, copies in returned_copies.items():
+            _release_copies(conn, book_id, copies, return_date, hold_expires_at)
+        conn.commit()
+        for book_id in returned_copies:
+            _invalidate_book(book_id)
+        return results
+    except sqlite3.Error:
+        conn.rollback()
+        return None
+    finally:
+        conn.close()
+
+def place_hold_transaction(patron_id: str, book_id: int, now: datetime) -> Tuple[str, Optional[Dict]]:
+    """
+    Join the queue for a book with no copies on the shelf.
+
+    Returns:
+        tuple: (status, hold) where status is one of 'success', 'not_found',
+        'available' (a copy can be borrowed right away), 'borrowed' (the
+        patron already has the book), 'duplicate' (the patron already holds
+        it) or 'error', and hold has hold_id, title and position (1 = next
+        in line)
+    """
+    conn = get_db_connection()
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        book = conn.execute('SELECT title, available_copies FROM books WHERE id = ?', (book_id,)).fetchone()
+        if not book:
+            conn.rollback()
+            return 'not_found', None
+        if book['available_copies'] > 0:
+            conn.rollback()
+            return 'available', None
+        if conn.execute('''
+            SELECT 1 FROM borrow_records WHERE patron_id = ? AND book_id = ? AND return_date IS NULL
+        ''', (patron_id, book_id)).fetchone():
+            conn.rollback()
+            return 'borrowed', None
+        if conn.execute('''
+            SELECT 1 FROM holds WHERE patron_id = ? AND book_id = ? AND status IN ('waiting', 'ready')
+        ''', (patron_id, book_id)).fetchone():
+            conn.rollback()
+            return 'duplicate', None
+
+        hold_id = conn.execute('''
+            INSERT INTO holds (patron_id, book_id, status, created_at, updated_at)
+            VALUES (?, ?, 'waiting', ?, ?)
+        ''', (patron_id, book_id, now.isoformat(), now.isoformat())).lastrowid
+        position = conn.execute('''
+            SELECT COUNT(*) FROM holds WHERE book_id = ? AND status = 'waiting'
+        ''', (book_id,)).fetchone()[0]
+        conn.commit()
+        return 'success', {'hold_id': hold_id, 'title': book['title'], 'position': position}
+    except sqlite3.Error:
+        conn.rollback()
+        return 'error', None
+    finally:
+        conn.close()
+
+def cancel_hold_transaction(patron_id: str, hold_id: int, now: datetime,
+                            hold_expires_at: datetime) -> str:
+    """
+    Cancel a patron's waiting or ready hold. A copy set aside for a ready
+    hold passes to the next hold in line (ready until hold_expires_at) or
+    back to the shelf.
+
+    Returns:
+        str: 'success', 'not_found' or 'error'
+    """
+    conn = get_db_connection()
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        hold = conn.execute('''
+            SELECT book_id, status FROM holds
+            WHERE id = ? AND patron_id = ? AND status IN ('waiting', 'ready')
+        ''', (hold_id, patron_id)).fetchone()
+        if not hold:
+            conn.rollback()
+            return 'not_found'
+        conn.execute("UPDATE holds SET status = 'cancelled', updated_at = ? WHERE id = ?",
+                     (now.isoformat(), hold_id))
+        if hold['status'] == 'ready':
+            _release_copies(conn, hold['book_id'], 1, now, hold_expires_at)
+        conn.commit()
+        _invalidate_book(hold['book_id'])
+        return 'success'
+    except sqlite3.Error:
+        conn.rollback()
+        return 'error'
+    finally:
+        conn.close()
+
+def expire_ready_holds(now: datetime, hold_expires_at: datetime) -> Optional[int]:
+    """
+    Expire ready holds whose pickup deadline has passed, passing each copy
+    on to the next hold in line (ready until hold_expires_at) or back to the
+    shelf, in one write transaction.
+
+    Returns:
+        Optional[int]: Number of holds expired, or None on a database error
+    """
+    conn = get_db_connection()
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        expired = conn.execute('''
+            SELECT id, book_id FROM holds WHERE status = 'ready' AND expires_at < ?
+            ORDER BY expires_at
+        ''', (now.isoformat(),)).fetchall()
+        for hold in expired:
+            conn.execute("UPDATE holds SET status = 'expired', updated_at = ? WHERE id = ?",
+                         (now.isoformat(), hold['id']))
+            _release_copies(conn, hold['book_id'], 1, now, hold_expires_at)
+        conn.commit()
+        for book_id in {hold['book_id'] for hold in expired}:
+            _invalidate_book(book_id)
+        return len(expired)
+    except sqlite3.Error:
+        conn.rollback()
+        return None
+    finally:
+        conn.close()
+
+def get_patron_holds(patron_id: str) -> List[Dict]:
+    """
+    Get a patron's holds, newest first, with the book title and, for
+    waiting holds, the position in the book's queue.
+    """
+    conn = get_db_connection()
+    try:
+        holds = conn.execute('''
+            SELECT h.id, h.book_id, b.title, h.status, h.created_at, h.ready_at, h.expires_at,
+                   CASE WHEN h.status = 'waiting' THEN (
+                       SELECT COUNT(*) FROM holds w
+                       WHERE w.book_id = h.book_id AND w.status = 'waiting'
+                         AND (w.created_at, w.id) <= (h.created_at, h.id)
+                   ) END AS position
+            FROM holds h
+            JOIN books b ON h.book_id = b.id
+            WHERE h.patron_id = ?
+            ORDER BY h.created_at DESC
+        ''', (patron_id,)).fetchall()
+    finally:
+        conn.close()
+    return [dict(hold) for hold in holds]
+
+def get_patron_notifications(patron_id: str, limit: int = 50) -> List[Dict]:
+    """Get a patron's most recent notifications."""
+    conn = get_db_connection()
+    try:
+        notifications = conn.execute('''
+            SELECT id, hold_id, kind, message, created_at, sent_at FROM notifications
+            WHERE patron_id = ? ORDER BY created_at DESC, id DESC LIMIT ?
+        ''', (patron_id, limit)).fetchall()
+    finally:
+        conn.close()
+    return [dict(notification) for notification in notifications]
+
+def enqueue_job(kind: str, payload: str, max_attempts: int, run_at: Optional[datetime] = None) -> Optional[int]:
+    """
+    Add a job to the queue.
+    
+    Returns:
+        Optional[int]: The new job ID, or None on a database error
+    """
+    now = datetime.now().isoformat()
+    conn = get_db_connection()
+    try:
+        job_id = conn.execute('''
+            INSERT INTO jobs (kind, payload, max_attempts, run_at, created_at, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', (kind, payload, max_attempts, (run_at.isoformat() if run_at else now), now, now)).lastrowid
+        conn.commit()
+        return job_id
+    except sqlite3.Error:
+        conn.rollback()
+        return None
+    finally:
+        conn.close()
+
+def claim_job(now: datetime) -> Optional[Dict]:
+    """
+    Take the oldest queued job that is due and mark it running.
+    
+    The select and the status change happen under one BEGIN IMMEDIATE lock,
+    so a job is handed to exactly one worker, across threads and processes.
+    
+    Returns:
+        Optional[Dict]: The claimed job (attempts already counts this run), or None
+    """
+    conn = get_db_connection()
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        job = conn.execute('''
+            SELECT id FROM jobs WHERE status = 'queued' AND run_at <= ?
+            ORDER BY run_at LIMIT 1
+        ''', (now.isoformat(),)).fetchone()
+        if not job:
+            conn.rollback()
+            return None
+        conn.execute('''
+            UPDATE jobs SET status = 'running', attempts = attempts + 1, updated_at = ?
+            WHERE id = ?
+        ''', (now.isoformat(), job['id']))
+        job = conn.execute('SELECT * FROM jobs WHERE id = ?', (job['id'],)).fetchone()
+        conn.commit()
+        return dict(job)
+    except sqlite3.Error:
+        conn.rollback()
+        return None
+    finally:
+        conn.close()
+
+def finish_job(job_id: int, status: str, result: Optional[str] = None, error: Optional[str] = None,
+               run_at: Optional[datetime] = None) -> bool:
+    """
+    Record the outcome of a job run: 'succeeded', 'failed' or 'dead', or
+    'queued' with a later run_at to retry it.
+    """
+    now = datetime.now().isoformat()
+    conn = get_db_connection()
+    try:
+        conn.execute('''
+            UPDATE jobs SET status = ?, result = COALESCE(?, result), last_error = ?,
+                            run_at = COALESCE(?, run_at), updated_at = ?
+            WHERE id = ?
+        ''', (status, result, error, run_at.isoformat() if run_at else None, now, job_id))
+        conn.commit()
+        return True
+    except sqlite3.Error:
+        conn.rollback()
+        return False
+    finally:
+        conn.close()
+
+def get_job(job_id: int) -> Optional[Dict]:
+    """Get a job by ID."""
+    conn = get_db_connection()
+    try:
+        job = conn.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+    finally:
+        conn.close()
+    return dict(job) if job else None
+
+def get_jobs_by_status(status: str, limit: int = 100) -> List[Dict]:
+    """Get the most recently updated jobs with the given status."""
+    conn = get_db_connection()
+    try:
+        jobs = conn.execute('''
+            SELECT * FROM jobs WHERE status = ? ORDER BY updated_at DESC LIMIT ?
+        ''', (status, limit)).fetchall()
+    finally:
+        conn.close()
+    return [dict(job) for job in jobs]
+
+def requeue_jobs(status: str, updated_before: Optional[datetime] = None) -> int:
+    """
+    Put jobs with the given status back on the queue, due now: 'running' jobs
+    whose worker died (not updated since `updated_before`), or 'dead' jobs
+    that should get another round of attempts.
+    
+    Returns:
+        int: Number of jobs requeued
+    """
+    now = datetime.now().isoformat()
+    conn = get_db_connection()
+    try:
+        count = conn.execute('''
+            UPDATE jobs
+            SET status = 'queued', run_at = ?, updated_at = ?,
+                max_attempts = CASE WHEN status = 'dead' THEN attempts + max_attempts ELSE max_attempts END
+            WHERE status = ? AND updated_at < ?
+        ''', (now, now, status, (updated_before.isoformat() if updated_before else '9999'))).rowcount
+        conn.commit()
+        return count
+    except sqlite3.Error:
+        conn.rollback()
+        return 0
+    finally:
+        conn.close()
@@ -0,0 +1,62 @@
+"""
+Gunicorn settings for serving wsgi:app
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+
+Worker processes and threads per worker are read from the environment. The
+app is preloaded in the master, which initialises the database once; each
+worker then opens its own connections and starts its own job threads.
+kill -HUP <master> replaces the workers gracefully (in-flight requests finish
+first) and rereads these settings; as the app is preloaded, new code needs a
+restart, or kill -USR2 followed by kill -QUIT of the old master.
+
+Each worker writes its metrics to LIBRARY_METRICS_DIR (by default a directory
+under the temp dir named after the master's pid) and /metrics merges them, so
+a scrape covers the whole server whichever worker answers it. Counters of
+workers that have exited are kept until the master exits.
+"""
+
+import os
+import tempfile
+
+bind = os.environ.get('LIBRARY_BIND', '0.0.0.0:5000')
+workers = int(os.environ.get('LIBRARY_WEB_WORKERS', (os.cpu_count() or 1) * 2 + 1))
+# More than one thread runs the gthread worker; keep it at or below LIBRARY_DB_POOL_SIZE
+threads = int(os.environ.get('LIBRARY_WEB_THREADS', 4))
+timeout = int(os.environ.get('LIBRARY_WEB_TIMEOUT', 30))                 # seconds before a silent worker is killed
+graceful_timeout = int(os.environ.get('LIBRARY_WEB_GRACEFUL_TIMEOUT', 30))  # seconds stopping workers get to finish
+max_requests = int(os.environ.get('LIBRARY_WEB_MAX_REQUESTS', 0))          # recycle a worker after this many; 0 never
+max_requests_jitter = max_requests // 10
+preload_app = True
+accesslog = '-'
+
+os.environ.setdefault('LIBRARY_METRICS_DIR',
+                      os.path.join(tempfile.gettempdir(), f'library-metrics-{os.getpid()}'))
+
+
+def when_ready(server):
+    # Counters start from zero with the server (runs once bound, before the first fork)
+    import instrumentation
+    instrumentation.clear_metrics_dir()
+
+def post_worker_init(worker):
+    # Runs in each worker after the app is loaded and before it serves requests
+    import wsgi
+    wsgi.init_worker()
+
+def worker_exit(server, worker):
+    import wsgi
+    wsgi.shutdown_worker()
+
+def child_exit(server, worker):
+    # Runs in the master for every worker that exits, killed ones included
+    import instrumentation
+    instrumentation.mark_process_dead(worker.pid)
+
+def on_exit(server):
+    import instrumentation
+    instrumentation.clear_metrics_dir()
+    try:
+        os.rmdir(instrumentation.METRICS_DIR)
+    except OSError:
+        pass  # not empty: something else lives there
@@ -0,0 +1,442 @@
+"""
+Instrumentation module for Library Management System
+Opt-in request metrics: per-route latency histograms, SQL query count and time
+per request, and cProfile dumps of sampled slow requests, rendered in the
+Prometheus text format by the /metrics endpoint. Under a multi-process server
+each process writes its metrics to a shared directory and /metrics merges them
+"""
+
+import bisect
+import cProfile
+import glob
+import json
+import os
+import random
+import re
+import threading
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from flask import Flask, current_app, g, request
+
+import database
+from query_trace import start_trace, stop_trace
+from services.payment_service import CircuitBreaker, get_gateway_stats
+
+# Off unless LIBRARY_INSTRUMENTATION is set (or INSTRUMENTATION is passed to
+# create_app); when off no request hooks or query listeners are installed.
+INSTRUMENTATION_ENABLED = os.environ.get('LIBRARY_INSTRUMENTATION', '').lower() in ('1', 'true', 'yes')
+SLOW_REQUEST_SECONDS = float(os.environ.get('LIBRARY_SLOW_REQUEST_SECONDS', 0.5))
+PROFILE_SAMPLE_RATE = float(os.environ.get('LIBRARY_PROFILE_SAMPLE_RATE', 0.0))  # fraction of requests run under cProfile
+PROFILE_DIR = os.environ.get('LIBRARY_PROFILE_DIR', 'profiles')  # where slow sampled requests are dumped
+# Directory shared by the worker processes of one server (gunicorn.conf.py sets
+# it). Each process writes its metrics there every METRICS_FLUSH_INTERVAL
+# seconds and when it exits, and /metrics merges them: counters and histograms
+# are summed over every process the server has run, gauges are reported per
+# live process with a pid label. Unset, /metrics serves this process only.
+METRICS_DIR = os.environ.get('LIBRARY_METRICS_DIR')
+METRICS_FLUSH_INTERVAL = float(os.environ.get('LIBRARY_METRICS_FLUSH_INTERVAL', 5.0))
+
+# Upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Upper bounds of the per-request SQL query count histogram buckets
+QUERY_COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200)
+
+# A metric family: (name, type, help, [(sample name, labels, value), ...])
+Family = Tuple[str, str, str, List[Tuple[str, Dict[str, str], float]]]
+
+
+class Histogram:
+    """Thread-safe Prometheus-style histogram with fixed bucket bounds."""
+
+    def __init__(self, buckets: Iterable[float]):
+        self.buckets = tuple(sorted(buckets))
+        self._counts = [0] * (len(self.buckets) + 1)  # last slot is +Inf
+        self._sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        """Record one observation."""
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+
+    def snapshot(self) -> Tuple[List[Tuple[float, int]], int, float]:
+        """
+        Returns:
+            tuple: ([(upper_bound, cumulative_count), ...] ending with +Inf,
+            total count, sum of the observations)
+        """
+        with self._lock:
+            counts, total = list(self._counts), self._sum
+        cumulative, running = [], 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            running += count
+            cumulative.append((bound, running))
+        return cumulative, running, total
+
+
+class RequestMetrics:
+    """
+    Per-route request metrics: a latency histogram, request counts by
+    status, SQL query count and time, and counts of slow requests and of
+    requests that repeated a query.
+
+    Routes are labelled by their URL rule ('/api/holds/<int:hold_id>'), not
+    the requested path, so the number of series stays bounded.
+    """
+
+    def __init__(self, latency_buckets: Iterable[float] = LATENCY_BUCKETS,
+                 query_buckets: Iterable[float] = QUERY_COUNT_BUCKETS):
+        self.latency_buckets = tuple(latency_buckets)
+        self.query_buckets = tuple(query_buckets)
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Drop every recorded observation."""
+        with self._lock:
+            self._latency: Dict[Tuple[str, str], Histogram] = {}
+            self._queries: Dict[Tuple[str, str], Histogram] = {}
+            self._responses: Dict[Tuple[str, str, int], int] = {}
+            self._sql_seconds: Dict[Tuple[str, str], float] = {}
+            self._slow: Dict[Tuple[str, str], int] = {}
+            self._repeated: Dict[Tuple[str, str], int] = {}
+            self.profiles_written = 0
+
+    def _histograms(self, key: Tuple[str, str]) -> Tuple[Histogram, Histogram]:
+        with self._lock:
+            latency = self._latency.get(key)
+            if latency is None:
+                latency = self._latency[key] = Histogram(self.latency_buckets)
+                self._queries[key] = Histogram(self.query_buckets)
+            return latency, self._queries[key]
+
+    def record(self, method: str, route: str, status: int, seconds: float,
+               queries: int, sql_seconds: float, slow: bool, repeated_queries: bool = False):
+        """Record one finished request."""
+        key = (method, route)
+        latency, query_counts = self._histograms(key)
+        latency.observe(seconds)
+        query_counts.observe(queries)
+        with self._lock:
+            self._responses[key + (status,)] = self._responses.get(key + (status,), 0) + 1
+            self._sql_seconds[key] = self._sql_seconds.get(key, 0.0) + sql_seconds
+            if slow:
+                self._slow[key] = self._slow.get(key, 0) + 1
+            if repeated_queries:
+                self._repeated[key] = self._repeated.get(key, 0) + 1
+
+    def record_profile(self):
+        """Count one cProfile dump written for a slow request."""
+        with self._lock:
+            self.profiles_written += 1
+
+    def collect(self) -> List[Family]:
+        """Collect the request metrics as metric families."""
+        with self._lock:
+            latency = dict(self._latency)
+            queries = dict(self._queries)
+            responses = dict(self._responses)
+            sql_seconds = dict(self._sql_seconds)
+            slow = dict(self._slow)
+            repeated = dict(self._repeated)
+            profiles_written = self.profiles_written
+
+        families = []
+        _family(families, 'library_http_requests_total', 'counter', "Requests handled, by route and status.",
+                [({'method': m, 'route': r, 'status': str(s)}, n) for (m, r, s), n in sorted(responses.items())])
+        _histogram_family(families, 'library_http_request_duration_seconds',
+                          "Time spent handling a request, by route.", latency)
+        _histogram_family(families, 'library_http_request_sql_queries',
+                          "SQL statements executed per request, by route.", queries)
+        _family(families, 'library_http_request_sql_seconds_total', 'counter',
+                "Time spent executing SQL statements, by route.",
+                [({'method': m, 'route': r}, v) for (m, r), v in sorted(sql_seconds.items())])
+        _family(families, 'library_http_slow_requests_total', 'counter',
+                f"Requests slower than {SLOW_REQUEST_SECONDS}s, by route.",
+                [({'method': m, 'route': r}, n) for (m, r), n in sorted(slow.items())])
+        _family(families, 'library_http_repeated_query_requests_total', 'counter',
+                "Requests that ran the same SQL statement more than once (possible N+1), by route.",
+                [({'method': m, 'route': r}, n) for (m, r), n in sorted(repeated.items())])
+        _family(families, 'library_profiles_written_total', 'counter',
+                "cProfile dumps written for sampled slow requests.", [({}, profiles_written)])
+        return families
+
+
+metrics = RequestMetrics()
+
+# Only one request is profiled at a time, which also bounds the overhead
+_profile_lock = threading.Lock()
+
+
+def _route() -> str:
+    return request.url_rule.rule if request.url_rule is not None else '<unmatched>'
+
+def _before_request():
+    g.instrumentation_trace = start_trace(f"{request.method} {request.path}")
+    g.instrumentation_profiler = None
+    if PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE \
+            and _profile_lock.acquire(blocking=False):
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+            g.instrumentation_profiler = profiler
+        except ValueError:  # another profiler is active in this thread
+            _profile_lock.release()
+    g.instrumentation_start = time.perf_counter()
+
+def _after_request(response):
+    g.instrumentation_status = response.status_code
+    return response
+
+def _teardown_request(exc):
+    start = g.pop('instrumentation_start', None)
+    if start is None:
+        return
+    seconds = time.perf_counter() - start
+    profiler = g.pop('instrumentation_profiler', None)
+    if profiler is not None:
+        profiler.disable()
+        _profile_lock.release()
+    trace = stop_trace(g.pop('instrumentation_trace'))
+    route = _route()
+    slow = seconds >= SLOW_REQUEST_SECONDS
+
+    if profiler is not None and slow:
+        _dump_profile(profiler, route, seconds)
+    repeated = trace.repeated()
+    if repeated:
+        current_app.logger.warning("Repeated queries (possible N+1):\n%s", trace.report())
+
+    status = g.pop('instrumentation_status', 500 if exc is not None else 200)
+    metrics.record(request.method, route, status, seconds, trace.count, trace.seconds, slow, bool(repeated))
+
+def _dump_profile(profiler: cProfile.Profile, route: str, seconds: float) -> Optional[str]:
+    name = re.sub(r'[^A-Za-z0-9_.-]+', '_', route).strip('_') or 'root'
+    path = os.path.join(PROFILE_DIR, f"{name}-{time.strftime('%Y%m%d-%H%M%S')}-{int(seconds * 1000)}ms.prof")
+    try:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        profiler.dump_stats(path)
+    except OSError:
+        return None
+    metrics.record_profile()
+    return path
+
+def init_instrumentation(app: Flask):
+    """
+    Install the request hooks on an app. Each request's SQL statements are
+    recorded with query_trace; a request that repeats a statement (other
+    than the chunks of a paginated read) is logged as a warning with the
+    full trace.
+
+    Requests are timed from before_request to teardown. A response streamed
+    with stream_with_context keeps its request open until the body is fully
+    sent, so its duration and queries cover the whole stream. A
+    PROFILE_SAMPLE_RATE fraction of requests runs under cProfile, and
+    those that take SLOW_REQUEST_SECONDS or longer are dumped to
+    PROFILE_DIR as <route>-<time>-<ms>ms.prof (open with pstats or snakeviz).
+    """
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    app.teardown_request(_teardown_request)
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+def _sample(name: str, labels: Dict[str, str], value: float) -> str:
+    if labels:
+        label_text = ','.join(f'{key}="{_escape(str(val))}"' for key, val in labels.items())
+        return f"{name}{{{label_text}}} {_format_value(value)}"
+    return f"{name} {_format_value(value)}"
+
+def _family(families: List[Family], name: str, kind: str, help_text: str,
+            samples: Iterable[Tuple[Dict[str, str], float]]):
+    families.append((name, kind, help_text, [(name, labels, value) for labels, value in samples]))
+
+def _histogram_family(families: List[Family], name: str, help_text: str,
+                      histograms: Dict[Tuple[str, str], Histogram]):
+    samples = []
+    for (method, route), histogram in sorted(histograms.items()):
+        buckets, count, total = histogram.snapshot()
+        labels = {'method': method, 'route': route}
+        for bound, cumulative in buckets:
+            samples.append((f"{name}_bucket", dict(labels, le=_format_value(bound)), cumulative))
+        samples.append((f"{name}_sum", labels, total))
+        samples.append((f"{name}_count", labels, count))
+    families.append((name, 'histogram', help_text, samples))
+
+def _stats_families(families: List[Family], prefix: str, what: str, stats: Dict, gauges: Iterable[str]):
+    """Collect the numeric entries of a stats() dict: `gauges` as gauges, the rest as counters."""
+    for key, value in stats.items():
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            continue
+        if key in gauges:
+            _family(families, f"{prefix}_{key}", 'gauge', f"{what}: {key}.", [({}, value)])
+        else:
+            _family(families, f"{prefix}_{key}_total", 'counter', f"{what}: {key}.", [({}, value)])
+
+def _render(families: Iterable[Family]) -> str:
+    lines = []
+    for name, kind, help_text, samples in families:
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        lines.extend(_sample(sample_name, labels, value) for sample_name, labels, value in samples)
+    return '\n'.join(lines) + '\n'
+
+def collect_metrics() -> List[Family]:
+    """
+    Collect this process's metrics: the request metrics (when
+    instrumentation is enabled) plus the database pool, book cache and
+    payment gateway counters, which are always kept.
+    """
+    families = metrics.collect()
+    _stats_families(families, 'library_db_pool', "Database connection pool",
+                    database.get_pool_stats(), ('size', 'open', 'in_use', 'idle', 'high_water'))
+    _stats_families(families, 'library_book_cache', "Book cache",
+                    database.get_book_cache_stats(), ('size', 'maxsize', 'ttl'))
+
+    gateway = get_gateway_stats()
+    circuit = gateway.pop('circuit')
+    _family(families, 'library_payment_circuit_state', 'gauge',
+            "Payment gateway circuit breaker state (1 = current).",
+            [({'state': state}, int(circuit['state'] == state))
+             for state in (CircuitBreaker.CLOSED, CircuitBreaker.OPEN, CircuitBreaker.HALF_OPEN)])
+    _stats_families(families, 'library_payment_circuit', "Payment gateway circuit breaker",
+                    circuit, ('consecutive_failures', 'failure_threshold', 'reset_timeout'))
+    _stats_families(families, 'library_payment_status_cache', "Payment status cache",
+                    gateway.pop('status_cache'), ('size', 'maxsize', 'ttl'))
+    _stats_families(families, 'library_payment_gateway', "Payment gateway status lookups", gateway, ())
+    return families
+
+def render_metrics() -> str:
+    """
+    Render the metrics in the Prometheus text exposition format: this
+    process's, or with METRICS_DIR set, those of every process of the server.
+    """
+    if METRICS_DIR:
+        write_process_metrics()
+        return _render(merge_process_metrics())
+    return _render(collect_metrics())
+
+
+# Serializes this process's writes of its metrics file
+_write_lock = threading.Lock()
+# Identifies each process's snapshots, so they are not mistaken for those of
+# an exited process that had the same pid
+_snapshot_ids: Dict[int, str] = {}
+
+# Counters of exited processes, folded into one file so the directory does not
+# grow as workers are recycled
+DEAD_METRICS_FILE = 'dead.json'
+
+def _read_snapshot(path: str) -> Optional[Dict]:
+    try:
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None  # not written yet, or just marked dead
+
+def _write_snapshot(path: str, snapshot: Dict):
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(snapshot, f)
+    os.replace(path + '.tmp', path)  # readers never see a half-written file
+
+def _merge(snapshots: Iterable[Dict], gauges: bool = True) -> List[Family]:
+    """Sum the samples of `snapshots`; gauges are kept apart by a pid label, or dropped."""
+    merged: Dict[str, Tuple[str, str, Dict]] = {}
+    for snapshot in snapshots:
+        for name, kind, help_text, samples in snapshot['families']:
+            if kind == 'gauge' and not gauges:
+                continue
+            family_samples = merged.setdefault(name, (kind, help_text, {}))[2]
+            for sample_name, labels, value in samples:
+                if kind == 'gauge':
+                    labels = dict(labels, pid=str(snapshot['pid']))
+                key = (sample_name, tuple(sorted(labels.items())))
+                if key in family_samples:
+                    family_samples[key][2] += value
+                else:
+                    family_samples[key] = [sample_name, labels, value]
+    return [(name, kind, help_text, [tuple(sample) for sample in samples.values()])
+            for name, (kind, help_text, samples) in merged.items()]
+
+def write_process_metrics(directory: Optional[str] = None, pid: Optional[int] = None):
+    """Write this process's metrics to <directory>/<pid>.json (default METRICS_DIR)."""
+    directory = directory or METRICS_DIR
+    pid = pid or os.getpid()
+    snapshot_id = _snapshot_ids.setdefault(pid, f'{pid}-{time.time_ns()}')
+    snapshot = {'id': snapshot_id, 'pid': pid, 'families': collect_metrics()}
+    with _write_lock:
+        _write_snapshot(os.path.join(directory, f'{pid}.json'), snapshot)
+
+def mark_process_dead(pid: int, directory: Optional[str] = None):
+    """
+    Fold an exited process's counters into the dead processes' file and
+    drop its gauges. Only the server's master process should call this.
+    """
+    directory = directory or METRICS_DIR
+    path = os.path.join(directory, f'{pid}.json')
+    snapshot = _read_snapshot(path)
+    if snapshot is None:
+        return
+    dead_path = os.path.join(directory, DEAD_METRICS_FILE)
+    dead = _read_snapshot(dead_path) or {'merged': [], 'families': []}
+    # Written before the process's own file is removed: readers skip that file
+    # once its id is listed here, so its counters are never counted twice or lost
+    _write_snapshot(dead_path, {'merged': dead['merged'] + [snapshot['id']],
+                                'families': _merge([dead, snapshot], gauges=False)})
+    os.remove(path)
+
+def merge_process_metrics(directory: Optional[str] = None) -> List[Family]:
+    """Merge the metrics files in `directory` (default METRICS_DIR) into one set of families."""
+    directory = directory or METRICS_DIR
+    # Live files first: any removed before we get to them are already in the dead file
+    live = [_read_snapshot(path) for path in sorted(glob.glob(os.path.join(directory, '[0-9]*.json')))]
+    dead = _read_snapshot(os.path.join(directory, DEAD_METRICS_FILE)) or {'merged': [], 'families': []}
+    merged_ids = set(dead['merged'])
+    live = [snapshot for snapshot in live if snapshot is not None and snapshot['id'] not in merged_ids]
+    return _merge(live + [dead])  # the dead file holds no gauges
+
+def clear_metrics_dir(directory: Optional[str] = None):
+    """Create `directory` (default METRICS_DIR) if needed and delete any metrics files in it."""
+    directory = directory or METRICS_DIR
+    os.makedirs(directory, exist_ok=True)
+    for path in glob.glob(os.path.join(directory, '*.json')) + glob.glob(os.path.join(directory, '*.json.tmp')):
+        os.remove(path)
+
+
+_writer: Optional[threading.Thread] = None
+_writer_stop = threading.Event()
+
+def _write_periodically(interval: float):
+    while not _writer_stop.wait(interval):
+        try:
+            write_process_metrics()
+        except OSError:
+            pass  # try again next interval
+
+def start_metrics_writer(interval: float = METRICS_FLUSH_INTERVAL):
+    """Write this process's metrics to METRICS_DIR every `interval` seconds (if set; once per process)."""
+    global _writer
+    if METRICS_DIR and _writer is None:
+        _writer_stop.clear()
+        _writer = threading.Thread(target=_write_periodically, args=(interval,),
+                                   name='metrics-writer', daemon=True)
+        _writer.start()
+
+def stop_metrics_writer():
+    """Stop the periodic writes and write this process's final metrics."""
+    global _writer
+    if _writer is not None:
+        _writer_stop.set()
+        _writer.join()
+        _writer = None
+        write_process_metrics()
@@ -0,0 +1,218 @@
+"""
+Query tracing module for Library Management System
+Records the SQL statements run through database.py (statement, parameter shape,
+duration and calling code), flags statements repeated within one request or
+service call, and enforces per-function query budgets in tests
+"""
+
+import functools
+import os
+import re
+import sys
+import threading
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+import database
+
+# A statement run this many times in one trace is reported as repeated (the
+# usual sign of a helper being called in a loop, i.e. an N+1 query pattern).
+REPEATED_QUERY_THRESHOLD = int(os.environ.get('LIBRARY_REPEATED_QUERY_THRESHOLD', 2))
+# When on, functions decorated with @query_budget fail with QueryBudgetExceeded
+# if they run more statements than declared, or repeat a statement. The test
+# suite turns this on in conftest.py; otherwise the decorator only costs one
+# flag check per call.
+ENFORCE_QUERY_BUDGETS = os.environ.get('LIBRARY_ENFORCE_QUERY_BUDGETS', '').lower() in ('1', 'true', 'yes')
+
+_MODULE_FILES = {os.path.abspath(database.__file__), os.path.abspath(__file__)}
+
+
+class TracedQuery(NamedTuple):
+    sql: str            # statement with whitespace collapsed
+    shape: str          # parameter types, e.g. '(str, int)'; values are never kept
+    seconds: float
+    helper: str         # database.py function that ran it
+    caller: str         # first frame outside database.py, 'file.py:line function'
+    chunked: bool = False  # one chunk of a paginated read (see chunked_reads)
+
+
+class QueryTrace:
+    """The statements run while a trace_queries() block was active."""
+
+    def __init__(self, name: str = ''):
+        self.name = name
+        self.queries: List[TracedQuery] = []
+
+    @property
+    def count(self) -> int:
+        return len(self.queries)
+
+    @property
+    def seconds(self) -> float:
+        return sum(query.seconds for query in self.queries)
+
+    def repeated(self, threshold: Optional[int] = None) -> List[Dict]:
+        """
+        Statements run at least `threshold` times (default
+        REPEATED_QUERY_THRESHOLD), most repeated first. Chunks of a
+        paginated read are expected to repeat and are left out.
+
+        Returns:
+            list: dicts with sql, count, seconds and the distinct callers
+        """
+        threshold = REPEATED_QUERY_THRESHOLD if threshold is None else threshold
+        groups: Dict[str, List[TracedQuery]] = {}
+        for query in self.queries:
+            if not query.chunked:
+                groups.setdefault(query.sql, []).append(query)
+        repeated = [{
+            'sql': sql,
+            'count': len(queries),
+            'seconds': sum(query.seconds for query in queries),
+            'callers': sorted({query.caller for query in queries}),
+        } for sql, queries in groups.items() if len(queries) >= threshold]
+        return sorted(repeated, key=lambda group: -group['count'])
+
+    def report(self) -> str:
+        """Human-readable listing of the traced statements, for failure messages and logs."""
+        lines = [f"{self.count} queries in {self.seconds * 1000:.1f} ms{' for ' + self.name if self.name else ''}:"]
+        for number, query in enumerate(self.queries, 1):
+            lines.append(f"  {number}. [{query.seconds * 1000:.2f} ms] {query.sql} {query.shape}"
+                         f"  -- {query.helper} <- {query.caller}{' (chunk)' if query.chunked else ''}")
+        for group in self.repeated():
+            lines.append(f"  repeated {group['count']}x from {', '.join(group['callers'])}: {group['sql']}")
+        return '\n'.join(lines)
+
+
+class QueryBudgetExceeded(AssertionError):
+    """Raised (when budgets are enforced) by a function that ran too many or repeated queries."""
+
+
+# Traces active in the current thread, innermost last; every statement is
+# recorded in all of them, so nested service calls each see their own queries.
+_local = threading.local()
+# Number of active traces in all threads; the database listener is only
+# installed while it is non-zero.
+_active = 0
+_active_lock = threading.Lock()
+
+
+def _shape(parameters) -> str:
+    if isinstance(parameters, dict):
+        return '{' + ', '.join(sorted(parameters)) + '}'
+    if isinstance(parameters, (list, tuple)):
+        if parameters and isinstance(parameters[0], (list, tuple, dict)):
+            return f"{len(parameters)} x {_shape(parameters[0])}"
+        return '(' + ', '.join(type(value).__name__ for value in parameters) + ')'
+    return '(...)'
+
+def _origin(frame) -> Tuple[str, str]:
+    helper = '?'
+    while frame is not None:
+        filename = os.path.abspath(frame.f_code.co_filename)
+        if filename not in _MODULE_FILES:
+            return helper, f"{os.path.basename(filename)}:{frame.f_lineno} {frame.f_code.co_name}"
+        if filename != os.path.abspath(__file__):
+            helper = frame.f_code.co_name
+        frame = frame.f_back
+    return helper, '?'
+
+def _record_query(sql: str, parameters, seconds: float):
+    traces = getattr(_local, 'traces', None)
+    if not traces:
+        return
+    helper, caller = _origin(sys._getframe(1))
+    query = TracedQuery(re.sub(r'\s+', ' ', sql).strip(), _shape(parameters), seconds, helper, caller,
+                        getattr(_local, 'chunked', 0) > 0)
+    for trace in traces:
+        trace.queries.append(query)
+
+def start_trace(name: str = '') -> QueryTrace:
+    """Start recording the current thread's statements; pair with stop_trace()."""
+    global _active
+    trace = QueryTrace(name)
+    with _active_lock:
+        _active += 1
+        if _active == 1:
+            database.add_query_listener(_record_query)
+    _local.__dict__.setdefault('traces', []).append(trace)
+    return trace
+
+def stop_trace(trace: QueryTrace) -> QueryTrace:
+    """Stop recording into a trace started with start_trace()."""
+    global _active
+    _local.traces.remove(trace)
+    with _active_lock:
+        _active -= 1
+        if _active == 0:
+            database.remove_query_listener(_record_query)
+    return trace
+
+@contextmanager
+def chunked_reads() -> Iterator[None]:
+    """
+    Mark the statements run in this block as one chunk of a paginated read
+    (the same query once per chunk, by design), so traces do not report
+    them as repeated.
+
+    Usage:
+        while True:
+            with chunked_reads():
+                chunk = get_overdue_loans(today, chunk_size, after)
+    """
+    _local.chunked = getattr(_local, 'chunked', 0) + 1
+    try:
+        yield
+    finally:
+        _local.chunked -= 1
+
+@contextmanager
+def trace_queries(name: str = '') -> Iterator[QueryTrace]:
+    """
+    Record every statement the current thread runs through database.py
+    while the block is active.
+
+    Usage:
+        with trace_queries('status report') as trace:
+            get_patron_status_report('123456')
+        print(trace.report())
+    """
+    trace = start_trace(name)
+    try:
+        yield trace
+    finally:
+        stop_trace(trace)
+
+def query_budget(max_queries: int, allow_repeats: bool = False) -> Callable:
+    """
+    Declare how many statements a service function may run per call.
+
+    With ENFORCE_QUERY_BUDGETS on, every call is traced and raises
+    QueryBudgetExceeded (listing the statements and their callers) if it
+    ran more than max_queries statements, or repeated one without
+    allow_repeats. The budget is kept as the function's `query_budget`
+    attribute.
+    """
+    def decorator(func: Callable) -> Callable:
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not ENFORCE_QUERY_BUDGETS:
+                return func(*args, **kwargs)
+            with trace_queries(func.__qualname__) as trace:
+                result = func(*args, **kwargs)
+            if trace.count > max_queries:
+                raise QueryBudgetExceeded(
+                    f"{func.__qualname__} ran {trace.count} queries, over its budget of {max_queries}.\n"
+                    + trace.report())
+            if not allow_repeats and trace.repeated():
+                raise QueryBudgetExceeded(
+                    f"{func.__qualname__} repeated a query (possible N+1).\n" + trace.report())
+            return result
+        wrapper.query_budget = max_queries
+        return wrapper
+    return decorator
+
+def enforce_query_budgets(enabled: bool = True):
+    """Turn query budget enforcement on or off for the whole process."""
+    global ENFORCE_QUERY_BUDGETS
+    ENFORCE_QUERY_BUDGETS = enabled
@@ -2,8 +2,16 @@
 API Routes - JSON API endpoints
 """
 
-from flask import Blueprint, jsonify, request
-from services.library_service import calculate_late_fee_for_book, search_books_in_catalog
+import json
+
+from flask import Blueprint, Response, jsonify, request, stream_with_context, url_for
+from services.library_service import (
+    calculate_late_fee_for_book, calculate_late_fees_batch, search_books_in_catalog,
+    get_catalog_page, get_payment_status, sweep_overdue_loans, return_books_by_patrons,
+    place_hold, cancel_hold, get_patron_holds_and_notifications,
+    SEARCH_RESULT_LIMIT, CATALOG_PAGE_SIZE, MAX_RETURN_BATCH_SIZE, MAX_LATE_FEE_BATCH_SIZE
+)
+from services.job_queue import submit_job, get_job_status
 
 api_bp = Blueprint('api', __name__, url_prefix='/api')
 
@@ -16,6 +24,107 @@ def get_late_fee(patron_id, book_id):
     result = calculate_late_fee_for_book(patron_id, book_id)
     return jsonify(result), 501 if 'not implemented' in result.get('status', '') else 200
 
+@api_bp.route('/late_fees', methods=['POST'])
+def get_late_fees_batch():
+    """
+    Calculate late fees for many loans in one call.
+    Batch API for R5: Late Fee Calculation
+    
+    Body: {"loans": [{"patron_id": "123456", "book_id": 1}, ...]}
+    (at most MAX_LATE_FEE_BATCH_SIZE) or {"all": true} for every active loan; add "overdue_only": true to
+    leave out loans with no fee.
+    """
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({'error': 'JSON body is required'}), 400
+    
+    overdue_only = bool(data.get('overdue_only', False))
+    if data.get('all'):
+        loans = None
+    else:
+        items = data.get('loans')
+        if not isinstance(items, list) or not all(isinstance(item, dict) for item in items):
+            return jsonify({'error': 'loans must be a list of {patron_id, book_id} objects'}), 400
+        if len(items) > MAX_LATE_FEE_BATCH_SIZE:
+            return jsonify({'error': f'At most {MAX_LATE_FEE_BATCH_SIZE} loans per request'}), 400
+        # Non-integer book IDs (booleans included) come back as invalid pairs
+        loans = [(str(item.get('patron_id', '')),
+                  item.get('book_id') if isinstance(item.get('book_id'), int)
+                  and not isinstance(item.get('book_id'), bool) else 0)
+                 for item in items]
+    
+    results = calculate_late_fees_batch(loans, overdue_only)
+    
+    return jsonify({
+        'results': results,
+        'count': len(results),
+        'total_fee_amount': round(sum(result['fee_amount'] for result in results), 2)
+    })
+
+@api_bp.route('/returns', methods=['POST'])
+def check_in_returns():
+    """
+    Check in many returned books in one transaction.
+    Batch API for R4: Book Return Processing
+    
+    Body: {"items": [{"patron_id": "123456", "book_id": 1}, ...]}
+    Each item gets its own status and late fee; a bad item does not stop
+    the others from being returned.
+    """
+    data = request.get_json(silent=True)
+    items = data.get('items') if isinstance(data, dict) else None
+    if not isinstance(items, list) or not all(isinstance(item, dict) for item in items):
+        return jsonify({'error': 'items must be a list of {patron_id, book_id} objects'}), 400
+    if len(items) > MAX_RETURN_BATCH_SIZE:
+        return jsonify({'error': f'At most {MAX_RETURN_BATCH_SIZE} items per request'}), 400
+    
+    report = return_books_by_patrons([(item.get('patron_id'), item.get('book_id')) for item in items])
+    return jsonify(dict(report, count=len(report['results'])))
+
+@api_bp.route('/holds', methods=['POST'])
+def place_hold_api():
+    """
+    Place a hold on a book with no copies on the shelf.
+    
+    Body: {"patron_id": "123456", "book_id": 3}
+    """
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({'error': 'JSON body is required'}), 400
+    
+    success, message = place_hold(str(data.get('patron_id', '')),
+                                  data.get('book_id') if isinstance(data.get('book_id'), int) else 0)
+    return jsonify({'success': success, 'message': message}), 201 if success else 400
+
+@api_bp.route('/holds/<int:hold_id>', methods=['DELETE'])
+def cancel_hold_api(hold_id):
+    """Cancel a hold; pass the holder's ?patron_id=."""
+    success, message = cancel_hold(request.args.get('patron_id', ''), hold_id)
+    return jsonify({'success': success, 'message': message}), 200 if success else 404
+
+@api_bp.route('/patrons/<patron_id>/holds')
+def patron_holds_api(patron_id):
+    """
+    List a patron's holds, with queue positions for waiting ones, and the
+    notifications sent when held copies became ready.
+    """
+    return jsonify(get_patron_holds_and_notifications(patron_id))
+
+@api_bp.route('/overdue')
+def overdue_loans_stream():
+    """
+    Stream every overdue loan with its late fee, most overdue first, as
+    newline-delimited JSON (one loan object per line).
+    
+    The response is written while the loans are read, chunk by chunk, so it
+    starts immediately and never holds the whole list in memory.
+    """
+    def generate():
+        for loan in sweep_overdue_loans():
+            yield json.dumps(loan) + '\n'
+    
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
 @api_bp.route('/search')
 def search_books_api():
     """
@@ -24,12 +133,13 @@ def search_books_api():
     """
     search_term = request.args.get('q', '').strip()
     search_type = request.args.get('type', 'title')
+    limit = request.args.get('limit', SEARCH_RESULT_LIMIT, type=int)
     
     if not search_term:
         return jsonify({'error': 'Search term is required'}), 400
     
     # Use business logic function
-    books = search_books_in_catalog(search_term, search_type)
+    books = search_books_in_catalog(search_term, search_type, limit)
     
     return jsonify({
         'search_term': search_term,
@@ -37,3 +147,99 @@ def search_books_api():
         'results': books,
         'count': len(books)
     })
+
+@api_bp.route('/catalog')
+def catalog_api():
+    """
+    List the catalog one page at a time.
+    API interface for R2: Book Catalog Display
+    
+    Pass the returned next_cursor as ?cursor= to fetch the following page.
+    """
+    cursor = request.args.get('cursor')
+    limit = request.args.get('limit', CATALOG_PAGE_SIZE, type=int)
+    
+    page = get_catalog_page(cursor, limit)
+    if page['status'] != 'success':
+        return jsonify({'error': page['status']}), 400
+    
+    return jsonify({
+        'books': page['books'],
+        'count': len(page['books']),
+        'limit': page['limit'],
+        'next_cursor': page['next_cursor']
+    })
+
+def _queued(job_id):
+    """202 response pointing at the status of a newly queued job."""
+    if job_id is None:
+        return jsonify({'error': 'Database error occurred while queueing the job'}), 500
+    
+    status_url = url_for('api.job_status', job_id=job_id)
+    return jsonify({'job_id': job_id, 'status': 'queued', 'status_url': status_url}), \
+        202, {'Location': status_url}
+
+@api_bp.route('/payments', methods=['POST'])
+def queue_late_fee_payment():
+    """
+    Queue a late fee payment; the gateway is charged by a background worker.
+    
+    Body: {"patron_id": "123456", "book_id": 1} to pay one book's fees, or
+    leave out book_id to pay all of the patron's fees. An optional
+    "idempotency_key" makes resubmitting the same payment safe.
+    Poll the returned status_url for the outcome.
+    """
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or not isinstance(data.get('patron_id'), str):
+        return jsonify({'error': 'patron_id is required'}), 400
+    
+    book_id = data.get('book_id')
+    if book_id is not None and (not isinstance(book_id, int) or isinstance(book_id, bool)):
+        return jsonify({'error': 'book_id must be an integer'}), 400
+    
+    payload = {'patron_id': data['patron_id'], 'book_id': book_id}
+    if data.get('idempotency_key'):
+        payload['idempotency_key'] = str(data['idempotency_key'])
+    return _queued(submit_job('pay_late_fees', payload))
+
+@api_bp.route('/payments/<transaction_id>')
+def payment_status(transaction_id):
+    """
+    Get the gateway status of a late fee payment. Final statuses are served
+    from cache; 503 means the gateway is failing or its circuit is open.
+    """
+    status = get_payment_status(transaction_id)
+    code = {'invalid': 400, 'not_found': 404, 'unavailable': 503}.get(status.get('status'), 200)
+    return jsonify(status), code
+
+@api_bp.route('/refunds', methods=['POST'])
+def queue_late_fee_refund():
+    """
+    Queue a refund of a late fee payment.
+    
+    Body: {"transaction_id": "txn_...", "amount": 5.0} plus an optional
+    "idempotency_key". Poll the returned status_url for the outcome.
+    """
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or not isinstance(data.get('transaction_id'), str):
+        return jsonify({'error': 'transaction_id is required'}), 400
+    
+    amount = data.get('amount')
+    if not isinstance(amount, (int, float)) or isinstance(amount, bool):
+        return jsonify({'error': 'amount must be a number'}), 400
+    
+    payload = {'transaction_id': data['transaction_id'], 'amount': amount}
+    if data.get('idempotency_key'):
+        payload['idempotency_key'] = str(data['idempotency_key'])
+    return _queued(submit_job('refund_late_fee_payment', payload))
+
+@api_bp.route('/jobs/<int:job_id>')
+def job_status(job_id):
+    """
+    Get the status of a queued payment or refund job: queued, running,
+    succeeded, failed (final, e.g. card declined) or dead (out of retries).
+    """
+    job = get_job_status(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job)
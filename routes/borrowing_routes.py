@@ -3,7 +3,7 @@ Borrowing Routes - Book borrowing and returning endpoints
 """
 
 from flask import Blueprint, render_template, request, redirect, url_for, flash
-from services.library_service import borrow_book_by_patron, return_book_by_patron
+from services.library_service import borrow_book_by_patron, return_book_by_patron, place_hold
 
 borrowing_bp = Blueprint('borrowing', __name__)
 
@@ -27,6 +27,26 @@ def borrow_book():
     flash(message, 'success' if success else 'error')
     return redirect(url_for('catalog.catalog'))
 
+@borrowing_bp.route('/hold', methods=['POST'])
+def place_book_hold():
+    """
+    Place a hold on a book with no copies on the shelf; the patron is
+    notified when a returned copy is set aside for them.
+    """
+    patron_id = request.form.get('patron_id', '').strip()
+    
+    try:
+        book_id = int(request.form.get('book_id', ''))
+    except (ValueError, TypeError):
+        flash('Invalid book ID.', 'error')
+        return redirect(url_for('catalog.catalog'))
+    
+    # Use business logic function
+    success, message = place_hold(patron_id, book_id)
+    
+    flash(message, 'success' if success else 'error')
+    return redirect(url_for('catalog.catalog'))
+
 @borrowing_bp.route('/return', methods=['GET', 'POST'])
 def return_book():
     """
@@ -3,8 +3,7 @@ Catalog Routes - Book catalog related endpoints
 """
 
 from flask import Blueprint, render_template, request, redirect, url_for, flash
-from database import get_all_books
-from services.library_service import add_book_to_catalog
+from services.library_service import add_book_to_catalog, get_catalog_page, CATALOG_PAGE_SIZE
 
 catalog_bp = Blueprint('catalog', __name__)
 
@@ -16,11 +15,19 @@ def index():
 @catalog_bp.route('/catalog')
 def catalog():
     """
-    Display all books in the catalog.
+    Display one page of books in the catalog.
     Implements R2: Book Catalog Display
     """
-    books = get_all_books()
-    return render_template('catalog.html', books=books)
+    cursor = request.args.get('cursor')
+    limit = request.args.get('limit', CATALOG_PAGE_SIZE, type=int)
+    
+    page = get_catalog_page(cursor, limit)
+    if page['status'] != 'success':
+        flash(page['status'], 'error')
+        page = get_catalog_page(None, limit)
+    
+    return render_template('catalog.html', books=page['books'], next_cursor=page['next_cursor'],
+                           limit=page['limit'], paged=bool(cursor))
 
 @catalog_bp.route('/add_book', methods=['GET', 'POST'])
 def add_book():
@@ -0,0 +1,17 @@
+"""
+Metrics Routes - Prometheus scrape endpoint
+"""
+
+from flask import Blueprint, Response
+from instrumentation import render_metrics
+
+metrics_bp = Blueprint('metrics', __name__)
+
+@metrics_bp.route('/metrics')
+def metrics():
+    """
+    Request latency, SQL and profiling metrics (when instrumentation is
+    enabled) plus connection pool, cache and payment gateway counters,
+    in the Prometheus text exposition format.
+    """
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
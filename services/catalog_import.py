@@ -0,0 +1,129 @@
+"""
+Catalog Import Module - Bulk loading of books from CSV or JSONL files
+Streams the input in chunks so memory use does not grow with the file size
+"""
+
+import csv
+import json
+from itertools import islice
+from typing import Dict, IO, Iterator, List, Optional, Tuple
+from database import get_existing_isbns, insert_books_bulk, insert_book
+from services.library_service import validate_book_details
+
+IMPORT_CHUNK_SIZE = 1000  # rows validated, deduplicated and inserted per transaction
+IMPORT_ERROR_LIMIT = 1000  # per-row errors kept in the report (all are counted)
+IMPORT_FORMATS = ('csv', 'jsonl')
+
+
+def _read_csv(stream: IO[str]) -> Iterator[Tuple[int, Dict]]:
+    """Yield (line number, row) pairs from a CSV file with a header row."""
+    reader = csv.DictReader(stream)
+    for row in reader:
+        yield reader.line_num, row
+
+def _read_jsonl(stream: IO[str]) -> Iterator[Tuple[int, Optional[Dict]]]:
+    """Yield (line number, object) pairs from a JSON Lines file; None for unparsable lines."""
+    for line_num, line in enumerate(stream, start=1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            record = None
+        yield line_num, record if isinstance(record, dict) else None
+
+def _parse_row(row: Optional[Dict]) -> Tuple[Optional[Tuple[str, str, str, int]], Optional[str]]:
+    """Turn a raw row into (title, author, isbn, total_copies), or return an error message."""
+    if row is None:
+        return None, "Row is not a valid JSON object."
+
+    title = str(row.get('title') or '')
+    author = str(row.get('author') or '')
+    isbn = str(row.get('isbn') or '').strip()
+    try:
+        total_copies = int(str(row.get('total_copies', '')).strip())
+    except ValueError:
+        return None, "Total copies must be a positive integer."
+
+    error = validate_book_details(title, author, isbn, total_copies)
+    if error:
+        return None, error
+    return (title.strip(), author.strip(), isbn, total_copies), None
+
+def import_books(stream: IO[str], file_format: str = 'csv', chunk_size: int = IMPORT_CHUNK_SIZE,
+                 error_limit: int = IMPORT_ERROR_LIMIT) -> Dict:
+    """
+    Bulk-add books to the catalog from a CSV or JSONL stream.
+    Bulk version of R1: Book Catalog Management
+
+    Each row needs title, author, isbn and total_copies and is held to the same
+    rules as add_book_to_catalog. Rows are processed chunk by chunk: the chunk is
+    validated, ISBNs duplicated within it or already in the catalog (including
+    earlier chunks) are rejected, and the rest are inserted with one executemany
+    in one transaction.
+
+    Args:
+        stream: Text stream to read from
+        file_format: 'csv' (with a header row) or 'jsonl'
+        chunk_size: Rows per transaction
+        error_limit: Maximum number of per-row errors kept in the report
+
+    Returns:
+        dict: rows, imported and failed counts, plus errors as a list of
+        {'line', 'isbn', 'message'} dicts (at most error_limit of them)
+    """
+    if file_format not in IMPORT_FORMATS:
+        raise ValueError(f"Unsupported import format: {file_format}")
+    if chunk_size <= 0:
+        raise ValueError("Chunk size must be a positive integer.")
+
+    report = {'rows': 0, 'imported': 0, 'failed': 0, 'errors': []}
+
+    rows = _read_csv(stream) if file_format == 'csv' else _read_jsonl(stream)
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            break
+        report['rows'] += len(chunk)
+        failures = []  # (line, isbn, message) for this chunk
+
+        # Validate, and drop ISBNs repeated within the chunk
+        valid: List[Tuple[int, Tuple[str, str, str, int]]] = []
+        chunk_isbns = set()
+        for line_num, row in chunk:
+            book, error = _parse_row(row)
+            if error:
+                failures.append((line_num, (row or {}).get('isbn'), error))
+            elif book[2] in chunk_isbns:
+                failures.append((line_num, book[2], "Duplicate ISBN in import file."))
+            else:
+                chunk_isbns.add(book[2])
+                valid.append((line_num, book))
+
+        # One batched lookup for ISBNs already in the catalog
+        existing = get_existing_isbns(list(chunk_isbns))
+        new_books = []
+        for line_num, book in valid:
+            if book[2] in existing:
+                failures.append((line_num, book[2], "A book with this ISBN already exists."))
+            else:
+                new_books.append((line_num, book))
+
+        if new_books and insert_books_bulk([(t, a, i, c, c) for _, (t, a, i, c) in new_books]):
+            report['imported'] += len(new_books)
+        else:
+            # The batch was rolled back (e.g. a concurrent insert took an ISBN);
+            # retry row by row so only the offending rows are rejected.
+            for line_num, (title, author, isbn, copies) in new_books:
+                if insert_book(title, author, isbn, copies, copies):
+                    report['imported'] += 1
+                else:
+                    failures.append((line_num, isbn, "Database error occurred while adding the book."))
+
+        report['failed'] += len(failures)
+        for line_num, isbn, message in sorted(failures, key=lambda failure: failure[0]):
+            if len(report['errors']) >= error_limit:
+                break
+            report['errors'].append({'line': line_num, 'isbn': isbn, 'message': message})
+
+    return report
@@ -0,0 +1,236 @@
+"""
+Job Queue Module - Background processing of late fee payments and refunds
+Jobs are stored in the jobs table and run by a pool of worker threads, so a
+web request only enqueues the work and returns the job ID straight away
+"""
+
+import json
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Optional, Tuple
+
+from database import enqueue_job, claim_job, finish_job, get_job, requeue_jobs
+from services import library_service
+
+JOB_WORKERS = int(os.environ.get('LIBRARY_JOB_WORKERS', 2))  # worker threads per process; 0 disables them
+JOB_MAX_ATTEMPTS = int(os.environ.get('LIBRARY_JOB_MAX_ATTEMPTS', 5))
+JOB_RETRY_DELAY = float(os.environ.get('LIBRARY_JOB_RETRY_DELAY', 2.0))  # seconds before the first retry; doubles after each
+JOB_MAX_RETRY_DELAY = float(os.environ.get('LIBRARY_JOB_MAX_RETRY_DELAY', 300.0))
+JOB_POLL_INTERVAL = float(os.environ.get('LIBRARY_JOB_POLL_INTERVAL', 1.0))  # idle wait between queue checks
+JOB_LEASE_TIMEOUT = float(os.environ.get('LIBRARY_JOB_LEASE_TIMEOUT', 300.0))  # running jobs older than this are requeued
+JOB_REQUEUE_INTERVAL = float(os.environ.get('LIBRARY_JOB_REQUEUE_INTERVAL', 60.0))  # seconds between checks for them
+
+# Failures worth retrying: the gateway or the database could not be reached,
+# or another run still holds the payment's ledger entry (it finishes, or is
+# found abandoned, by a later attempt). Anything else (a declined card, no
+# fees owed) is final.
+RETRYABLE_ERRORS = ("Payment processing error", "Refund processing error", "Database error",
+                    "This payment is already being processed")
+
+
+def _pay_late_fees(payload: Dict, idempotency_key: str) -> Tuple[bool, str, Optional[str]]:
+    """Pay one book's late fees, or all of the patron's when no book_id is given."""
+    if payload.get('book_id') is None:
+        return library_service.pay_all_late_fees(payload['patron_id'], idempotency_key=idempotency_key)
+    return library_service.pay_late_fees(payload['patron_id'], payload['book_id'],
+                                         idempotency_key=idempotency_key)
+
+def _refund_late_fee_payment(payload: Dict, idempotency_key: str) -> Tuple[bool, str, Optional[str]]:
+    success, message = library_service.refund_late_fee_payment(
+        payload['transaction_id'], payload['amount'], idempotency_key=idempotency_key)
+    return success, message, None
+
+# Job kind -> handler(payload, idempotency_key) returning (success, message, transaction_id)
+JOB_HANDLERS: Dict[str, Callable[[Dict, str], Tuple[bool, str, Optional[str]]]] = {
+    'pay_late_fees': _pay_late_fees,
+    'refund_late_fee_payment': _refund_late_fee_payment,
+}
+
+
+def retry_delay(attempts: int) -> float:
+    """Seconds to wait before the next run of a job that has failed `attempts` times."""
+    return min(JOB_RETRY_DELAY * 2 ** (attempts - 1), JOB_MAX_RETRY_DELAY)
+
+def submit_job(kind: str, payload: Dict, max_attempts: int = JOB_MAX_ATTEMPTS) -> Optional[int]:
+    """
+    Queue a job for the background workers.
+
+    Args:
+        kind: One of JOB_HANDLERS
+        payload: JSON-serializable arguments for the handler. An
+            'idempotency_key' in it is passed to the payment call; otherwise
+            the job uses 'job-<id>', so retries never charge twice.
+        max_attempts: Runs before the job is dead-lettered
+
+    Returns:
+        Optional[int]: The job ID, or None on a database error
+    """
+    if kind not in JOB_HANDLERS:
+        raise ValueError(f"Unknown job kind: {kind}")
+
+    job_id = enqueue_job(kind, json.dumps(payload), max_attempts)
+    if job_id is not None and _worker is not None:
+        _worker.wake()
+    return job_id
+
+def run_job(job: Dict) -> str:
+    """
+    Run one claimed job and record the outcome.
+
+    A successful run is 'succeeded' and a final failure 'failed'. A
+    retryable failure is queued again after an exponential backoff, or
+    'dead' once max_attempts runs have been used.
+
+    Returns:
+        str: The job's new status
+    """
+    payload = json.loads(job['payload'])
+    idempotency_key = payload.get('idempotency_key') or f"job-{job['id']}"
+    try:
+        success, message, transaction_id = JOB_HANDLERS[job['kind']](payload, idempotency_key)
+        retryable = not success and message.startswith(RETRYABLE_ERRORS)
+    except Exception as e:
+        success, message, transaction_id = False, f"Job error: {str(e)}", None
+        retryable = True
+
+    result = json.dumps({'success': success, 'message': message, 'transaction_id': transaction_id})
+    if success:
+        status, error, run_at = 'succeeded', None, None
+    elif not retryable:
+        status, error, run_at = 'failed', message, None
+    elif job['attempts'] >= job['max_attempts']:
+        status, error, run_at = 'dead', message, None
+    else:
+        status, error = 'queued', message
+        run_at = datetime.now() + timedelta(seconds=retry_delay(job['attempts']))
+
+    finish_job(job['id'], status, result, error, run_at)
+    return status
+
+def run_pending_jobs(limit: Optional[int] = None) -> int:
+    """
+    Run queued jobs that are due in the calling thread until none are left.
+
+    Returns:
+        int: Number of jobs run
+    """
+    count = 0
+    while limit is None or count < limit:
+        job = claim_job(datetime.now())
+        if job is None:
+            break
+        run_job(job)
+        count += 1
+    return count
+
+def get_job_status(job_id: int) -> Optional[Dict]:
+    """Get a job with its payload and result decoded, or None if it does not exist."""
+    job = get_job(job_id)
+    if not job:
+        return None
+
+    return {
+        'job_id': job['id'],
+        'kind': job['kind'],
+        'status': job['status'],
+        'attempts': job['attempts'],
+        'max_attempts': job['max_attempts'],
+        'payload': json.loads(job['payload']),
+        'result': json.loads(job['result']) if job['result'] else None,
+        'last_error': job['last_error'],
+        'next_run_at': job['run_at'] if job['status'] == 'queued' else None,
+        'created_at': job['created_at'],
+        'updated_at': job['updated_at'],
+    }
+
+
+class JobWorker:
+    """
+    Pool of daemon threads that claim and run queued jobs.
+
+    Idle threads sleep for poll_interval between queue checks, or until
+    wake() is called by submit_job. Claims are made under a database lock,
+    so several processes can run workers against the same database. Every
+    requeue_interval seconds one thread puts jobs whose lease expired (their
+    process died mid-run) back on the queue.
+    """
+
+    def __init__(self, workers: int = JOB_WORKERS, poll_interval: float = JOB_POLL_INTERVAL,
+                 requeue_interval: float = JOB_REQUEUE_INTERVAL):
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.requeue_interval = requeue_interval
+        self._wake = threading.Event()
+        self._stopping = threading.Event()
+        self._threads: List[threading.Thread] = []
+        self._requeue_lock = threading.Lock()
+        self._next_requeue = 0.0
+
+    def start(self):
+        """Requeue jobs orphaned by a previous process, then start the threads."""
+        self.requeue_abandoned()
+        self._stopping.clear()
+        for number in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f'job-worker-{number}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout: Optional[float] = None):
+        """Stop the threads once they finish their current job."""
+        self._stopping.set()
+        self._wake.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def wake(self):
+        """Make idle threads check the queue now."""
+        self._wake.set()
+
+    def requeue_abandoned(self) -> int:
+        """
+        Requeue running jobs not updated for JOB_LEASE_TIMEOUT seconds, unless
+        this worker already did so in the last requeue_interval seconds.
+
+        Returns:
+            int: Number of jobs requeued
+        """
+        with self._requeue_lock:
+            now = time.monotonic()
+            if now < self._next_requeue:
+                return 0
+            self._next_requeue = now + self.requeue_interval
+        return requeue_jobs('running', datetime.now() - timedelta(seconds=JOB_LEASE_TIMEOUT))
+
+    def _run(self):
+        while not self._stopping.is_set():
+            self.requeue_abandoned()
+            job = claim_job(datetime.now())
+            if job is None:
+                self._wake.wait(self.poll_interval)
+                self._wake.clear()
+                continue
+            run_job(job)
+
+
+_worker: Optional[JobWorker] = None
+_worker_lock = threading.Lock()
+
+def start_job_worker(workers: int = JOB_WORKERS) -> Optional[JobWorker]:
+    """Start this process's job worker threads (once); returns None if workers is 0."""
+    global _worker
+    with _worker_lock:
+        if _worker is None and workers > 0:
+            _worker = JobWorker(workers)
+            _worker.start()
+        return _worker
+
+def stop_job_worker(timeout: Optional[float] = None):
+    """Stop this process's job worker threads, if running."""
+    global _worker
+    with _worker_lock:
+        if _worker is not None:
+            _worker.stop(timeout)
+            _worker = None
@@ -3,47 +3,85 @@ Library Service Module - Business Logic Functions
 Contains all the core business logic for the Library Management System
 """
 
+import base64
+import json
+import uuid
 from datetime import datetime, timedelta
-from typing import Dict, List, Optional, Tuple
+from typing import Dict, Iterator, List, Optional, Tuple
 from database import (
-    get_book_by_id, get_book_by_isbn, get_patron_borrow_count,
-    insert_book, insert_borrow_record, update_book_availability,
-    update_borrow_record_return_date, get_all_books, get_patron_borrowed_books
+    get_book_by_id, get_book_by_isbn,
+    insert_book, borrow_book_transaction, return_book_transaction, return_books_batch,
+    place_hold_transaction, cancel_hold_transaction, expire_ready_holds, get_patron_holds,
+    get_patron_notifications,
+    get_patron_borrowed_books, search_books,
+    get_all_books, get_patron_loans, get_active_loan_due_dates, get_overdue_loans,
+    get_patron_fee_loans, get_payment_by_key, get_payment_by_transaction, begin_payment, finish_payment
 )
-from services.payment_service import PaymentGateway
+from services.payment_service import PaymentGateway, get_payment_gateway
+from query_trace import chunked_reads, query_budget
 
-def add_book_to_catalog(title: str, author: str, isbn: str, total_copies: int) -> Tuple[bool, str]:
+MAX_BORROWED_BOOKS = 5  # maximum number of books a patron may have out at once
+LOAN_PERIOD_DAYS = 14
+HOLD_PICKUP_DAYS = 7  # days a returned copy is kept for the patron whose hold it went to
+SEARCH_RESULT_LIMIT = 50  # default number of search results returned
+MAX_SEARCH_RESULT_LIMIT = 200
+LATE_FEE_PER_DAY = 0.50
+MAX_LATE_FEE = 15.00  # per book
+CATALOG_PAGE_SIZE = 50  # default number of books per catalog page
+MAX_CATALOG_PAGE_SIZE = 200
+OVERDUE_SWEEP_CHUNK_SIZE = 1000  # loans read per query by sweep_overdue_loans
+MAX_RETURN_BATCH_SIZE = 5000  # items accepted by one batch check-in
+MAX_LATE_FEE_BATCH_SIZE = 5000  # loans priced by one batch late fee lookup
+# Seconds a payments ledger entry may stay pending before it is taken to belong
+# to a process that died mid-payment, and its idempotency key may be retried
+PAYMENT_PENDING_TIMEOUT = 300.0
+
+def validate_book_details(title: str, author: str, isbn: str, total_copies: int) -> Optional[str]:
     """
-    Add a new book to the catalog.
-    Implements R1: Book Catalog Management
+    Validate the fields of a new book (R1 rules), without touching the database.
     
-    Args:
-        title: Book title (max 200 chars)
-        author: Book author (max 100 chars)
-        isbn: 13-digit ISBN
-        total_copies: Number of copies (positive integer)
-        
     Returns:
-        tuple: (success: bool, message: str)
+        str: Error message for the first invalid field, or None if all are valid
     """
-    # Input validation
     if not title or not title.strip():
-        return False, "Title is required."
+        return "Title is required."
     
     if len(title.strip()) > 200:
-        return False, "Title must be less than 200 characters."
+        return "Title must be less than 200 characters."
     
     if not author or not author.strip():
-        return False, "Author is required."
+        return "Author is required."
     
     if len(author.strip()) > 100:
-        return False, "Author must be less than 100 characters."
+        return "Author must be less than 100 characters."
     
     if len(isbn) != 13:
-        return False, "ISBN must be exactly 13 digits."
+        return "ISBN must be exactly 13 digits."
     
     if not isinstance(total_copies, int) or total_copies <= 0:
-        return False, "Total copies must be a positive integer."
+        return "Total copies must be a positive integer."
+    
+    return None
+
+@query_budget(2)
+def add_book_to_catalog(title: str, author: str, isbn: str, total_copies: int) -> Tuple[bool, str]:
+    """
+    Add a new book to the catalog.
+    Implements R1: Book Catalog Management
+    
+    Args:
+        title: Book title (max 200 chars)
+        author: Book author (max 100 chars)
+        isbn: 13-digit ISBN
+        total_copies: Number of copies (positive integer)
+        
+    Returns:
+        tuple: (success: bool, message: str)
+    """
+    # Input validation
+    error = validate_book_details(title, author, isbn, total_copies)
+    if error:
+        return False, error
     
     # Check for duplicate ISBN
     existing = get_book_by_isbn(isbn)
@@ -57,6 +95,7 @@ def add_book_to_catalog(title: str, author: str, isbn: str, total_copies: int) -
     else:
         return False, "Database error occurred while adding the book."
 
+@query_budget(6)
 def borrow_book_by_patron(patron_id: str, book_id: int) -> Tuple[bool, str]:
     """
     Allow a patron to borrow a book.
@@ -73,54 +112,225 @@ def borrow_book_by_patron(patron_id: str, book_id: int) -> Tuple[bool, str]:
     if not patron_id or not patron_id.isdigit() or len(patron_id) != 6:
         return False, "Invalid patron ID. Must be exactly 6 digits."
     
-    # Check if book exists and is available
-    book = get_book_by_id(book_id)
-    if not book:
-        return False, "Book not found."
+    # Create borrow record
+    borrow_date = datetime.now()
+    due_date = borrow_date + timedelta(days=LOAN_PERIOD_DAYS)
     
-    if book['available_copies'] <= 0:
-        return False, "This book is currently not available."
+    # Check availability and the borrowing limit, then record the loan, in one transaction
+    status, book = borrow_book_transaction(patron_id, book_id, borrow_date, due_date, MAX_BORROWED_BOOKS)
     
-    # Check patron's current borrowed books count
-    current_borrowed = get_patron_borrow_count(patron_id)
+    if status == 'not_found':
+        return False, "Book not found."
     
-    if current_borrowed > 5:
-        return False, "You have reached the maximum borrowing limit of 5 books."
+    if status == 'unavailable':
+        return False, "This book is currently not available."
     
-    # Create borrow record
-    borrow_date = datetime.now()
-    due_date = borrow_date + timedelta(days=14)
+    if status == 'limit_reached':
+        return False, f"You have reached the maximum borrowing limit of {MAX_BORROWED_BOOKS} books."
     
-    # Insert borrow record and update availability
-    borrow_success = insert_borrow_record(patron_id, book_id, borrow_date, due_date)
-    if not borrow_success:
+    if status != 'success':
         return False, "Database error occurred while creating borrow record."
     
-    availability_success = update_book_availability(book_id, -1)
-    if not availability_success:
-        return False, "Database error occurred while updating book availability."
-    
     return True, f'Successfully borrowed "{book["title"]}". Due date: {due_date.strftime("%Y-%m-%d")}.'
 
+@query_budget(6)
 def return_book_by_patron(patron_id: str, book_id: int) -> Tuple[bool, str]:
     """
     Process book return by a patron.
+    Implements R4 as per requirements
+    
+    The loan is closed, the copy goes to the next patron waiting for it (or
+    back on the shelf) and any late fee is assessed in one database
+    transaction.
     
-    TODO: Implement R4 as per requirements
+    Args:
+        patron_id: 6-digit library card ID
+        book_id: ID of the book being returned
+        
+    Returns:
+        tuple: (success: bool, message: str); the message states the late
+        fee owed, if any
     """
-
-    if (not patron_id or not patron_id.isdigit() or len(patron_id) != 6) and (not isinstance(book_id, int) or book_id <= 0):
-        return False, "Invalid patron ID or book ID."
-    elif borrow_book_by_patron(patron_id, book_id)[0] is False:
+    # Validate patron ID
+    if not patron_id or not patron_id.isdigit() or len(patron_id) != 6:
+        return False, "Invalid patron ID. Must be exactly 6 digits."
+    
+    if not isinstance(book_id, int) or book_id <= 0:
+        return False, "Invalid book ID."
+    
+    return_date = datetime.now()
+    status, loan = return_book_transaction(patron_id, book_id, return_date,
+                                           return_date + timedelta(days=HOLD_PICKUP_DAYS))
+    
+    if status == 'not_found':
         return False, "No active borrow record found for this patron and book."
-    else:
-        update_book_availability(book_id, 1)
-        calculate_late_fee_for_book(patron_id, book_id)
-        update_borrow_record_return_date(patron_id, book_id, datetime.now())
-        return True, "Book returned successfully."
+    
+    if status != 'success':
+        return False, "Database error occurred while processing the return."
+    
+    days_overdue, fee_amount = compute_late_fee(loan['due_date'], return_date)
+    if fee_amount > 0:
+        return True, (f"Book returned successfully. Late fee: ${fee_amount:.2f} "
+                      f"({days_overdue} days overdue).")
+    return True, "Book returned successfully."
 
+@query_budget(6)
+def place_hold(patron_id: str, book_id: int) -> Tuple[bool, str]:
+    """
+    Reserve a book that has no copies on the shelf.
+    
+    Holds are served first come, first served: each returned copy is set
+    aside for the oldest waiting hold, whose patron is notified and then has
+    HOLD_PICKUP_DAYS days to borrow it.
+    
+    Args:
+        patron_id: 6-digit library card ID
+        book_id: ID of the book to reserve
+        
+    Returns:
+        tuple: (success: bool, message: str)
+    """
+    if not patron_id or not patron_id.isdigit() or len(patron_id) != 6:
+        return False, "Invalid patron ID. Must be exactly 6 digits."
+    
+    if not isinstance(book_id, int) or book_id <= 0:
+        return False, "Invalid book ID."
+    
+    status, hold = place_hold_transaction(patron_id, book_id, datetime.now())
+    
+    if status == 'not_found':
+        return False, "Book not found."
+    
+    if status == 'available':
+        return False, "This book is available now; borrow it instead of placing a hold."
+    
+    if status == 'borrowed':
+        return False, "You already have this book borrowed."
+    
+    if status == 'duplicate':
+        return False, "You already have a hold on this book."
+    
+    if status != 'success':
+        return False, "Database error occurred while placing the hold."
+    
+    return True, f'Hold placed on "{hold["title"]}". You are number {hold["position"]} in line.'
+
+@query_budget(6)
+def cancel_hold(patron_id: str, hold_id: int) -> Tuple[bool, str]:
+    """
+    Cancel one of a patron's holds; a copy already set aside for it passes
+    to the next patron in line.
+    
+    Returns:
+        tuple: (success: bool, message: str)
+    """
+    if not patron_id or not patron_id.isdigit() or len(patron_id) != 6:
+        return False, "Invalid patron ID. Must be exactly 6 digits."
+    
+    now = datetime.now()
+    status = cancel_hold_transaction(patron_id, hold_id, now, now + timedelta(days=HOLD_PICKUP_DAYS))
+    
+    if status == 'not_found':
+        return False, "No active hold found for this patron."
+    
+    if status != 'success':
+        return False, "Database error occurred while cancelling the hold."
+    
+    return True, "Hold cancelled."
+
+def expire_holds(now: Optional[datetime] = None) -> int:
+    """
+    Expire ready holds that were not picked up in time and pass their copies
+    on to the next patrons in line.
     
+    Returns:
+        int: Number of holds expired
+    """
+    now = now or datetime.now()
+    return expire_ready_holds(now, now + timedelta(days=HOLD_PICKUP_DAYS)) or 0
+
+@query_budget(2)
+def get_patron_holds_and_notifications(patron_id: str) -> Dict:
+    """
+    Get a patron's holds (with queue positions) and recent notifications.
+    
+    Returns:
+        dict: holds and notifications lists, empty for an invalid patron ID
+    """
+    if not patron_id or not patron_id.isdigit() or len(patron_id) != 6:
+        return {'holds': [], 'notifications': []}
+    
+    return {
+        'holds': get_patron_holds(patron_id),
+        'notifications': get_patron_notifications(patron_id)
+    }
+
+def return_books_by_patrons(items: List[Tuple[str, int]]) -> Dict:
+    """
+    Check in many returned books at once (drop box, self-check machines).
+    Batch version of R4: Book Return Processing
+    
+    Every valid item is returned in one database transaction; each gets the
+    same outcome and late fee return_book_by_patron would give it.
+    
+    Args:
+        items: (patron_id, book_id) pairs, at most MAX_RETURN_BATCH_SIZE
+        
+    Returns:
+        dict: results (one dict per item, in order, with patron_id, book_id,
+        status, fee_amount and days_overdue), returned and failed counts,
+        and total_fee_amount
+    """
+    results = []
+    valid = []
+    for patron_id, book_id in items:
+        result = {'patron_id': patron_id, 'book_id': book_id, 'status': 'success',
+                  'fee_amount': 0.00, 'days_overdue': 0}
+        if not isinstance(patron_id, str) or not patron_id.isdigit() or len(patron_id) != 6:
+            result['status'] = "Invalid patron ID. Must be exactly 6 digits."
+        elif not isinstance(book_id, int) or isinstance(book_id, bool) or book_id <= 0:
+            result['status'] = "Invalid book ID."
+        else:
+            valid.append(result)
+        results.append(result)
+    
+    if valid:
+        return_date = datetime.now()
+        loans = return_books_batch([(r['patron_id'], r['book_id']) for r in valid], return_date,
+                                   return_date + timedelta(days=HOLD_PICKUP_DAYS))
+        for result, loan in zip(valid, loans or [None] * len(valid)):
+            if loans is None:
+                result['status'] = "Database error occurred while processing the return."
+            elif loan is None:
+                result['status'] = "No active borrow record found for this patron and book."
+            else:
+                result['days_overdue'], result['fee_amount'] = compute_late_fee(loan['due_date'], return_date)
+    
+    returned = sum(1 for result in results if result['status'] == 'success')
+    return {
+        'results': results,
+        'returned': returned,
+        'failed': len(results) - returned,
+        'total_fee_amount': round(sum(result['fee_amount'] for result in results), 2)
+    }
 
+def compute_late_fee(due_date: datetime, now: datetime) -> Tuple[int, float]:
+    """
+    Compute (days_overdue, fee_amount) for a loan due on `due_date`, as of `now`.
+    
+    Days are counted by calendar date; the fee is LATE_FEE_PER_DAY per day
+    overdue, capped at MAX_LATE_FEE.
+    """
+    days_overdue = max(0, (now.date() - due_date.date()).days)
+    fee_amount = min(round(days_overdue * LATE_FEE_PER_DAY, 2), MAX_LATE_FEE)
+    return days_overdue, fee_amount
+
+def _is_valid_loan_key(patron_id: str, book_id: int) -> bool:
+    """True if patron_id is a 6-digit string and book_id a positive integer."""
+    return (isinstance(patron_id, str) and patron_id.isdigit() and len(patron_id) == 6
+            and isinstance(book_id, int) and not isinstance(book_id, bool) and book_id > 0)
+
+@query_budget(1)
 def calculate_late_fee_for_book(patron_id: str, book_id: int) -> Dict:
     """
     Calculate late fees for a specific book.
@@ -140,7 +350,7 @@ def calculate_late_fee_for_book(patron_id: str, book_id: int) -> Dict:
         'status': ''
     }
 
-    if (not patron_id or not patron_id.isdigit() or len(patron_id) != 6) and (not isinstance(book_id, int) or book_id <= 0):
+    if not _is_valid_loan_key(patron_id, book_id):
         result['status'] = "Invalid patron ID or book ID."
         return result
     else:
@@ -150,9 +360,7 @@ def calculate_late_fee_for_book(patron_id: str, book_id: int) -> Dict:
             if rec.get('book_id') == book_id and rec.get('return_date') is None:
                 due_date = rec.get('due_date')
                 if isinstance(due_date, datetime):
-                    days_overdue = max(0, (now.date() - due_date.date()).days)
-                    fee_amount = round(days_overdue * 0.50, 2)
-                    fee_amount = min(fee_amount, 15.00)
+                    days_overdue, fee_amount = compute_late_fee(due_date, now)
 
                     result.update({
                         'fee_amount': float(f"{fee_amount:.2f}"),
@@ -164,11 +372,131 @@ def calculate_late_fee_for_book(patron_id: str, book_id: int) -> Dict:
         result['status'] = "No active borrow record found for this patron and book."
         return result
 
-def search_books_in_catalog(search_term: str, search_type: str) -> List[Dict]:
+def calculate_late_fees_batch(loans: Optional[List[Tuple[str, int]]] = None,
+                              overdue_only: bool = False) -> List[Dict]:
+    """
+    Calculate late fees for many loans at once.
+    Batch version of R5: Late Fee Calculation
+    
+    The loans are fetched with one query per few hundred pairs (or a single
+    query for all active loans), and the fee rule is evaluated once per
+    distinct due date rather than once per loan.
+    
+    Args:
+        loans: (patron_id, book_id) pairs, at most MAX_LATE_FEE_BATCH_SIZE
+            per API request, or None for every active loan
+        overdue_only: Leave out loans with no fee
+        
+    Returns:
+        list: One dict per loan with patron_id, book_id, fee_amount,
+        days_overdue and status, in request order when `loans` is given
+    """
+    now = datetime.now()
+    fees_by_day = {}
+    
+    def fee_for(due_date: str) -> Tuple[int, float]:
+        day = due_date[:10]
+        fee = fees_by_day.get(day)
+        if fee is None:
+            fee = fees_by_day[day] = compute_late_fee(datetime.fromisoformat(day), now)
+        return fee
+    
+    if loans is None:
+        results = []
+        for patron_id, book_id, due_date in get_active_loan_due_dates():
+            days_overdue, fee_amount = fee_for(due_date)
+            if overdue_only and fee_amount <= 0:
+                continue
+            results.append({'patron_id': patron_id, 'book_id': book_id, 'fee_amount': fee_amount,
+                            'days_overdue': days_overdue, 'status': 'success'})
+        return results
+    
+    valid = {(patron_id, book_id) for patron_id, book_id in loans if _is_valid_loan_key(patron_id, book_id)}
+    # Like calculate_late_fee_for_book, the oldest active loan of a pair counts
+    due_dates = {}
+    for patron_id, book_id, due_date in get_active_loan_due_dates(list(valid)):
+        due_dates.setdefault((patron_id, book_id), due_date)
+    
+    results = []
+    for patron_id, book_id in loans:
+        result = {'patron_id': patron_id, 'book_id': book_id, 'fee_amount': 0.00, 'days_overdue': 0}
+        due_date = due_dates.get((patron_id, book_id))
+        if due_date is not None:
+            result['days_overdue'], result['fee_amount'] = fee_for(due_date)
+            result['status'] = 'success'
+        elif (patron_id, book_id) in valid:
+            result['status'] = "No active borrow record found for this patron and book."
+        else:
+            result['status'] = "Invalid patron ID or book ID."
+        if overdue_only and result['fee_amount'] <= 0:
+            continue
+        results.append(result)
+    return results
+
+def sweep_overdue_loans(now: Optional[datetime] = None,
+                        chunk_size: int = OVERDUE_SWEEP_CHUNK_SIZE) -> Iterator[Dict]:
+    """
+    Stream every overdue loan in the library, most overdue first.
+    
+    Loans are read chunk by chunk off the active-loan due_date index (the
+    pooled connection is returned between chunks) and yielded one at a time,
+    so memory use stays flat however many loans there are. A loan is overdue
+    once its due date has passed by at least one calendar day; fees follow
+    the same rule as calculate_late_fee_for_book.
+    
+    Args:
+        now: Time to assess the loans at (default: now)
+        chunk_size: Loans read per query
+        
+    Yields:
+        dict: record_id, patron_id, book_id, title, due_date (ISO string),
+        days_overdue and fee_amount
+    """
+    if chunk_size <= 0:
+        raise ValueError("Chunk size must be a positive integer.")
+    
+    now = now or datetime.now()
+    today = datetime.combine(now.date(), datetime.min.time())
+    after = None
+    day, fee = None, None
+    while True:
+        with chunked_reads():
+            chunk = get_overdue_loans(today, chunk_size, after)
+        for record_id, patron_id, book_id, title, due_date in chunk:
+            # Loans arrive in due_date order, so the fee only changes with the day
+            if due_date[:10] != day:
+                day = due_date[:10]
+                fee = compute_late_fee(datetime.fromisoformat(day), now)
+            yield {
+                'record_id': record_id,
+                'patron_id': patron_id,
+                'book_id': book_id,
+                'title': title,
+                'due_date': due_date,
+                'days_overdue': fee[0],
+                'fee_amount': fee[1],
+            }
+        if len(chunk) < chunk_size:
+            return
+        after = (chunk[-1][4], chunk[-1][0])
+
+@query_budget(1)
+def search_books_in_catalog(search_term: str, search_type: str, limit: int = SEARCH_RESULT_LIMIT) -> List[Dict]:
     """
     Search for books in the catalog.
+    Implements R6: Book Search Functionality
     
-    TODO: Implement R6 as per requirements
+    Title and author searches match every word of the search term as a word
+    prefix (so "gre gat" finds "The Great Gatsby") and return the best matches
+    first; ISBN searches are exact.
+    
+    Args:
+        search_term: Text to search for
+        search_type: One of 'title', 'author' or 'isbn'
+        limit: Maximum number of results (capped at MAX_SEARCH_RESULT_LIMIT)
+        
+    Returns:
+        list: Matching book rows
     """
     # Check if search term is valid
     if not search_term or not search_term.strip():
@@ -178,59 +506,193 @@ def search_books_in_catalog(search_term: str, search_type: str) -> List[Dict]:
     if search_type not in ['title', 'author', 'isbn']:
         return []
     
+    limit = max(1, min(limit, MAX_SEARCH_RESULT_LIMIT))
     
-    all_books = get_all_books()
-    search_term_lower = search_term.strip().lower()
-    
-    filtered_books = []
-    for book in all_books:
-        if search_type == 'title':
-            if search_term_lower in book['title'].lower():
-                filtered_books.append(book)
-        elif search_type == 'author':
-            if search_term_lower in book['author'].lower():
-                filtered_books.append(book)
-        elif search_type == 'isbn':
-            if book['isbn'] == search_term.strip():
-                filtered_books.append(book)
-    
-    return filtered_books
+    return search_books(search_term.strip(), search_type, limit)
 
 
 
+def encode_catalog_cursor(book: Dict) -> str:
+    """Encode the (title, id) position of a book as an opaque, URL-safe cursor."""
+    raw = json.dumps([book['title'], book['id']]).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+def decode_catalog_cursor(cursor: str) -> Optional[Tuple[str, int]]:
+    """Decode a catalog cursor back into (title, id), or None if it is malformed."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        title, book_id = json.loads(raw.decode('utf-8'))
+    except (ValueError, TypeError):
+        return None
+    if not isinstance(title, str) or not isinstance(book_id, int):
+        return None
+    return title, book_id
+
+@query_budget(1)
+def get_catalog_page(cursor: Optional[str] = None, limit: int = CATALOG_PAGE_SIZE) -> Dict:
+    """
+    Get one page of the catalog, ordered by title.
+    Implements R2: Book Catalog Display
+    
+    Args:
+        cursor: next_cursor from the previous page, or None for the first page
+        limit: Books per page (capped at MAX_CATALOG_PAGE_SIZE)
+        
+    Returns:
+        dict: books, next_cursor (None on the last page), limit and status
+    """
+    limit = max(1, min(limit, MAX_CATALOG_PAGE_SIZE))
+    page = {'books': [], 'next_cursor': None, 'limit': limit, 'status': 'success'}
+    
+    after = None
+    if cursor:
+        after = decode_catalog_cursor(cursor)
+        if after is None:
+            page['status'] = "Invalid catalog cursor."
+            return page
+    
+    # Read one extra row to find out whether another page follows
+    books = get_all_books(limit=limit + 1, after=after)
+    if len(books) > limit:
+        books = books[:limit]
+        page['next_cursor'] = encode_catalog_cursor(books[-1])
+    page['books'] = books
+    return page
+
+@query_budget(1)
 def get_patron_status_report(patron_id: str) -> Dict:
     """
     Get status report for a patron.
+    Implements R7: Patron Status Report
+    
+    All of the patron's loans are read with one query; late fees and totals
+    are then computed in a single pass over them.
     
-    TODO: Implement R7 as per requirements
+    Args:
+        patron_id: 6-digit library card ID
+        
+    Returns:
+        dict: patron_id, borrowed_books (current loans with due dates,
+        days_overdue and late_fee), currently_borrowed, total_late_fees and
+        borrowing_history (every loan, oldest first)
     """
     if not patron_id or not patron_id.isdigit() or len(patron_id) != 6:
         return {
             'patron_id': patron_id,
             'borrowed_books': [],
+            'currently_borrowed': 0,
             'total_late_fees': 0.00,
             'borrowing_history': []
         }
-    else:
-        borrowed_books = get_patron_borrowed_books(patron_id)
-        total_late_fees_owed = 0.00
+    
+    now = datetime.now()
+    borrowed_books = []
+    borrowing_history = []
+    total_late_fees_owed = 0.00
+    
+    for loan in get_patron_loans(patron_id):
+        borrowing_history.append({
+            'book_id': loan['book_id'],
+            'title': loan['title'],
+            'author': loan['author'],
+            'borrow_date': loan['borrow_date'],
+            'due_date': loan['due_date'],
+            'return_date': loan['return_date']
+        })
+        if loan['return_date'] is not None:
+            continue
+        
+        days_overdue, late_fee = compute_late_fee(loan['due_date'], now)
+        total_late_fees_owed += late_fee
+        borrowed_books.append({
+            'book_id': loan['book_id'],
+            'title': loan['title'],
+            'author': loan['author'],
+            'borrow_date': loan['borrow_date'],
+            'due_date': loan['due_date'],
+            'is_overdue': now > loan['due_date'],
+            'days_overdue': days_overdue,
+            'late_fee': late_fee
+        })
+    
+    return {
+        'patron_id': patron_id,
+        'borrowed_books': borrowed_books,
+        'currently_borrowed': len(borrowed_books),
+        'total_late_fees': round(total_late_fees_owed, 2),
+        'borrowing_history': borrowing_history
+    }
 
-        for book in borrowed_books:
-            late_fee = calculate_late_fee_for_book(patron_id,book['book_id'])
-            if late_fee['status'] == 'success':
-                total_late_fees_owed += late_fee['fee_amount']
 
-        borrowing_history = get_patron_borrow_count(patron_id)
+def _replay_payment(payment: Dict, kind: str, reference: str) -> Tuple[bool, str, Optional[str]]:
+    """
+    Outcome of a ledger entry whose idempotency key is used again. `reference`
+    is the patron ID of a charge or the original transaction ID of a refund.
+    """
+    recorded = payment['patron_id'] if kind == 'charge' else payment['transaction_id']
+    if payment['kind'] != kind or recorded != reference:
+        return False, "Idempotency key was already used for a different payment.", None
+    if payment['status'] == 'completed':
+        return True, payment['message'], payment['transaction_id']
+    return False, "This payment is already being processed.", None
 
-        return {
-            'patron_id': patron_id,
-            'borrowed_books': borrowed_books,
-            'total_late_fees': "{total_late_fees_owed}",
-            'borrowing_history': borrowing_history
-        }
+def _pending_cutoff() -> datetime:
+    """Ledger entries pending since before this were abandoned by a process that died."""
+    return datetime.now() - timedelta(seconds=PAYMENT_PENDING_TIMEOUT)
 
+def _can_retry_payment(payment: Dict) -> bool:
+    """True if a ledger entry failed or was abandoned while pending, so its key may be used again."""
+    return payment['status'] == 'failed' or (payment['status'] == 'pending' and
+                                             payment['updated_at'] < _pending_cutoff().isoformat())
+
+def _charge_through_ledger(payment_gateway: Optional[PaymentGateway], idempotency_key: Optional[str],
+                           patron_id: str, amount: float, description: str,
+                           loans: List[Tuple[int, float]]) -> Tuple[bool, str, Optional[str]]:
+    """
+    Charge a patron, recording the attempt in the payments ledger first so a
+    repeated idempotency key never reaches the gateway twice.
+    """
+    state, payment = begin_payment(idempotency_key or uuid.uuid4().hex, 'charge', patron_id,
+                                   amount, description, loans, stale_before=_pending_cutoff())
+    if state == 'error':
+        return False, "Database error occurred while recording the payment.", None
+    if state == 'existing':
+        return _replay_payment(payment, 'charge', patron_id)
+    
+    # Use provided gateway or the shared one
+    if payment_gateway is None:
+        payment_gateway = get_payment_gateway()
+    
+    # Process payment through external gateway
+    # THIS IS WHAT YOU SHOULD MOCK IN THEIR TESTS!
+    try:
+        success, transaction_id, message = payment_gateway.process_payment(
+            patron_id=patron_id,
+            amount=amount,
+            description=description
+        )
+    except Exception as e:
+        # Handle payment gateway errors; the key stays retryable
+        message = f"Payment processing error: {str(e)}"
+        finish_payment(payment['id'], 'failed', message)
+        return False, message, None
+    
+    if not success:
+        message = f"Payment failed: {message}"
+        finish_payment(payment['id'], 'failed', message)
+        return False, message, None
+    
+    message = f"Payment successful! {message}"
+    if not finish_payment(payment['id'], 'completed', message, transaction_id):
+        return True, f"{message} (Warning: the payment could not be recorded.)", transaction_id
+    return True, message, transaction_id
 
-def pay_late_fees(patron_id: str, book_id: int, payment_gateway: PaymentGateway = None) -> Tuple[bool, str, Optional[str]]:
+# The idempotency key is read once up front, so replays skip the fee lookups,
+# and again under the ledger lock; the payment functions repeat that query.
+# Retrying a failed or abandoned key also resets its ledger entry and shares.
+@query_budget(11, allow_repeats=True)
+def pay_late_fees(patron_id: str, book_id: int, payment_gateway: PaymentGateway = None,
+                  idempotency_key: Optional[str] = None) -> Tuple[bool, str, Optional[str]]:
     """
     Process payment for late fees using external payment gateway.
     
@@ -241,6 +703,8 @@ def pay_late_fees(patron_id: str, book_id: int, payment_gateway: PaymentGateway
         patron_id: 6-digit library card ID
         book_id: ID of the book with late fees
         payment_gateway: Payment gateway instance (injectable for testing)
+        idempotency_key: Client-chosen key; a repeated call with the same key
+            returns the recorded outcome without charging again
         
     Returns:
         tuple: (success: bool, message: str, transaction_id: Optional[str])
@@ -255,6 +719,12 @@ def pay_late_fees(patron_id: str, book_id: int, payment_gateway: PaymentGateway
     if not patron_id or not patron_id.isdigit() or len(patron_id) != 6:
         return False, "Invalid patron ID. Must be exactly 6 digits.", None
     
+    # A key that was already used is answered from the ledger
+    if idempotency_key:
+        payment = get_payment_by_key(idempotency_key)
+        if payment and not _can_retry_payment(payment):
+            return _replay_payment(payment, 'charge', patron_id)
+    
     # Calculate late fee first
     fee_info = calculate_late_fee_for_book(patron_id, book_id)
     
@@ -272,29 +742,68 @@ def pay_late_fees(patron_id: str, book_id: int, payment_gateway: PaymentGateway
     if not book:
         return False, "Book not found.", None
     
-    # Use provided gateway or create new one
-    if payment_gateway is None:
-        payment_gateway = PaymentGateway()
+    # The charge covers the patron's oldest active loan of this book, net of
+    # whatever was already paid on it (here or through pay_all_late_fees) and
+    # not refunded since
+    loan = next((loan for loan in get_patron_fee_loans(patron_id) if loan['book_id'] == book_id), None)
+    outstanding = round(fee_amount - loan['paid'], 2) if loan else fee_amount
+    if outstanding <= 0:
+        return False, "No late fees to pay for this book.", None
     
-    # Process payment through external gateway
-    # THIS IS WHAT YOU SHOULD MOCK IN THEIR TESTS!
-    try:
-        success, transaction_id, message = payment_gateway.process_payment(
-            patron_id=patron_id,
-            amount=fee_amount,
-            description=f"Late fees for '{book['title']}'"
-        )
+    return _charge_through_ledger(payment_gateway, idempotency_key, patron_id, outstanding,
+                                  f"Late fees for '{book['title']}'",
+                                  [(loan['record_id'], outstanding)] if loan else [])
+
+@query_budget(9, allow_repeats=True)
+def pay_all_late_fees(patron_id: str, payment_gateway: PaymentGateway = None,
+                      idempotency_key: Optional[str] = None) -> Tuple[bool, str, Optional[str]]:
+    """
+    Settle every outstanding late fee of a patron with a single charge.
+    
+    Outstanding fees for all active loans are read with one query (net of
+    anything already paid on each loan) and charged as one aggregated amount
+    with an itemized description. The loans the charge covers are recorded
+    with the payment, so they are not charged again.
+    
+    Args:
+        patron_id: 6-digit library card ID
+        payment_gateway: Payment gateway instance (injectable for testing)
+        idempotency_key: Client-chosen key; a repeated call with the same key
+            returns the recorded outcome without charging again
         
-        if success:
-            return True, f"Payment successful! {message}", transaction_id
-        else:
-            return False, f"Payment failed: {message}", None
-            
-    except Exception as e:
-        # Handle payment gateway errors
-        return False, f"Payment processing error: {str(e)}", None
+    Returns:
+        tuple: (success: bool, message: str, transaction_id: Optional[str])
+    """
+    # Validate patron ID
+    if not patron_id or not patron_id.isdigit() or len(patron_id) != 6:
+        return False, "Invalid patron ID. Must be exactly 6 digits.", None
+    
+    if idempotency_key:
+        payment = get_payment_by_key(idempotency_key)
+        if payment and not _can_retry_payment(payment):
+            return _replay_payment(payment, 'charge', patron_id)
+    
+    now = datetime.now()
+    items = []
+    for loan in get_patron_fee_loans(patron_id):
+        _days_overdue, fee_amount = compute_late_fee(loan['due_date'], now)
+        outstanding = round(fee_amount - loan['paid'], 2)
+        if outstanding > 0:
+            items.append((loan, outstanding))
+    
+    if not items:
+        return False, "No late fees to pay.", None
+    
+    total = round(sum(outstanding for _loan, outstanding in items), 2)
+    description = "Late fees: " + "; ".join(
+        f"'{loan['title']}' (${outstanding:.2f})" for loan, outstanding in items)
+    
+    return _charge_through_ledger(payment_gateway, idempotency_key, patron_id, total, description,
+                                  [(loan['record_id'], outstanding) for loan, outstanding in items])
 
-def refund_late_fee_payment(transaction_id: str, amount: float, payment_gateway: PaymentGateway = None) -> Tuple[bool, str]:
+@query_budget(8, allow_repeats=True)
+def refund_late_fee_payment(transaction_id: str, amount: float, payment_gateway: PaymentGateway = None,
+                            idempotency_key: Optional[str] = None) -> Tuple[bool, str]:
     """
     Refund a late fee payment (e.g., if book was returned on time but fees were charged in error).
     
@@ -304,6 +813,8 @@ def refund_late_fee_payment(transaction_id: str, amount: float, payment_gateway:
         transaction_id: Original transaction ID to refund
         amount: Amount to refund
         payment_gateway: Payment gateway instance (injectable for testing)
+        idempotency_key: Client-chosen key; a repeated call with the same key
+            returns the recorded outcome without refunding again
         
     Returns:
         tuple: (success: bool, message: str)
@@ -318,22 +829,58 @@ def refund_late_fee_payment(transaction_id: str, amount: float, payment_gateway:
     if amount > 15.00:  # Maximum late fee per book
         return False, "Refund amount exceeds maximum late fee."
     
-    # Use provided gateway or create new one
+    # Record the refund against the original charge before calling the gateway
+    charge = get_payment_by_transaction(transaction_id)
+    state, payment = begin_payment(idempotency_key or uuid.uuid4().hex, 'refund',
+                                   charge['patron_id'] if charge else '', amount,
+                                   f"Refund of {transaction_id}", transaction_id=transaction_id,
+                                   stale_before=_pending_cutoff())
+    if state == 'error':
+        return False, "Database error occurred while recording the refund."
+    if state == 'existing':
+        return _replay_payment(payment, 'refund', transaction_id)[:2]
+    
+    # Use provided gateway or the shared one
     if payment_gateway is None:
-        payment_gateway = PaymentGateway()
+        payment_gateway = get_payment_gateway()
     
     # Process refund through external gateway
     # THIS IS WHAT YOU SHOULD MOCK IN YOUR TESTS!
     try:
         success, message = payment_gateway.refund_payment(transaction_id, amount)
-        
-        if success:
-            return True, message
-        else:
-            return False, f"Refund failed: {message}"
-            
     except Exception as e:
-        return False, f"Refund processing error: {str(e)}"
+        message = f"Refund processing error: {str(e)}"
+        finish_payment(payment['id'], 'failed', message)
+        return False, message
+    
+    if not success:
+        message = f"Refund failed: {message}"
+        finish_payment(payment['id'], 'failed', message)
+        return False, message
     
+    finish_payment(payment['id'], 'completed', message)
+    return True, message
 
-       
+def get_payment_status(transaction_id: str, payment_gateway: PaymentGateway = None) -> Dict:
+    """
+    Look up the gateway status of a late fee payment.
+    
+    Args:
+        transaction_id: Transaction ID returned when the fee was paid
+        payment_gateway: Payment gateway instance (injectable for testing)
+        
+    Returns:
+        dict: The gateway's status information, or a 'status' of 'invalid'
+        or 'unavailable' with a message
+    """
+    if not transaction_id or not transaction_id.startswith("txn_"):
+        return {'status': 'invalid', 'message': "Invalid transaction ID."}
+    
+    # Use provided gateway or the shared one (cached and circuit-broken)
+    if payment_gateway is None:
+        payment_gateway = get_payment_gateway()
+    
+    try:
+        return payment_gateway.verify_payment_status(transaction_id)
+    except Exception as e:
+        return {'status': 'unavailable', 'message': f"Payment status check error: {str(e)}"}
@@ -4,131 +4,476 @@ This module simulates integration with an external payment processing API.
 
 For Assignment 3: You will learn to mock this service in their tests
 since we cannot make actual payment API calls during testing.
+
+When PAYMENT_GATEWAY_URL is set (e.g. to the local stand-in started with
+`python -m services.payment_stub_server`), calls go over HTTP through one
+shared, pooled session; otherwise the simulated gateway runs in-process.
+AsyncPaymentGateway offers the same calls as coroutines, plus a bounded
+concurrency fan-out, so many payments can be in flight at once.
+ResilientPaymentGateway (what get_payment_gateway hands out) adds a circuit
+breaker in front of every call and caches final payment statuses.
 """
 
-import requests
-from typing import Dict, Tuple
+import asyncio
+import os
+import threading
 import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from cache import TTLCache
+from services.payment_stub_server import (
+    SIMULATED_LATENCY, simulate_charge, simulate_refund, simulate_status
+)
+
+# Gateway configuration
+PAYMENT_GATEWAY_URL = os.environ.get('PAYMENT_GATEWAY_URL')  # None = in-process simulation
+PAYMENT_TIMEOUT = float(os.environ.get('PAYMENT_GATEWAY_TIMEOUT', 5.0))  # seconds per call
+PAYMENT_HTTP_POOL_SIZE = int(os.environ.get('PAYMENT_HTTP_POOL_SIZE', 32))  # kept-alive connections
+PAYMENT_MAX_CONCURRENCY = int(os.environ.get('PAYMENT_MAX_CONCURRENCY', 100))  # in-flight async calls
+PAYMENT_BREAKER_THRESHOLD = int(os.environ.get('PAYMENT_BREAKER_THRESHOLD', 5))  # consecutive errors that open the circuit
+PAYMENT_BREAKER_RESET_TIMEOUT = float(os.environ.get('PAYMENT_BREAKER_RESET_TIMEOUT', 30.0))  # seconds open before a trial call
+PAYMENT_STATUS_CACHE_SIZE = int(os.environ.get('PAYMENT_STATUS_CACHE_SIZE', 4096))
+PAYMENT_STATUS_CACHE_TTL = float(os.environ.get('PAYMENT_STATUS_CACHE_TTL', 3600.0))
+
+# Payment statuses that never change again, so lookups of them can be cached
+TERMINAL_PAYMENT_STATUSES = frozenset({'completed', 'failed', 'refunded', 'cancelled'})
+
+_session: Optional[requests.Session] = None
+_executor: Optional[ThreadPoolExecutor] = None
+_shared_lock = threading.Lock()
+
+def get_http_session() -> requests.Session:
+    """Get the process-wide HTTP session, whose connections are reused across calls."""
+    global _session
+    with _shared_lock:
+        if _session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=PAYMENT_HTTP_POOL_SIZE)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _session = session
+        return _session
+
+def _get_executor() -> ThreadPoolExecutor:
+    """Get the thread pool that runs blocking HTTP calls for AsyncPaymentGateway."""
+    global _executor
+    with _shared_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=PAYMENT_HTTP_POOL_SIZE,
+                                           thread_name_prefix='payment-gateway')
+        return _executor
 
 
 class PaymentGateway:
     """
     Simulates an external payment gateway API.
     In production, this would connect to services like Stripe, PayPal, etc.
-    
+
     For testing purposes, you should MOCK this class to avoid:
     - Making actual API calls
     - Depending on external service availability
     - Incurring costs or rate limits
     """
-    
-    def __init__(self, api_key: str = "test_key_12345"):
+
+    def __init__(self, api_key: str = "test_key_12345", base_url: Optional[str] = None,
+                 timeout: Optional[float] = None):
         """
         Initialize payment gateway with API credentials.
-        
+
         Args:
             api_key: API key for authentication (default is test key)
+            base_url: Gateway URL (default PAYMENT_GATEWAY_URL); None simulates in-process
+            timeout: Seconds before a call is abandoned (default PAYMENT_TIMEOUT)
         """
         self.api_key = api_key
-        self.base_url = "https://api.payment-gateway.example.com"
-    
+        self.base_url = (base_url or PAYMENT_GATEWAY_URL or '').rstrip('/') or None
+        self.timeout = PAYMENT_TIMEOUT if timeout is None else timeout
+
+    def _request(self, method: str, path: str, **kwargs) -> Dict:
+        """Send one request over the shared session and return the decoded JSON body."""
+        response = get_http_session().request(
+            method, f"{self.base_url}{path}",
+            headers={"Authorization": f"Bearer {self.api_key}"},
+            timeout=self.timeout, **kwargs
+        )
+        if response.status_code >= 500:
+            response.raise_for_status()
+        return response.json()
+
     def process_payment(self, patron_id: str, amount: float, description: str = "") -> Tuple[bool, str, str]:
         """
         Process a payment through the external gateway.
-        
+
         WARNING: This makes an actual HTTP request to external service.
         You should MOCK this method in tests!
-        
+
         Args:
             patron_id: 6-digit patron/customer ID
             amount: Payment amount in dollars
             description: Payment description
-            
+
         Returns:
             tuple: (success: bool, transaction_id: str, message: str)
-            
+
         Example:
             gateway = PaymentGateway()
             success, txn_id, msg = gateway.process_payment("123456", 10.50, "Late fees")
         """
-        # Simulate API call delay
-        time.sleep(0.5)
-        
-        # In a real implementation, this would make an HTTP request:
-        # response = requests.post(
-        #     f"{self.base_url}/charges",
-        #     headers={"Authorization": f"Bearer {self.api_key}"},
-        #     json={
-        #         "customer_id": patron_id,
-        #         "amount": amount,
-        #         "currency": "usd",
-        #         "description": description
-        #     }
-        # )
-        
-        # For this template, we simulate different scenarios based on amount
-        # This allows testing without a real API
-        
-        if amount <= 0:
-            return False, "", "Invalid amount: must be greater than 0"
-        
-        if amount > 1000:
-            return False, "", "Payment declined: amount exceeds limit"
-        
-        if len(patron_id) != 6:
-            return False, "", "Invalid patron ID format"
-        
-        # Simulate successful payment
-        transaction_id = f"txn_{patron_id}_{int(time.time())}"
-        return True, transaction_id, f"Payment of ${amount:.2f} processed successfully"
-    
+        if self.base_url is None:
+            # Simulate API call delay
+            time.sleep(SIMULATED_LATENCY['charge'])
+            return simulate_charge(patron_id, amount, description)
+
+        data = self._request('POST', '/charges', json={
+            "customer_id": patron_id,
+            "amount": amount,
+            "currency": "usd",
+            "description": description
+        })
+        return bool(data.get('success')), data.get('transaction_id') or "", data.get('message', '')
+
     def refund_payment(self, transaction_id: str, amount: float) -> Tuple[bool, str]:
         """
         Refund a previous payment.
-        
+
         WARNING: This makes an actual HTTP request to external service.
         You should MOCK this method in tests!
-        
+
         Args:
             transaction_id: Original transaction ID to refund
             amount: Amount to refund
-            
+
         Returns:
             tuple: (success: bool, message: str)
         """
-        time.sleep(0.5)
-        
-        if not transaction_id or not transaction_id.startswith("txn_"):
-            return False, "Invalid transaction ID"
-        
-        if amount <= 0:
-            return False, "Invalid refund amount"
-        
-        refund_id = f"refund_{transaction_id}_{int(time.time())}"
-        return True, f"Refund of ${amount:.2f} processed successfully. Refund ID: {refund_id}"
-    
+        if self.base_url is None:
+            time.sleep(SIMULATED_LATENCY['refund'])
+            return simulate_refund(transaction_id, amount)
+
+        data = self._request('POST', '/refunds', json={"transaction_id": transaction_id, "amount": amount})
+        return bool(data.get('success')), data.get('message', '')
+
     def verify_payment_status(self, transaction_id: str) -> Dict:
         """
         Check the status of a payment transaction.
-        
+
         WARNING: This makes an actual HTTP request to external service.
         You should MOCK this method in tests!
-        
+
         Args:
             transaction_id: Transaction ID to check
-            
+
         Returns:
             dict: Payment status information
         """
-        time.sleep(0.3)
-        
-        if not transaction_id or not transaction_id.startswith("txn_"):
-            return {"status": "not_found", "message": "Transaction not found"}
-        
-        # Simulate status check
-        return {
-            "transaction_id": transaction_id,
-            "status": "completed",
-            "amount": 10.50,
-            "timestamp": time.time()
-        }
\ No newline at end of file
+        if self.base_url is None:
+            time.sleep(SIMULATED_LATENCY['status'])
+            return simulate_status(transaction_id)
+
+        return self._request('GET', f'/charges/{transaction_id}')
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling the gateway while the circuit breaker is open."""
+
+
+class CircuitBreaker:
+    """
+    Fails calls fast while a dependency keeps erroring.
+
+    'closed': calls go through; failure_threshold consecutive exceptions
+    open the circuit. 'open': calls raise CircuitOpenError without being
+    attempted, until reset_timeout seconds have passed. 'half_open': one
+    trial call goes through (others are still rejected); its success closes
+    the circuit and its failure opens it again.
+    """
+
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+
+    def __init__(self, failure_threshold: int = PAYMENT_BREAKER_THRESHOLD,
+                 reset_timeout: float = PAYMENT_BREAKER_RESET_TIMEOUT,
+                 clock: Callable[[], float] = time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._clock = clock
+        self._lock = threading.Lock()
+        self.state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial_in_flight = False
+        self._stats = {'successes': 0, 'failures': 0, 'rejected': 0,
+                       'opened': 0, 'half_opened': 0, 'closed': 0}
+
+    def _before_call(self):
+        with self._lock:
+            if self.state == self.OPEN and self._clock() - self._opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                self._stats['half_opened'] += 1
+            if self.state == self.OPEN or (self.state == self.HALF_OPEN and self._trial_in_flight):
+                self._stats['rejected'] += 1
+                raise CircuitOpenError("Payment gateway unavailable (circuit open)")
+            if self.state == self.HALF_OPEN:
+                self._trial_in_flight = True
+
+    def _after_call(self, succeeded: bool):
+        with self._lock:
+            self._trial_in_flight = False
+            if succeeded:
+                self._stats['successes'] += 1
+                self._failures = 0
+                if self.state != self.CLOSED:
+                    self.state = self.CLOSED
+                    self._stats['closed'] += 1
+                return
+            self._stats['failures'] += 1
+            self._failures += 1
+            if self.state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    self._stats['opened'] += 1
+                self.state = self.OPEN
+                self._opened_at = self._clock()
+
+    def call(self, func: Callable, *args, **kwargs):
+        """Call func through the breaker; any exception it raises counts as a failure."""
+        self._before_call()
+        try:
+            result = func(*args, **kwargs)
+        except Exception:
+            self._after_call(False)
+            raise
+        self._after_call(True)
+        return result
+
+    async def call_async(self, func: Callable, *args, **kwargs):
+        """Await func(*args, **kwargs) through the breaker, like call()."""
+        self._before_call()
+        try:
+            result = await func(*args, **kwargs)
+        except asyncio.CancelledError:
+            # Not the gateway's fault, but a half-open trial must not stay claimed
+            with self._lock:
+                self._trial_in_flight = False
+            raise
+        except Exception:
+            self._after_call(False)
+            raise
+        self._after_call(True)
+        return result
+
+    def stats(self) -> Dict:
+        """Return the current state and a snapshot of the transition counters."""
+        with self._lock:
+            return dict(self._stats, state=self.state, consecutive_failures=self._failures,
+                        failure_threshold=self.failure_threshold, reset_timeout=self.reset_timeout)
+
+
+class ResilientPaymentGateway:
+    """
+    PaymentGateway wrapper that keeps callers from piling up on a slow or
+    failing gateway.
+
+    Every call goes through one CircuitBreaker. verify_payment_status also
+    caches statuses in TERMINAL_PAYMENT_STATUSES, and coalesces concurrent
+    lookups of the same transaction into one gateway call whose result (or
+    exception) all of them share. A refund turns 'completed' into 'refunded',
+    so refund_payment drops the transaction's cached status.
+    """
+
+    def __init__(self, gateway: Optional[PaymentGateway] = None,
+                 breaker: Optional[CircuitBreaker] = None,
+                 cache_size: int = PAYMENT_STATUS_CACHE_SIZE, cache_ttl: float = PAYMENT_STATUS_CACHE_TTL,
+                 clock: Callable[[], float] = time.monotonic):
+        self.gateway = gateway or PaymentGateway()
+        self.breaker = breaker or CircuitBreaker(clock=clock)
+        self.status_cache = TTLCache(cache_size, cache_ttl, clock)
+        self._in_flight: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+        self._stats = {'status_calls': 0, 'coalesced': 0}
+
+    @property
+    def api_key(self) -> str:
+        return self.gateway.api_key
+
+    @property
+    def base_url(self) -> Optional[str]:
+        return self.gateway.base_url
+
+    @property
+    def timeout(self) -> float:
+        return self.gateway.timeout
+
+    def process_payment(self, patron_id: str, amount: float, description: str = "") -> Tuple[bool, str, str]:
+        """PaymentGateway.process_payment behind the circuit breaker."""
+        return self.breaker.call(self.gateway.process_payment, patron_id, amount, description)
+
+    def refund_payment(self, transaction_id: str, amount: float) -> Tuple[bool, str]:
+        """PaymentGateway.refund_payment behind the circuit breaker; forgets the cached status."""
+        try:
+            return self.breaker.call(self.gateway.refund_payment, transaction_id, amount)
+        finally:
+            # Even a call that raised may have reached the gateway
+            self.status_cache.invalidate(transaction_id)
+
+    def verify_payment_status(self, transaction_id: str) -> Dict:
+        """PaymentGateway.verify_payment_status, cached and coalesced, behind the circuit breaker."""
+        status = self.status_cache.get(transaction_id)
+        if status is not None:
+            return dict(status)
+
+        with self._lock:
+            call = self._in_flight.get(transaction_id)
+            leader = call is None
+            if leader:
+                call = self._in_flight[transaction_id] = Future()
+                self._stats['status_calls'] += 1
+            else:
+                self._stats['coalesced'] += 1
+        if not leader:
+            return dict(call.result())
+
+        # A refund made while this lookup is in flight keeps its answer out of the cache
+        generation = self.status_cache.generation
+        try:
+            status = self.breaker.call(self.gateway.verify_payment_status, transaction_id)
+            if status.get('status') in TERMINAL_PAYMENT_STATUSES:
+                self.status_cache.set(transaction_id, status, generation)
+            call.set_result(status)
+            return dict(status)
+        except Exception as e:
+            call.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._in_flight.pop(transaction_id, None)
+
+    def stats(self) -> Dict:
+        """Return circuit breaker, status cache and coalescing counters."""
+        with self._lock:
+            calls = dict(self._stats)
+        return dict(calls, circuit=self.breaker.stats(), status_cache=self.status_cache.stats())
+
+
+_default_gateway: Optional[ResilientPaymentGateway] = None
+
+def get_payment_gateway() -> ResilientPaymentGateway:
+    """Get the shared gateway (a ResilientPaymentGateway) used when callers do not inject one."""
+    global _default_gateway
+    with _shared_lock:
+        if _default_gateway is None:
+            _default_gateway = ResilientPaymentGateway(PaymentGateway())
+        return _default_gateway
+
+def get_gateway_stats() -> Dict:
+    """Return the shared gateway's circuit breaker and status cache counters."""
+    return get_payment_gateway().stats()
+
+def reset_payment_clients():
+    """
+    Forget the process-wide HTTP session, thread pool and shared gateway; they
+    are created again on next use. Called in freshly forked worker processes,
+    which must not reuse the parent's sockets and have none of its threads.
+    """
+    global _session, _executor, _default_gateway
+    with _shared_lock:
+        _session = None
+        _executor = None
+        _default_gateway = None
+
+
+class AsyncPaymentGateway:
+    """
+    asyncio front end for a PaymentGateway.
+
+    Simulated calls wait with asyncio.sleep, so they hold no thread at all;
+    HTTP calls run on a shared thread pool over the pooled session. Either
+    way a call goes through a CircuitBreaker and is abandoned, as a failure,
+    after `timeout` seconds with asyncio.TimeoutError. Given a
+    ResilientPaymentGateway (the default), its breaker and status cache are
+    used, so sync and async calls share one circuit.
+    """
+
+    def __init__(self, gateway: Optional[PaymentGateway] = None, timeout: Optional[float] = None,
+                 max_concurrency: int = PAYMENT_MAX_CONCURRENCY, breaker: Optional[CircuitBreaker] = None):
+        self.gateway = gateway or get_payment_gateway()
+        self.timeout = self.gateway.timeout if timeout is None else timeout
+        self.max_concurrency = max_concurrency
+        if isinstance(self.gateway, ResilientPaymentGateway):
+            # Its breaker wraps the calls here, so they go to the gateway behind it
+            self.breaker = breaker or self.gateway.breaker
+            self.status_cache = self.gateway.status_cache
+            self._backend = self.gateway.gateway
+        else:
+            self.breaker = breaker or CircuitBreaker()
+            self.status_cache = None
+            self._backend = self.gateway
+
+    async def _call(self, kind: str, simulate, blocking, *args):
+        async def call():
+            if self.gateway.base_url is None:
+                await asyncio.sleep(SIMULATED_LATENCY[kind])
+                return simulate(*args)
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(_get_executor(), blocking, *args)
+
+        # The coroutine is only created once the breaker lets the call through
+        return await self.breaker.call_async(lambda: asyncio.wait_for(call(), self.timeout))
+
+    async def process_payment(self, patron_id: str, amount: float, description: str = "") -> Tuple[bool, str, str]:
+        """Coroutine version of PaymentGateway.process_payment."""
+        return await self._call('charge', simulate_charge, self._backend.process_payment,
+                                patron_id, amount, description)
+
+    async def refund_payment(self, transaction_id: str, amount: float) -> Tuple[bool, str]:
+        """Coroutine version of PaymentGateway.refund_payment; forgets the cached status."""
+        try:
+            return await self._call('refund', simulate_refund, self._backend.refund_payment,
+                                    transaction_id, amount)
+        finally:
+            if self.status_cache is not None:
+                self.status_cache.invalidate(transaction_id)
+
+    async def verify_payment_status(self, transaction_id: str) -> Dict:
+        """Coroutine version of PaymentGateway.verify_payment_status, using the status cache."""
+        if self.status_cache is None:
+            return await self._call('status', simulate_status, self._backend.verify_payment_status,
+                                    transaction_id)
+        status = self.status_cache.get(transaction_id)
+        if status is not None:
+            return dict(status)
+        generation = self.status_cache.generation
+        status = await self._call('status', simulate_status, self._backend.verify_payment_status,
+                                  transaction_id)
+        if status.get('status') in TERMINAL_PAYMENT_STATUSES:
+            self.status_cache.set(transaction_id, status, generation)
+        return dict(status)
+
+    async def process_payments(self, payments: Iterable[Dict]) -> List:
+        """
+        Charge many payments concurrently, at most max_concurrency at a time.
+
+        Args:
+            payments: Dicts with patron_id, amount and optional description
+
+        Returns:
+            list: One (success, transaction_id, message) tuple per payment, in
+            order; a payment whose call raised gets the exception instead
+        """
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        async def charge(payment):
+            async with semaphore:
+                return await self.process_payment(payment['patron_id'], payment['amount'],
+                                                  payment.get('description', ""))
+
+        return await asyncio.gather(*(charge(payment) for payment in payments), return_exceptions=True)
+
+
+def process_payments_concurrently(payments: Iterable[Dict], gateway: Optional[PaymentGateway] = None,
+                                  max_concurrency: int = PAYMENT_MAX_CONCURRENCY) -> List:
+    """Blocking helper: run AsyncPaymentGateway.process_payments on a fresh event loop."""
+    client = AsyncPaymentGateway(gateway, max_concurrency=max_concurrency)
+    return asyncio.run(client.process_payments(list(payments)))
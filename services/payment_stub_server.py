@@ -0,0 +1,124 @@
+"""
+Payment Stub Server - Local stand-in for the external payment gateway API
+
+Holds the simulated gateway behaviour (the same rules PaymentGateway used to
+apply in-process) and serves it over HTTP, so the real HTTP client path,
+connection reuse and timeouts can be exercised without a payment provider:
+
+    python -m services.payment_stub_server --port 5001
+    PAYMENT_GATEWAY_URL=http://localhost:5001 flask --app app run
+"""
+
+import argparse
+import time
+import uuid
+from typing import Dict, Tuple
+
+from flask import Flask, jsonify, request
+
+# Seconds each simulated call takes, mimicking the real provider's latency
+SIMULATED_LATENCY = {
+    'charge': 0.5,
+    'refund': 0.5,
+    'status': 0.3,
+}
+
+
+def simulate_charge(patron_id: str, amount: float, description: str = "") -> Tuple[bool, str, str]:
+    """
+    Simulated charge rules: declines invalid amounts, amounts over $1000 and
+    malformed patron IDs; anything else succeeds.
+
+    Returns:
+        tuple: (success: bool, transaction_id: str, message: str)
+    """
+    if amount <= 0:
+        return False, "", "Invalid amount: must be greater than 0"
+
+    if amount > 1000:
+        return False, "", "Payment declined: amount exceeds limit"
+
+    if len(patron_id) != 6:
+        return False, "", "Invalid patron ID format"
+
+    # The random suffix keeps two charges for one patron in the same second apart
+    transaction_id = f"txn_{patron_id}_{int(time.time())}_{uuid.uuid4().hex[:8]}"
+    return True, transaction_id, f"Payment of ${amount:.2f} processed successfully"
+
+def simulate_refund(transaction_id: str, amount: float) -> Tuple[bool, str]:
+    """
+    Simulated refund rules.
+
+    Returns:
+        tuple: (success: bool, message: str)
+    """
+    if not transaction_id or not transaction_id.startswith("txn_"):
+        return False, "Invalid transaction ID"
+
+    if amount <= 0:
+        return False, "Invalid refund amount"
+
+    refund_id = f"refund_{transaction_id}_{int(time.time())}"
+    return True, f"Refund of ${amount:.2f} processed successfully. Refund ID: {refund_id}"
+
+def simulate_status(transaction_id: str) -> Dict:
+    """Simulated payment status lookup."""
+    if not transaction_id or not transaction_id.startswith("txn_"):
+        return {"status": "not_found", "message": "Transaction not found"}
+
+    return {
+        "transaction_id": transaction_id,
+        "status": "completed",
+        "amount": 10.50,
+        "timestamp": time.time()
+    }
+
+
+def create_stub_app(latency_scale: float = 1.0) -> Flask:
+    """
+    Create the stand-in gateway as a Flask app.
+
+    Args:
+        latency_scale: Multiplier for SIMULATED_LATENCY (0 disables the delays)
+    """
+    app = Flask(__name__)
+
+    def wait(kind):
+        if latency_scale > 0:
+            time.sleep(SIMULATED_LATENCY[kind] * latency_scale)
+
+    @app.route('/charges', methods=['POST'])
+    def create_charge():
+        data = request.get_json(silent=True) or {}
+        wait('charge')
+        success, transaction_id, message = simulate_charge(
+            str(data.get('customer_id', '')), float(data.get('amount', 0)), data.get('description', ''))
+        return jsonify({'success': success, 'transaction_id': transaction_id, 'message': message}), \
+            200 if success else 402
+
+    @app.route('/refunds', methods=['POST'])
+    def create_refund():
+        data = request.get_json(silent=True) or {}
+        wait('refund')
+        success, message = simulate_refund(str(data.get('transaction_id', '')), float(data.get('amount', 0)))
+        return jsonify({'success': success, 'message': message}), 200 if success else 400
+
+    @app.route('/charges/<transaction_id>')
+    def get_charge(transaction_id):
+        wait('status')
+        return jsonify(simulate_status(transaction_id))
+
+    @app.route('/health')
+    def health():
+        return jsonify({'status': 'ok'})
+
+    return app
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5001)
+    parser.add_argument('--latency-scale', type=float, default=1.0)
+    args = parser.parse_args()
+    create_stub_app(args.latency_scale).run(host=args.host, port=args.port, threaded=True)
@@ -0,0 +1,25 @@
+import pytest
+
+import database
+from query_trace import enforce_query_budgets
+
+# Service functions fail their tests if they exceed their declared query budget
+enforce_query_budgets()
+
+
+@pytest.fixture
+def temp_db(tmp_path, monkeypatch):
+    """Point database.py at a fresh, seeded database file for one test."""
+    monkeypatch.setattr(database, 'DATABASE', str(tmp_path / 'library.db'))
+    database.init_database()
+    database.add_sample_data()
+    yield database.DATABASE
+    database.close_pool()
+
+
+@pytest.fixture
+def client(temp_db):
+    """Flask test client for an app backed by the temp_db database."""
+    from app import create_app
+    app = create_app({'DATABASE': temp_db, 'TESTING': True})
+    return app.test_client()
@@ -0,0 +1,80 @@
+import pytest
+
+import database
+from benchmarks import datagen
+from benchmarks.harness import compare, summarize
+from benchmarks.runner import run_benchmarks
+
+
+@pytest.fixture
+def tiny_scale(tmp_path, monkeypatch):
+    monkeypatch.setattr(database, 'DATABASE', database.DATABASE)
+    monkeypatch.setitem(datagen.SCALES, 'tiny', (200, 400))
+    yield str(tmp_path / 'data')
+    database.close_pool()
+
+def test_generated_data_is_consistent_and_reproducible(tmp_path, monkeypatch):
+    monkeypatch.setattr(database, 'DATABASE', database.DATABASE)
+    first = datagen.generate(str(tmp_path / 'a.db'), 100, 300, seed=1)
+    books = database.get_all_books()
+    second = datagen.generate(str(tmp_path / 'b.db'), 100, 300, seed=1)
+
+    assert first == second
+    assert first['active_loans'] > 0
+    assert [b['title'] for b in database.get_all_books()] == [b['title'] for b in books]
+
+    conn = database.get_db_connection()
+    try:
+        mismatched = conn.execute('''
+            SELECT COUNT(*) FROM books b
+            WHERE b.available_copies != b.total_copies - (
+                SELECT COUNT(*) FROM borrow_records br WHERE br.book_id = b.id AND br.return_date IS NULL)
+        ''').fetchone()[0]
+        most_active = conn.execute('SELECT MAX(active_loans) FROM patrons').fetchone()[0]
+    finally:
+        conn.close()
+    assert mismatched == 0
+    assert most_active <= 5
+    assert database.verify_patron_counters() == []
+    database.close_pool()
+
+def test_run_times_every_case(tiny_scale):
+    progress = []
+
+    results = run_benchmarks('tiny', iterations=5, warmup=1, data_dir=tiny_scale,
+                             progress=lambda name, summary: progress.append(name))
+
+    assert results['meta']['scale'] == 'tiny'
+    assert results['meta']['books'] == 200
+    assert 'service.borrow_book_by_patron' in results['results']
+    assert 'route.GET /api/search' in results['results']
+    assert progress == list(results['results'])
+    assert all(summary['iterations'] == 5 for summary in results['results'].values())
+
+    only = run_benchmarks('tiny', iterations=2, warmup=0, only=['service.search*'], data_dir=tiny_scale)
+    assert sorted(only['results']) == ['service.search_books_in_catalog.author',
+                                       'service.search_books_in_catalog.isbn',
+                                       'service.search_books_in_catalog.title']
+
+def test_summarize():
+    summary = summarize([0.001] * 94 + [0.002] * 5 + [0.010])
+
+    assert summary['iterations'] == 100
+    assert summary['median_ms'] == 1.0
+    assert summary['p95_ms'] == 2.0
+    assert summary['p99_ms'] == 2.0
+    assert summary['min_ms'] == 1.0
+
+def test_compare_flags_regressions_over_threshold():
+    baseline = {'results': {'a': {'median_ms': 1.0}, 'b': {'median_ms': 2.0},
+                            'c': {'median_ms': 4.0}, 'gone': {'median_ms': 1.0}}}
+    current = {'results': {'a': {'median_ms': 1.2}, 'b': {'median_ms': 3.0},
+                           'c': {'median_ms': 2.0}, 'added': {'median_ms': 1.0}}}
+
+    report = compare(current, baseline, threshold=0.25)
+
+    assert [entry['case'] for entry in report['regressions']] == ['b']
+    assert report['regressions'][0]['change'] == 0.5
+    assert [entry['case'] for entry in report['improvements']] == ['c']
+    assert [entry['case'] for entry in report['unchanged']] == ['a']
+    assert (report['new'], report['missing']) == (['added'], ['gone'])
@@ -0,0 +1,78 @@
+import database
+from cache import TTLCache
+from database import get_book_by_id, get_book_by_isbn, get_book_cache_stats, update_book_availability
+from services.library_service import borrow_book_by_patron
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_cache_evicts_least_recently_used():
+    """Test that a full cache evicts the entry used longest ago."""
+    cache = TTLCache(maxsize=2, ttl=60)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get('a')
+    cache.set('c', 3)
+
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert cache.stats()['evictions'] == 1
+
+def test_cache_entries_expire():
+    """Test that entries are not served after their TTL."""
+    clock = FakeClock()
+    cache = TTLCache(maxsize=10, ttl=5, clock=clock)
+    cache.set('a', 1)
+    clock.now = 4.9
+    assert cache.get('a') == 1
+    clock.now = 5.0
+
+    assert cache.get('a') is None
+    assert cache.stats()['expirations'] == 1
+
+def test_cache_rejects_value_read_before_invalidation():
+    """Test that a value read before a concurrent write is not stored."""
+    cache = TTLCache()
+    generation = cache.generation
+    cache.invalidate('a')
+
+    assert cache.set('a', 'stale', generation) is False
+    assert cache.get('a') is None
+
+def test_book_lookups_are_cached(temp_db):
+    """Test that repeated lookups by ID and ISBN are served from the cache."""
+    get_book_by_id(1)
+    before = get_book_cache_stats()
+    book = get_book_by_id(1)
+    by_isbn = get_book_by_isbn(book['isbn'])
+    by_isbn = get_book_by_isbn(book['isbn'])
+    after = get_book_cache_stats()
+
+    assert by_isbn == book
+    assert after['hits'] - before['hits'] == 3  # id, then isbn->id + id on the second ISBN lookup
+
+def test_availability_update_invalidates_cache(temp_db):
+    """Test that cached availability is dropped when copies change."""
+    assert get_book_by_id(1)['available_copies'] == 3
+    update_book_availability(1, -1)
+
+    assert get_book_by_id(1)['available_copies'] == 2
+
+def test_borrow_is_not_fooled_by_cached_availability(temp_db):
+    """Test that the borrow path re-reads availability instead of trusting the cache."""
+    assert get_book_by_id(2)['available_copies'] == 2
+    conn = database.get_db_connection()
+    conn.execute('UPDATE books SET available_copies = 0 WHERE id = 2')  # bypasses invalidation
+    conn.commit()
+    conn.close()
+
+    success, message = borrow_book_by_patron("333333", 2)
+
+    assert success is False
+    assert "not available" in message
@@ -0,0 +1,76 @@
+import io
+import json
+
+import database
+from services.catalog_import import import_books
+
+
+def test_import_books_from_csv(temp_db):
+    """Test importing valid CSV rows in several chunks."""
+    lines = ["title,author,isbn,total_copies"]
+    lines += [f"Imported Book {i},Author {i},{7770000000000 + i},{i % 3 + 1}" for i in range(25)]
+
+    report = import_books(io.StringIO("\n".join(lines)), 'csv', chunk_size=10)
+
+    assert report == {'rows': 25, 'imported': 25, 'failed': 0, 'errors': []}
+    book = database.get_book_by_isbn("7770000000004")
+    assert book['title'] == "Imported Book 4"
+    assert book['available_copies'] == book['total_copies'] == 2
+
+def test_import_books_reports_row_errors(temp_db):
+    """Test that invalid and duplicate rows are reported with their line numbers."""
+    csv_text = "\n".join([
+        "title,author,isbn,total_copies",
+        "Good Book,Author,7771111111111,1",
+        ",Author,7771111111112,1",
+        "Bad Copies,Author,7771111111113,zero",
+        "Duplicate,Author,7771111111111,1",
+        "Already There,Author,9780743273565,1",
+        "Short ISBN,Author,123,1",
+    ])
+
+    report = import_books(io.StringIO(csv_text), 'csv')
+
+    assert report['imported'] == 1
+    assert report['failed'] == 5
+    assert [(e['line'], e['message']) for e in report['errors']] == [
+        (3, "Title is required."),
+        (4, "Total copies must be a positive integer."),
+        (5, "Duplicate ISBN in import file."),
+        (6, "A book with this ISBN already exists."),
+        (7, "ISBN must be exactly 13 digits."),
+    ]
+
+def test_import_books_detects_duplicates_across_chunks(temp_db):
+    """Test that an ISBN repeated in a later chunk is rejected against the database."""
+    rows = [{'title': f"Book {i}", 'author': "Author", 'isbn': "7772222222222", 'total_copies': 1}
+            for i in range(3)]
+    jsonl = "\n".join(json.dumps(row) for row in rows) + "\nnot json\n"
+
+    report = import_books(io.StringIO(jsonl), 'jsonl', chunk_size=1)
+
+    assert report['imported'] == 1
+    assert [e['line'] for e in report['errors']] == [2, 3, 4]
+    assert report['errors'][-1]['message'] == "Row is not a valid JSON object."
+
+def test_import_books_caps_reported_errors(temp_db):
+    """Test that the error list is bounded while failures are still counted."""
+    jsonl = "\n".join(json.dumps({'title': '', 'isbn': str(i)}) for i in range(20))
+
+    report = import_books(io.StringIO(jsonl), 'jsonl', error_limit=5)
+
+    assert report['failed'] == 20
+    assert len(report['errors']) == 5
+
+def test_import_books_cli(temp_db, tmp_path):
+    """Test the import-books CLI command end to end."""
+    from app import create_app
+    path = tmp_path / "books.jsonl"
+    path.write_text(json.dumps({'title': "CLI Book", 'author': "Author",
+                                'isbn': "7773333333333", 'total_copies': 2}) + "\n")
+    app = create_app({'DATABASE': temp_db, 'TESTING': True})
+
+    result = app.test_cli_runner().invoke(args=['import-books', str(path)])
+
+    assert "Imported 1 of 1 rows; 0 failed." in result.output
+    assert database.get_book_by_isbn("7773333333333")['title'] == "CLI Book"
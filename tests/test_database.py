@@ -0,0 +1,275 @@
+import threading
+from datetime import datetime, timedelta
+
+import pytest
+
+import database
+from database import (
+    ConnectionPool, borrow_book_transaction, get_book_by_id, get_db_connection, get_pool_stats
+)
+from services.library_service import MAX_BORROWED_BOOKS, add_book_to_catalog, borrow_book_by_patron
+
+
+def test_connection_is_reused_from_pool(temp_db):
+    """Test that helpers hand their connection back to the pool for reuse."""
+    get_book_by_id(1)
+    before = get_pool_stats()
+    get_book_by_id(2)
+    after = get_pool_stats()
+
+    assert after['hits'] == before['hits'] + 1
+    assert after['misses'] == before['misses']
+    assert after['in_use'] == 0
+
+def test_pool_never_exceeds_size(tmp_path):
+    """Test that a full pool makes callers wait instead of opening more connections."""
+    pool = ConnectionPool(str(tmp_path / 'pool.db'), size=2, timeout=1.0)
+    first = pool.acquire()
+    second = pool.acquire()
+
+    threading.Timer(0.05, first.close).start()
+    third = pool.acquire()
+
+    stats = pool.stats()
+    assert stats['open'] == 2
+    assert stats['waits'] == 1
+    assert stats['high_water'] == 2
+    second.close()
+    third.close()
+    pool.close()
+
+def test_pool_times_out_when_exhausted(tmp_path):
+    """Test that waiting for a connection gives up after the pool timeout."""
+    pool = ConnectionPool(str(tmp_path / 'pool.db'), size=1, timeout=0.01)
+    conn = pool.acquire()
+
+    with pytest.raises(Exception, match="Timed out"):
+        pool.acquire()
+
+    assert pool.stats()['timeouts'] == 1
+    conn.close()
+    pool.close()
+
+def test_pool_discards_unhealthy_connection(tmp_path):
+    """Test that a broken idle connection is replaced on checkout."""
+    pool = ConnectionPool(str(tmp_path / 'pool.db'), size=1)
+    conn = pool.acquire()
+    raw = conn._conn
+    conn.close()
+    raw.close()  # simulate a connection that died while idle
+
+    conn = pool.acquire()
+    assert conn.execute('SELECT 1').fetchone()[0] == 1
+    assert pool.stats()['discarded'] == 1
+    conn.close()
+    pool.close()
+
+def test_release_rolls_back_open_transaction(temp_db):
+    """Test that uncommitted work is not leaked to the next borrower of a connection."""
+    conn = get_db_connection()
+    conn.execute('UPDATE books SET available_copies = 99 WHERE id = 1')
+    conn.close()
+
+    assert get_book_by_id(1)['available_copies'] == 3
+
+def test_pool_follows_database_setting(temp_db, tmp_path, monkeypatch):
+    """Test that changing DATABASE switches helpers to a new pool."""
+    old_pool = database.get_pool()
+    monkeypatch.setattr(database, 'DATABASE', str(tmp_path / 'other.db'))
+
+    assert database.get_pool() is not old_pool
+    assert database.get_pool().database == str(tmp_path / 'other.db')
+
+def test_borrow_transaction_never_oversells(temp_db):
+    """Test that concurrent borrows of the last copy let exactly one patron win."""
+    database.update_book_availability(2, -1)  # leave one copy of book 2
+    now = datetime.now()
+    results = []
+
+    def borrow(patron_id):
+        status, _ = borrow_book_transaction(patron_id, 2, now, now + timedelta(days=14), 5)
+        results.append(status)
+
+    threads = [threading.Thread(target=borrow, args=(f"{100000 + i}",)) for i in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert results.count('success') == 1
+    assert results.count('unavailable') == 7
+    assert get_book_by_id(2)['available_copies'] == 0
+
+def test_borrow_book_enforces_limit(temp_db):
+    """Test that a patron cannot hold more than the maximum number of books."""
+    for i in range(MAX_BORROWED_BOOKS + 1):
+        add_book_to_catalog(f"Limit Book {i}", "Author", f"{5550000000000 + i}", 1)
+    books = [b for b in database.get_all_books() if b['title'].startswith("Limit Book")]
+
+    outcomes = [borrow_book_by_patron("222222", book['id'])[0] for book in books]
+
+    assert outcomes == [True] * MAX_BORROWED_BOOKS + [False]
+    assert database.get_patron_borrow_count("222222") == MAX_BORROWED_BOOKS
+
+def test_connections_use_wal_and_configured_pragmas(temp_db):
+    """Test that pooled connections are opened with the tuned pragmas."""
+    conn = get_db_connection()
+    try:
+        assert conn.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+        assert conn.execute('PRAGMA synchronous').fetchone()[0] == 1  # NORMAL
+        assert conn.execute('PRAGMA busy_timeout').fetchone()[0] == 5000
+    finally:
+        conn.close()
+
+def test_readers_do_not_wait_on_writer(temp_db):
+    """Test that a catalog read succeeds while another connection holds the write lock."""
+    writer = get_db_connection()
+    try:
+        writer.execute('BEGIN IMMEDIATE')
+        writer.execute('UPDATE books SET available_copies = 0 WHERE id = 1')
+
+        assert get_book_by_id(1)['available_copies'] == 3
+    finally:
+        writer.close()
+
+def test_configure_database_switches_path(tmp_path, monkeypatch):
+    """Test that configure_database points helpers at a new file."""
+    monkeypatch.setattr(database, 'DATABASE', database.DATABASE)
+    monkeypatch.setattr(database, 'SQLITE_PRAGMAS', dict(database.SQLITE_PRAGMAS))
+    path = str(tmp_path / 'data' / 'configured.db')
+
+    database.configure_database(database=path, pragmas={'cache_size': -2000})
+    database.init_database()
+
+    conn = get_db_connection()
+    try:
+        assert conn.execute('PRAGMA cache_size').fetchone()[0] == -2000
+    finally:
+        conn.close()
+    assert get_pool_stats()['size'] == database.POOL_SIZE
+    assert database.get_pool().database == path
+    database.close_pool()
+
+def test_migrations_are_applied_once(temp_db):
+    """Test that init_database records the schema version and is idempotent."""
+    conn = get_db_connection()
+    try:
+        assert database.get_schema_version(conn) == len(database.SCHEMA_MIGRATIONS)
+        assert database.migrate_database(conn) == 0
+    finally:
+        conn.close()
+
+def test_init_database_builds_missing_search_index(temp_db):
+    """Test that a database migrated without FTS5 gets its search index on a later start."""
+    conn = get_db_connection()
+    try:
+        for trigger in ('books_fts_insert', 'books_fts_delete', 'books_fts_update'):
+            conn.execute(f'DROP TRIGGER {trigger}')
+        conn.execute('DROP TABLE books_fts')
+        conn.commit()
+    finally:
+        conn.close()
+    assert [b['title'] for b in database.search_books('atsby', 'title', 10)] == ['The Great Gatsby']
+
+    database.init_database()
+    add_book_to_catalog("Gatsby Revisited", "A. Critic", "9990000000001", 1)
+
+    assert [b['title'] for b in database.search_books('atsby', 'title', 10)] == []
+    assert sorted(b['title'] for b in database.search_books('gats', 'title', 10)) == \
+        ['Gatsby Revisited', 'The Great Gatsby']
+
+@pytest.mark.parametrize("sql, params, index", [
+    ('''SELECT br.*, b.title, b.author FROM borrow_records br JOIN books b ON br.book_id = b.id
+        WHERE br.patron_id = ? AND br.return_date IS NULL ORDER BY br.borrow_date''',
+     ('123456',), 'idx_borrow_records_patron'),
+    ('''SELECT COUNT(*) as count FROM borrow_records
+        WHERE patron_id = ? AND return_date IS NULL''',
+     ('123456',), 'idx_borrow_records_patron'),
+    ('''SELECT br.id, br.book_id, br.borrow_date, br.due_date, br.return_date, b.title, b.author
+        FROM borrow_records br JOIN books b ON br.book_id = b.id
+        WHERE br.patron_id = ? ORDER BY br.borrow_date''',
+     ('123456',), 'idx_borrow_records_patron'),
+    ('''UPDATE borrow_records SET return_date = ?
+        WHERE patron_id = ? AND book_id = ? AND return_date IS NULL''',
+     ('2024-01-01', '123456', 3), 'idx_borrow_records_'),
+    ('''SELECT br.id, br.borrow_date, br.due_date, b.title FROM borrow_records br
+        JOIN books b ON br.book_id = b.id
+        WHERE br.patron_id = ? AND br.book_id = ? AND br.return_date IS NULL
+        ORDER BY br.borrow_date LIMIT 1''',
+     ('123456', 3), 'idx_borrow_records_'),
+    ('''SELECT * FROM borrow_records WHERE book_id = ? AND return_date IS NULL''',
+     (3,), 'idx_borrow_records_book_active'),
+    ('''SELECT * FROM borrow_records WHERE return_date IS NULL AND due_date < ? ORDER BY due_date''',
+     ('2024-01-01',), 'idx_borrow_records_due_active'),
+    ('''SELECT br.id, br.patron_id, br.book_id, b.title, br.due_date
+        FROM borrow_records br JOIN books b ON br.book_id = b.id
+        WHERE br.return_date IS NULL AND br.due_date < ? AND (br.due_date, br.id) > (?, ?)
+        ORDER BY br.due_date, br.id LIMIT ?''',
+     ('2024-01-01', '2023-06-01', 7, 1000), 'idx_borrow_records_due_active'),
+    ('''SELECT * FROM payments WHERE idempotency_key = ?''',
+     ('key-1',), 'idx_payments_idempotency_key'),
+    ("""SELECT * FROM payments
+        WHERE transaction_id = ? AND kind = 'charge' AND status = 'completed'""",
+     ('txn_123',), 'idx_payments_transaction'),
+])
+def test_hot_queries_use_indexes(temp_db, sql, params, index):
+    """Test that the hot borrow_records queries are index lookups, not table scans."""
+    plan = database.explain_query_plan(sql, params)
+
+    assert any(index in step for step in plan), plan
+    assert not any(step.startswith('SCAN br') or step.startswith('SCAN borrow_records')
+                   or step.startswith('SCAN payments') for step in plan), plan
+
+def test_patron_counters_follow_loans_and_payments(temp_db):
+    """Test that the triggers keep a patron's counters in step with every write."""
+    assert database.get_patron_counters("123456")['active_loans'] == 1  # backfilled sample loan
+
+    now = datetime.now()
+    borrow_book_transaction("333333", 1, now, now + timedelta(days=14), MAX_BORROWED_BOOKS)
+    borrow_book_transaction("333333", 2, now, now + timedelta(days=14), MAX_BORROWED_BOOKS)
+    database.update_borrow_record_return_date("333333", 1, now)
+    state, payment = database.begin_payment("key-1", 'charge', "333333", 4.5, "Late fees")
+    assert database.get_patron_counters("333333")['fees_paid'] == 0
+    database.finish_payment(payment['id'], 'completed', "Payment successful!", "txn_1")
+
+    assert database.get_patron_counters("333333") == {
+        'patron_id': "333333", 'active_loans': 1, 'total_loans': 2, 'fees_paid': 4.5}
+    assert database.get_patron_borrow_count("333333") == 1
+    assert database.verify_patron_counters() == []
+
+def test_patron_counters_verify_and_rebuild(temp_db):
+    """Test that drift is reported and repaired by a rebuild."""
+    conn = get_db_connection()
+    conn.execute("UPDATE patrons SET active_loans = 4 WHERE patron_id = '123456'")
+    conn.execute("INSERT INTO patrons (patron_id, active_loans) VALUES ('999999', 2)")
+    conn.commit()
+    conn.close()
+
+    drift = database.verify_patron_counters()
+
+    assert sorted((d['patron_id'], d['stored'][0], d['actual'][0]) for d in drift) == \
+        [('123456', 4, 1), ('999999', 2, 0)]
+    assert database.rebuild_patron_counters() == 1
+    assert database.verify_patron_counters() == []
+    assert database.get_patron_borrow_count("999999") == 0
+
+def test_borrow_limit_check_is_a_primary_key_read(temp_db):
+    """Test that the limit check reads the patron's counters by primary key."""
+    plan = database.explain_query_plan('SELECT active_loans FROM patrons WHERE patron_id = ?', ('123456',))
+
+    assert plan == ['SEARCH patrons USING PRIMARY KEY (patron_id=?)']
+
+def test_patrons_cli(temp_db):
+    """Test the patrons verify/rebuild CLI commands."""
+    from app import create_app
+    runner = create_app({'DATABASE': temp_db, 'TESTING': True}).test_cli_runner()
+    conn = get_db_connection()
+    conn.execute("UPDATE patrons SET total_loans = 7")
+    conn.commit()
+    conn.close()
+
+    assert runner.invoke(args=['patrons', 'verify']).exit_code == 1
+    assert "Rebuilt counters for 1 patrons." in runner.invoke(args=['patrons', 'rebuild']).output
+    result = runner.invoke(args=['patrons', 'verify'])
+    assert result.exit_code == 0
+    assert "0 patrons with drifted counters." in result.output
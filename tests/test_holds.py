@@ -0,0 +1,126 @@
+from datetime import datetime, timedelta
+
+import database
+from services.library_service import (
+    borrow_book_by_patron, cancel_hold, expire_holds, get_patron_holds_and_notifications,
+    place_hold, return_book_by_patron, return_books_by_patrons
+)
+
+
+def test_returned_copy_goes_to_oldest_hold(temp_db):
+    """Test that a returned copy is set aside for the first patron in line, not shelved."""
+    assert place_hold("111111", 3) == (True, 'Hold placed on "1984". You are number 1 in line.')
+    assert place_hold("222222", 3)[1].endswith("You are number 2 in line.")
+
+    success, _ = return_book_by_patron("123456", 3)
+
+    assert success
+    assert database.get_book_by_id(3)['available_copies'] == 0
+    first = get_patron_holds_and_notifications("111111")
+    assert first['holds'][0]['status'] == 'ready'
+    assert first['notifications'][0]['kind'] == 'hold_ready'
+    assert first['notifications'][0]['message'].startswith('Your hold on "1984" is ready.')
+    second = get_patron_holds_and_notifications("222222")
+    assert second['holds'][0]['status'] == 'waiting'
+    assert second['holds'][0]['position'] == 1
+    assert second['notifications'] == []
+
+def test_ready_hold_is_collected_by_borrowing(temp_db):
+    """Test that only the holder can borrow the set-aside copy, fulfilling the hold."""
+    place_hold("111111", 3)
+    return_book_by_patron("123456", 3)
+
+    assert borrow_book_by_patron("222222", 3) == (False, "This book is currently not available.")
+    assert borrow_book_by_patron("111111", 3)[0]
+
+    assert get_patron_holds_and_notifications("111111")['holds'][0]['status'] == 'fulfilled'
+    assert database.get_book_by_id(3)['available_copies'] == 0
+
+def test_place_hold_rejections(temp_db):
+    """Test that holds are only placed on unavailable books the patron does not have."""
+    assert place_hold("12345", 3) == (False, "Invalid patron ID. Must be exactly 6 digits.")
+    assert place_hold("111111", 999) == (False, "Book not found.")
+    assert place_hold("111111", 1)[1].startswith("This book is available now")
+    assert place_hold("123456", 3) == (False, "You already have this book borrowed.")
+    place_hold("111111", 3)
+    assert place_hold("111111", 3) == (False, "You already have a hold on this book.")
+
+def test_cancelled_ready_hold_passes_copy_on(temp_db):
+    """Test that cancelling a ready hold readies the next one, then the shelf gets the copy."""
+    place_hold("111111", 3)
+    place_hold("222222", 3)
+    return_book_by_patron("123456", 3)
+    first_hold = get_patron_holds_and_notifications("111111")['holds'][0]['id']
+    second_hold = get_patron_holds_and_notifications("222222")['holds'][0]['id']
+
+    assert cancel_hold("222222", first_hold) == (False, "No active hold found for this patron.")
+    assert cancel_hold("111111", first_hold) == (True, "Hold cancelled.")
+    assert get_patron_holds_and_notifications("222222")['holds'][0]['status'] == 'ready'
+
+    cancel_hold("222222", second_hold)
+    assert database.get_book_by_id(3)['available_copies'] == 1
+
+def test_uncollected_holds_expire(temp_db):
+    """Test that ready holds past their pickup date expire and free the copy."""
+    place_hold("111111", 3)
+    return_book_by_patron("123456", 3)
+
+    assert expire_holds() == 0
+    assert expire_holds(datetime.now() + timedelta(days=8)) == 1
+    assert get_patron_holds_and_notifications("111111")['holds'][0]['status'] == 'expired'
+    assert database.get_book_by_id(3)['available_copies'] == 1
+
+def test_batch_return_fills_holds_in_order(temp_db):
+    """Test that batch check-in hands each returned copy to the next waiting hold."""
+    now = datetime.now()
+    database.insert_borrow_record("444444", 2, now, now + timedelta(days=14))
+    database.insert_borrow_record("555555", 2, now, now + timedelta(days=14))
+    database.update_book_availability(2, -2)
+    place_hold("111111", 2)
+    place_hold("222222", 2)
+    place_hold("333333", 2)
+
+    result = return_books_by_patrons([("444444", 2), ("555555", 2)])
+
+    assert result['returned'] == 2
+    assert [get_patron_holds_and_notifications(p)['holds'][0]['status']
+            for p in ("111111", "222222", "333333")] == ['ready', 'ready', 'waiting']
+    assert database.get_book_by_id(2)['available_copies'] == 0
+
+def test_next_in_line_lookup_uses_index(temp_db):
+    """Test that finding the next waiting hold is an index search, not a scan or sort."""
+    plan = database.explain_query_plan('''
+        SELECT id, patron_id FROM holds WHERE book_id = ? AND status = 'waiting'
+        ORDER BY created_at, id LIMIT 1
+    ''', (3,))
+
+    assert any('idx_holds_waiting' in step for step in plan), plan
+    assert not any(step.startswith('SCAN') or 'TEMP B-TREE' in step for step in plan), plan
+
+def test_holds_api(client):
+    """Test placing, listing and cancelling holds through the API."""
+    response = client.post('/api/holds', json={'patron_id': "111111", 'book_id': 3})
+    assert response.status_code == 201
+    assert client.post('/api/holds', json={'patron_id': "111111", 'book_id': 3}).status_code == 400
+    assert client.post('/api/holds', data="nope").status_code == 400
+
+    holds = client.get('/api/patrons/111111/holds').get_json()['holds']
+    assert [(h['book_id'], h['status'], h['position']) for h in holds] == [(3, 'waiting', 1)]
+
+    assert client.delete(f"/api/holds/{holds[0]['id']}?patron_id=222222").status_code == 404
+    assert client.delete(f"/api/holds/{holds[0]['id']}?patron_id=111111").status_code == 200
+    assert client.get('/api/patrons/111111/holds').get_json()['holds'][0]['status'] == 'cancelled'
+
+def test_hold_form(client):
+    """Test the catalog's Place Hold form."""
+    response = client.post('/hold', data={'patron_id': "111111", 'book_id': "3"}, follow_redirects=True)
+
+    assert response.status_code == 200
+    assert b"You are number 1 in line." in response.data
+
+def test_holds_expire_cli(temp_db):
+    """Test the holds expire CLI command."""
+    from app import create_app
+    runner = create_app({'DATABASE': temp_db, 'TESTING': True}).test_cli_runner()
+
+    assert "Expired 0 holds." in runner.invoke(args=['holds', 'expire']).output
@@ -0,0 +1,93 @@
+import os
+
+import pytest
+
+import database
+import instrumentation
+from instrumentation import Histogram, metrics
+
+
+@pytest.fixture
+def instrumented_client(temp_db):
+    from app import create_app
+    metrics.reset()
+    app = create_app({'DATABASE': temp_db, 'TESTING': True, 'INSTRUMENTATION': True})
+    yield app.test_client()
+    metrics.reset()
+
+def _sample(text, line_start):
+    return next(float(line.rsplit(' ', 1)[1]) for line in text.splitlines() if line.startswith(line_start))
+
+def test_histogram_buckets_are_cumulative():
+    histogram = Histogram((0.1, 1.0))
+    for value in (0.05, 0.1, 0.5, 3.0):
+        histogram.observe(value)
+
+    buckets, count, total = histogram.snapshot()
+
+    assert buckets == [(0.1, 2), (1.0, 3), (float('inf'), 4)]
+    assert count == 4
+    assert total == pytest.approx(3.65)
+
+def test_request_latency_and_sql_are_recorded(instrumented_client):
+    instrumented_client.get('/api/catalog')
+    instrumented_client.get('/api/catalog')
+    instrumented_client.get('/api/late_fee/123456/999')
+
+    text = instrumented_client.get('/metrics').get_data(as_text=True)
+
+    assert 'library_http_requests_total{method="GET",route="/api/catalog",status="200"} 2' in text
+    assert _sample(text, 'library_http_request_duration_seconds_count{method="GET",route="/api/catalog"}') == 2
+    assert _sample(text, 'library_http_request_sql_queries_sum{method="GET",route="/api/catalog"}') >= 2
+    assert _sample(text, 'library_http_request_sql_seconds_total{method="GET",route="/api/catalog"}') > 0
+    assert 'route="/api/late_fee/<patron_id>/<int:book_id>"' in text
+    assert '# TYPE library_http_request_duration_seconds histogram' in text
+
+def test_metrics_include_pool_cache_and_gateway_stats(client):
+    text = client.get('/metrics').get_data(as_text=True)
+
+    assert '# TYPE library_db_pool_hits_total counter' in text
+    assert '# TYPE library_db_pool_in_use gauge' in text
+    assert 'library_book_cache_hits_total' in text
+    assert 'library_payment_circuit_state{state="closed"} 1' in text
+    assert 'library_payment_status_cache_size' in text
+    # Request metrics are only kept when instrumentation is enabled
+    assert 'library_http_requests_total{' not in text
+
+def test_disabled_instrumentation_installs_no_hooks(client, monkeypatch):
+    monkeypatch.setattr('query_trace.ENFORCE_QUERY_BUDGETS', False)
+    client.get('/api/catalog')
+
+    assert database._query_listeners == ()
+    assert client.application.before_request_funcs.get(None, []) == []
+
+def test_slow_sampled_requests_are_profiled(instrumented_client, tmp_path, monkeypatch):
+    monkeypatch.setattr(instrumentation, 'PROFILE_SAMPLE_RATE', 1.0)
+    monkeypatch.setattr(instrumentation, 'PROFILE_DIR', str(tmp_path / 'profiles'))
+    monkeypatch.setattr(instrumentation, 'SLOW_REQUEST_SECONDS', 0.0)
+
+    instrumented_client.get('/api/catalog')
+
+    dumps = list((tmp_path / 'profiles').iterdir())
+    assert len(dumps) == 1
+    assert dumps[0].name.startswith('api_catalog-')
+    assert metrics.profiles_written == 1
+    assert not instrumentation._profile_lock.locked()
+
+def test_metrics_are_merged_across_worker_processes(instrumented_client, tmp_path, monkeypatch):
+    monkeypatch.setattr(instrumentation, 'METRICS_DIR', str(tmp_path))
+    instrumented_client.get('/api/catalog')
+    instrumentation.write_process_metrics(pid=111)  # another worker that served the same request
+
+    text = instrumented_client.get('/metrics').get_data(as_text=True)
+
+    assert 'library_http_requests_total{method="GET",route="/api/catalog",status="200"} 2' in text
+    assert _sample(text, 'library_http_request_duration_seconds_count{method="GET",route="/api/catalog"}') == 2
+    assert 'library_book_cache_maxsize{pid="111"}' in text
+    assert f'library_book_cache_maxsize{{pid="{os.getpid()}"}}' in text
+
+    instrumentation.mark_process_dead(111)
+    text = instrumented_client.get('/metrics').get_data(as_text=True)
+
+    assert 'library_http_requests_total{method="GET",route="/api/catalog",status="200"} 2' in text
+    assert 'pid="111"' not in text
@@ -0,0 +1,191 @@
+import time
+from datetime import datetime, timedelta
+
+import pytest
+
+import database
+from services import job_queue
+from services.job_queue import submit_job, run_pending_jobs, get_job_status, stop_job_worker, JobWorker
+from services.payment_service import PaymentGateway
+
+
+@pytest.fixture
+def gateway(temp_db, mocker):
+    mock_gateway = mocker.Mock(spec=PaymentGateway)
+    mock_gateway.process_payment.return_value = (True, "txn_777", "Success")
+    mocker.patch("services.library_service.get_payment_gateway", return_value=mock_gateway)
+    return mock_gateway
+
+def _add_overdue_loan(patron_id, book_id, days_overdue):
+    conn = database.get_db_connection()
+    due = datetime.now() - timedelta(days=days_overdue)
+    conn.execute('''
+        INSERT INTO borrow_records (patron_id, book_id, borrow_date, due_date)
+        VALUES (?, ?, ?, ?)
+    ''', (patron_id, book_id, (due - timedelta(days=14)).isoformat(), due.isoformat()))
+    conn.commit()
+    conn.close()
+
+def test_payment_job_succeeds(gateway):
+    _add_overdue_loan("777777", 1, 4)
+    job_id = submit_job('pay_late_fees', {'patron_id': "777777", 'book_id': 1})
+
+    assert get_job_status(job_id)['status'] == 'queued'
+    assert run_pending_jobs() == 1
+
+    job = get_job_status(job_id)
+    assert job['status'] == 'succeeded'
+    assert job['attempts'] == 1
+    assert job['result'] == {'success': True, 'message': "Payment successful! Success",
+                             'transaction_id': "txn_777"}
+    # The job's charge is in the ledger under the job's own idempotency key
+    assert database.get_payment_by_key(f"job-{job_id}")['status'] == 'completed'
+
+def test_declined_payment_is_not_retried(gateway):
+    _add_overdue_loan("777777", 1, 4)
+    gateway.process_payment.return_value = (False, None, "Card declined")
+    job_id = submit_job('pay_late_fees', {'patron_id': "777777", 'book_id': 1})
+
+    run_pending_jobs()
+
+    job = get_job_status(job_id)
+    assert job['status'] == 'failed'
+    assert job['last_error'] == "Payment failed: Card declined"
+    assert gateway.process_payment.call_count == 1
+
+def test_gateway_error_is_retried_with_backoff(gateway):
+    _add_overdue_loan("777777", 1, 4)
+    gateway.process_payment.side_effect = Exception("Network error")
+    job_id = submit_job('pay_late_fees', {'patron_id': "777777", 'book_id': 1})
+
+    run_pending_jobs()
+
+    job = get_job_status(job_id)
+    assert job['status'] == 'queued'
+    assert job['attempts'] == 1
+    assert job['last_error'] == "Payment processing error: Network error"
+    assert datetime.fromisoformat(job['next_run_at']) > datetime.now()
+    # Not due yet, so nothing runs
+    assert run_pending_jobs() == 0
+
+def test_retry_delay_doubles_up_to_the_cap(monkeypatch):
+    monkeypatch.setattr(job_queue, 'JOB_RETRY_DELAY', 2.0)
+    monkeypatch.setattr(job_queue, 'JOB_MAX_RETRY_DELAY', 10.0)
+
+    assert [job_queue.retry_delay(attempts) for attempts in range(1, 6)] == [2.0, 4.0, 8.0, 10.0, 10.0]
+
+def test_job_is_dead_lettered_after_max_attempts(gateway, monkeypatch):
+    monkeypatch.setattr(job_queue, 'JOB_RETRY_DELAY', 0)
+    _add_overdue_loan("777777", 1, 4)
+    gateway.process_payment.side_effect = Exception("Network error")
+    job_id = submit_job('pay_late_fees', {'patron_id': "777777", 'book_id': 1}, max_attempts=3)
+
+    assert run_pending_jobs() == 3
+
+    job = get_job_status(job_id)
+    assert job['status'] == 'dead'
+    assert job['attempts'] == 3
+
+    # Requeued dead jobs get another round and reuse the same idempotency key
+    gateway.process_payment.side_effect = None
+    assert database.requeue_jobs('dead') == 1
+    run_pending_jobs()
+    assert get_job_status(job_id)['status'] == 'succeeded'
+    assert database.get_payment_by_key(f"job-{job_id}")['transaction_id'] == "txn_777"
+
+def _age(table, row_id, seconds):
+    conn = database.get_db_connection()
+    conn.execute(f'UPDATE {table} SET updated_at = ? WHERE id = ?',
+                 ((datetime.now() - timedelta(seconds=seconds)).isoformat(), row_id))
+    conn.commit()
+    conn.close()
+
+def test_job_abandoned_mid_payment_is_requeued_and_succeeds(gateway):
+    _add_overdue_loan("777777", 1, 4)
+    job_id = submit_job('pay_late_fees', {'patron_id': "777777", 'book_id': 1})
+
+    # A process claims the job and records the pending charge, then dies
+    database.claim_job(datetime.now())
+    state, payment = database.begin_payment(f"job-{job_id}", 'charge', "777777", 2.0, "Late fees")
+    assert state == 'new'
+    _age('jobs', job_id, job_queue.JOB_LEASE_TIMEOUT + 1)
+
+    worker = JobWorker(workers=0)
+    assert worker.requeue_abandoned() == 1
+    assert worker.requeue_abandoned() == 0  # not again within requeue_interval
+
+    # The ledger entry still looks in flight, so the run is retried, not failed
+    run_pending_jobs()
+    job = get_job_status(job_id)
+    assert (job['status'], job['last_error']) == ('queued', "This payment is already being processed.")
+
+    _age('payments', payment['id'], 301)
+    database.requeue_jobs('queued')  # due now rather than after the backoff
+    run_pending_jobs()
+
+    job = get_job_status(job_id)
+    assert job['status'] == 'succeeded'
+    assert job['attempts'] == 3
+    assert database.get_payment_by_key(f"job-{job_id}")['status'] == 'completed'
+    gateway.process_payment.assert_called_once()
+
+def test_create_app_starts_no_job_threads(temp_db):
+    from app import create_app
+    create_app({'DATABASE': temp_db})
+
+    assert job_queue._worker is None
+
+def test_serving_app_starts_job_threads_with_first_request(temp_db):
+    from app import create_app
+    client = create_app({'DATABASE': temp_db, 'JOB_WORKERS': 1}).test_client()
+    try:
+        assert job_queue._worker is None
+        client.get('/catalog')
+
+        assert job_queue._worker is not None
+        assert job_queue._worker.workers == 1
+    finally:
+        stop_job_worker()
+
+def test_unknown_job_kind_is_rejected(temp_db):
+    with pytest.raises(ValueError):
+        submit_job('send_email', {})
+
+def test_worker_threads_run_jobs(gateway):
+    gateway.refund_payment.return_value = (True, "Refund successful")
+    worker = JobWorker(workers=2, poll_interval=0.05)
+    worker.start()
+    try:
+        job_ids = [submit_job('refund_late_fee_payment', {'transaction_id': f"txn_{n}", 'amount': 5.0})
+                   for n in range(5)]
+        deadline = time.monotonic() + 5
+        while time.monotonic() < deadline:
+            if all(get_job_status(job_id)['status'] == 'succeeded' for job_id in job_ids):
+                break
+            time.sleep(0.05)
+    finally:
+        worker.stop(timeout=5)
+
+    assert [get_job_status(job_id)['status'] for job_id in job_ids] == ['succeeded'] * 5
+    assert gateway.refund_payment.call_count == 5
+
+def test_payments_api_queues_job(client, gateway):
+    _add_overdue_loan("777777", 1, 4)
+
+    response = client.post('/api/payments', json={'patron_id': "777777", 'book_id': 1})
+
+    assert response.status_code == 202
+    job_id = response.get_json()['job_id']
+    assert response.headers['Location'].endswith(f"/api/jobs/{job_id}")
+    gateway.process_payment.assert_not_called()
+
+    run_pending_jobs()
+    job = client.get(f"/api/jobs/{job_id}").get_json()
+    assert job['status'] == 'succeeded'
+    assert job['result']['transaction_id'] == "txn_777"
+
+def test_payments_api_validation(client):
+    assert client.post('/api/payments', json={'book_id': 1}).status_code == 400
+    assert client.post('/api/payments', json={'patron_id': "777777", 'book_id': "1"}).status_code == 400
+    assert client.post('/api/refunds', json={'transaction_id': "txn_1"}).status_code == 400
+    assert client.get('/api/jobs/999').status_code == 404
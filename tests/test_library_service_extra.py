@@ -1,4 +1,7 @@
+import json
 import pytest
+from datetime import datetime, timedelta
+import database
 from services.library_service import (
     add_book_to_catalog,
     borrow_book_by_patron,
@@ -8,6 +11,10 @@ from services.library_service import (
     search_books_in_catalog,
     get_patron_status_report,
     refund_late_fee_payment,
+    get_catalog_page,
+    calculate_late_fees_batch,
+    sweep_overdue_loans,
+    return_books_by_patrons,
 
 
 )
@@ -358,4 +365,309 @@ def test_return_book_both_invalid():
     success, message = return_book_by_patron("123", -1)
     
     assert success == False
-    assert "Invalid" in message or "borrow record" in message.lower()
\ No newline at end of file
+    assert "Invalid" in message or "borrow record" in message.lower()
+
+def test_search_books_matches_word_prefixes_in_rank_order(temp_db):
+    """Test that title search matches word prefixes and ranks the best match first."""
+    add_book_to_catalog("Great Expectations", "Charles Dickens", "9780141439563", 1)
+    results = search_books_in_catalog("gre gat", "title")
+
+    assert [book['title'] for book in results] == ["The Great Gatsby"]
+    assert search_books_in_catalog("great", "title")[0]['title'] in ("The Great Gatsby", "Great Expectations")
+    assert len(search_books_in_catalog("great", "title")) == 2
+
+def test_search_books_by_author_prefix(temp_db):
+    """Test that author search matches the start of any author word."""
+    results = search_books_in_catalog("orw", "author")
+
+    assert [book['title'] for book in results] == ["1984"]
+
+def test_search_books_respects_limit(temp_db):
+    """Test that the number of search results is capped by the limit."""
+    for i in range(5):
+        add_book_to_catalog(f"Limited Edition {i}", "Author", f"{4440000000000 + i}", 1)
+
+    assert len(search_books_in_catalog("limited", "title", limit=3)) == 3
+
+def test_search_index_follows_title_updates(temp_db):
+    """Test that the full-text index is kept in sync with edits to the books table."""
+    conn = database.get_db_connection()
+    conn.execute("UPDATE books SET title = 'Nineteen Eighty-Four' WHERE id = 3")
+    conn.commit()
+    conn.close()
+
+    assert search_books_in_catalog("1984", "title") == []
+    assert search_books_in_catalog("nineteen", "title")[0]['id'] == 3
+
+def test_search_books_punctuation_only_term():
+    """Test that a search term with no words returns no results instead of an FTS syntax error."""
+    assert search_books_in_catalog('"*', "title") == []
+
+def test_get_catalog_page_walks_whole_catalog(temp_db):
+    """Test that following next_cursor visits every book exactly once in title order."""
+    for i in range(4):
+        add_book_to_catalog("Same Title", "Author", f"{3330000000000 + i}", 1)
+
+    seen, cursor = [], None
+    while True:
+        page = get_catalog_page(cursor, limit=2)
+        assert page['status'] == 'success'
+        assert len(page['books']) <= 2
+        seen.extend(book['id'] for book in page['books'])
+        cursor = page['next_cursor']
+        if cursor is None:
+            break
+
+    expected = [book['id'] for book in database.get_all_books()]
+    assert seen == expected
+    assert len(seen) == 7
+
+def test_get_catalog_page_invalid_cursor(temp_db):
+    """Test that a tampered cursor is reported instead of raising."""
+    page = get_catalog_page("not-a-cursor", limit=2)
+
+    assert page['status'] == "Invalid catalog cursor."
+    assert page['books'] == []
+
+def test_catalog_api_returns_cursor(client):
+    """Test that the JSON catalog API pages through books with a cursor."""
+    first = client.get('/api/catalog?limit=2').get_json()
+    second = client.get(f"/api/catalog?limit=2&cursor={first['next_cursor']}").get_json()
+
+    assert first['count'] == 2
+    assert second['count'] == 1
+    assert second['next_cursor'] is None
+    assert client.get('/api/catalog?cursor=bad').status_code == 400
+
+def test_catalog_page_links_to_next_page(client):
+    """Test that the catalog page renders a bounded page with a next-page link."""
+    response = client.get('/catalog?limit=2')
+
+    assert response.status_code == 200
+    assert b'Next Page' in response.data
+    assert response.data.count(b'<tr>') == 3  # header row + 2 books
+
+def test_get_patron_status_report_totals_and_history(temp_db):
+    """Test that the report sums real fees and lists past and current loans."""
+    conn = database.get_db_connection()
+    conn.execute('''
+        INSERT INTO borrow_records (patron_id, book_id, borrow_date, due_date, return_date)
+        VALUES ('444444', 1, '2024-01-01T10:00:00', '2024-01-15T10:00:00', '2024-01-10T10:00:00'),
+               ('444444', 2, '2024-02-01T10:00:00', '2024-02-15T10:00:00', NULL),
+               ('444444', 1, ?, ?, NULL)
+    ''', ((datetime.now() - timedelta(days=18)).isoformat(),
+          (datetime.now() - timedelta(days=4)).isoformat()))
+    conn.commit()
+    conn.close()
+
+    report = get_patron_status_report("444444")
+
+    assert report['currently_borrowed'] == 2
+    assert [b['late_fee'] for b in report['borrowed_books']] == [15.00, 2.00]
+    assert report['total_late_fees'] == 17.00
+    assert len(report['borrowing_history']) == 3
+    assert report['borrowing_history'][0]['return_date'] is not None
+
+def test_calculate_late_fees_batch_matches_single_calculation(temp_db):
+    """Test that batch fees agree with calculate_late_fee_for_book for each pair."""
+    conn = database.get_db_connection()
+    conn.executemany('''
+        INSERT INTO borrow_records (patron_id, book_id, borrow_date, due_date)
+        VALUES (?, ?, ?, ?)
+    ''', [('555555', 1, (datetime.now() - timedelta(days=20)).isoformat(),
+           (datetime.now() - timedelta(days=6)).isoformat()),
+          ('555555', 2, (datetime.now() - timedelta(days=60)).isoformat(),
+           (datetime.now() - timedelta(days=46)).isoformat())])
+    conn.commit()
+    conn.close()
+    pairs = [("555555", 1), ("555555", 2), ("123456", 3), ("555555", 3), ("12", 1),
+             ("12345a", 3), ("123456", 0), ("123456", -3), ("", 1), ("12", -1)]
+
+    results = calculate_late_fees_batch(pairs)
+
+    assert [(r['patron_id'], r['book_id']) for r in results] == pairs
+    for result, (patron_id, book_id) in zip(results, pairs):
+        single = calculate_late_fee_for_book(patron_id, book_id)
+        assert (result['fee_amount'], result['days_overdue'], result['status']) == \
+            (single['fee_amount'], single['days_overdue'], single['status'])
+    assert results[1]['fee_amount'] == 15.00
+    assert all(r['status'] == "Invalid patron ID or book ID." for r in results[4:])
+
+def test_calculate_late_fees_batch_all_active_loans(temp_db):
+    """Test computing fees for every active loan, optionally only overdue ones."""
+    conn = database.get_db_connection()
+    conn.execute('''
+        INSERT INTO borrow_records (patron_id, book_id, borrow_date, due_date)
+        VALUES ('666666', 2, '2024-01-01T09:00:00', '2024-01-15T09:00:00')
+    ''')
+    conn.commit()
+    conn.close()
+
+    everything = calculate_late_fees_batch()
+    overdue = calculate_late_fees_batch(overdue_only=True)
+
+    assert len(everything) == 2
+    assert [(r['patron_id'], r['fee_amount']) for r in overdue] == [('666666', 15.00)]
+
+def test_late_fees_batch_endpoint(client):
+    """Test the POST batch late fee API."""
+    response = client.post('/api/late_fees', json={'loans': [
+        {'patron_id': '123456', 'book_id': 3}, {'patron_id': '123456', 'book_id': 'x'}]})
+    data = response.get_json()
+
+    assert response.status_code == 200
+    assert data['count'] == 2
+    assert data['results'][0]['status'] == 'success'
+    assert data['results'][1]['status'] == "Invalid patron ID or book ID."
+    assert client.post('/api/late_fees', json={'all': True}).get_json()['count'] == 1
+    assert client.post('/api/late_fees', data='nope').status_code == 400
+
+def test_late_fees_batch_endpoint_rejects_boolean_book_id(client):
+    """Test that a boolean book_id is an invalid pair, not book 1."""
+    response = client.post('/api/late_fees', json={'loans': [{'patron_id': '123456', 'book_id': True}]})
+    result = response.get_json()['results'][0]
+
+    assert response.status_code == 200
+    assert result['status'] == "Invalid patron ID or book ID."
+    assert result['fee_amount'] == 0.00
+    assert calculate_late_fees_batch([('123456', True)])[0]['status'] == "Invalid patron ID or book ID."
+
+def test_late_fees_batch_endpoint_caps_batch_size(client, monkeypatch):
+    """Test that a request with more loans than the cap is refused."""
+    monkeypatch.setattr('routes.api_routes.MAX_LATE_FEE_BATCH_SIZE', 2)
+    loans = [{'patron_id': '123456', 'book_id': book_id} for book_id in (1, 2, 3)]
+
+    response = client.post('/api/late_fees', json={'loans': loans})
+
+    assert response.status_code == 400
+    assert "At most 2 loans" in response.get_json()['error']
+    assert client.post('/api/late_fees', json={'loans': loans[:2]}).status_code == 200
+
+def _add_loans_due(loans):
+    """Insert active loans as (patron_id, book_id, due_date) tuples."""
+    conn = database.get_db_connection()
+    conn.executemany('''
+        INSERT INTO borrow_records (patron_id, book_id, borrow_date, due_date)
+        VALUES (?, ?, ?, ?)
+    ''', [(patron_id, book_id, (due - timedelta(days=14)).isoformat(), due.isoformat())
+          for patron_id, book_id, due in loans])
+    conn.commit()
+    conn.close()
+
+def test_sweep_overdue_loans_streams_in_due_order(temp_db):
+    """Test the sweep across chunk boundaries, including loans sharing a due date."""
+    now = datetime(2025, 3, 20, 12, 0)
+    _add_loans_due([('700000', 1, datetime(2025, 3, 10, 9, 0)),
+                    ('700001', 2, datetime(2025, 1, 1, 9, 0)),
+                    ('700002', 1, datetime(2025, 3, 10, 9, 0)),
+                    ('700003', 2, datetime(2025, 3, 10, 9, 0)),
+                    ('700004', 1, datetime(2025, 3, 20, 8, 0)),   # due today: not overdue yet
+                    ('700005', 2, datetime(2025, 3, 19, 23, 0))])
+
+    loans = list(sweep_overdue_loans(now, chunk_size=2))
+
+    assert [loan['patron_id'] for loan in loans] == ['700001', '700000', '700002', '700003', '700005']
+    assert [(loan['days_overdue'], loan['fee_amount']) for loan in loans] == \
+        [(78, 15.00), (10, 5.00), (10, 5.00), (10, 5.00), (1, 0.50)]
+    assert loans[0]['title'] == "To Kill a Mockingbird"
+
+def test_sweep_overdue_loans_is_lazy(temp_db, mocker):
+    """Test that the sweep reads one chunk at a time, only as it is consumed."""
+    _add_loans_due([(f'70{n:04d}', 1, datetime.now() - timedelta(days=3)) for n in range(10)])
+    from services import library_service
+    spy = mocker.spy(library_service, 'get_overdue_loans')
+
+    sweep = sweep_overdue_loans(chunk_size=4)
+    assert spy.call_count == 0
+    first = [next(sweep) for _ in range(5)]
+
+    assert spy.call_count == 2
+    assert len(first) + len(list(sweep)) == 10
+    assert spy.call_count == 3
+
+def test_overdue_stream_endpoint(client):
+    """Test the NDJSON overdue loans stream."""
+    _add_loans_due([('700000', 1, datetime.now() - timedelta(days=40))])
+
+    response = client.get('/api/overdue')
+    lines = response.get_data(as_text=True).splitlines()
+
+    assert response.status_code == 200
+    assert response.mimetype == 'application/x-ndjson'
+    assert len(lines) == 1
+    assert json.loads(lines[0])['fee_amount'] == 15.00
+
+def test_overdue_sweep_cli(temp_db):
+    """Test the overdue-sweep CLI command in CSV format."""
+    from app import create_app
+    _add_loans_due([('700000', 1, datetime.now() - timedelta(days=4))])
+    app = create_app({'DATABASE': temp_db, 'TESTING': True})
+
+    result = app.test_cli_runner().invoke(args=['overdue-sweep', '--format', 'csv'])
+
+    header, row = result.stdout.splitlines()
+    assert header == "record_id,patron_id,book_id,title,due_date,days_overdue,fee_amount"
+    assert ",700000,1,The Great Gatsby," in row and row.endswith(",4,2.0")
+    assert "1 overdue loans; $2.00 in late fees." in result.stderr
+
+def test_return_book_restores_availability_without_phantom_borrow(temp_db):
+    """Test that a return closes the loan and frees the copy in one step, borrowing nothing."""
+    assert borrow_book_by_patron("800000", 1)[0] is True
+    before = database.get_patron_counters("800000")
+
+    success, message = return_book_by_patron("800000", 1)
+
+    assert (success, message) == (True, "Book returned successfully.")
+    assert database.get_book_by_id(1)['available_copies'] == 3
+    assert database.get_patron_counters("800000") == dict(before, active_loans=0)
+    assert return_book_by_patron("800000", 1) == \
+        (False, "No active borrow record found for this patron and book.")
+
+def test_return_book_reports_late_fee(temp_db):
+    """Test that an overdue return states the fee owed."""
+    _add_loans_due([('800001', 2, datetime.now() - timedelta(days=5))])
+
+    success, message = return_book_by_patron("800001", 2)
+
+    assert success is True
+    assert message == "Book returned successfully. Late fee: $2.50 (5 days overdue)."
+
+def test_return_book_validation_messages():
+    """Test that patron and book ID problems are reported separately."""
+    assert return_book_by_patron("12a456", 1) == (False, "Invalid patron ID. Must be exactly 6 digits.")
+    assert return_book_by_patron("123456", 0) == (False, "Invalid book ID.")
+
+def test_return_books_batch_outcomes(temp_db):
+    """Test per-item outcomes of a batch check-in, including a pair returned twice."""
+    _add_loans_due([('810000', 1, datetime.now() - timedelta(days=4)),
+                    ('810000', 1, datetime.now() + timedelta(days=3)),
+                    ('810001', 2, datetime.now() + timedelta(days=3))])
+    database.update_book_availability(1, -2)
+    database.update_book_availability(2, -1)
+
+    report = return_books_by_patrons([("810000", 1), ("810001", 2), ("810000", 1),
+                                      ("810000", 1), ("81", 1), ("810001", 0)])
+
+    assert [r['status'] for r in report['results']] == [
+        'success', 'success', 'success',
+        "No active borrow record found for this patron and book.",
+        "Invalid patron ID. Must be exactly 6 digits.", "Invalid book ID."]
+    # The overdue (older) loan is closed first
+    assert [r['fee_amount'] for r in report['results'][:3]] == [2.00, 0.00, 0.00]
+    assert (report['returned'], report['failed'], report['total_fee_amount']) == (3, 3, 2.00)
+    assert database.get_book_by_id(1)['available_copies'] == 3
+    assert database.get_book_by_id(2)['available_copies'] == 2
+    assert database.get_patron_counters("810000")['active_loans'] == 0
+
+def test_returns_endpoint(client):
+    """Test the POST batch check-in API."""
+    response = client.post('/api/returns', json={'items': [
+        {'patron_id': '123456', 'book_id': 3}, {'patron_id': '123456', 'book_id': 3}]})
+    data = response.get_json()
+
+    assert response.status_code == 200
+    assert data['count'] == 2
+    assert data['returned'] == 1
+    assert data['results'][1]['status'] == "No active borrow record found for this patron and book."
+    assert database.get_book_by_id(3)['available_copies'] == 1
+    assert client.post('/api/returns', json={'items': 'nope'}).status_code == 400
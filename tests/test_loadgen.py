@@ -0,0 +1,47 @@
+import pytest
+
+import database
+from benchmarks import datagen
+from benchmarks.loadgen import check_invariants, parse_mix, run_load
+
+
+@pytest.fixture
+def load_db(tmp_path, monkeypatch):
+    monkeypatch.setattr(database, 'DATABASE', database.DATABASE)
+    path = str(tmp_path / 'load.db')
+    datagen.generate(path, 60, 120, seed=3)
+    database.close_pool()
+    yield path
+    database.close_pool()
+
+def test_concurrent_load_keeps_invariants(load_db):
+    report = run_load(load_db, threads=4, duration=1.5, patrons=12, hot_books=5, seed=1)
+
+    assert report['requests'] > 0
+    assert report['errors'] == 0, report['error_samples']
+    assert report['violations'] == []
+    assert set(report['by_kind']) <= {'borrow', 'return', 'search', 'api_search', 'late_fee'}
+    assert report['by_kind']['borrow']['ok'] > 0
+    assert report['latency']['p99_ms'] >= report['latency']['median_ms']
+
+def test_check_invariants_reports_broken_rows(load_db):
+    assert check_invariants() == []
+
+    conn = database.get_db_connection()
+    try:
+        conn.execute('UPDATE books SET available_copies = -1 WHERE id = 1')
+        conn.commit()
+    finally:
+        conn.close()
+
+    violations = check_invariants()
+    assert any(v.startswith('Book 1 has -1 of') for v in violations)
+    assert any(v.startswith('Book 1: -1 available') for v in violations)
+    assert check_invariants(max_borrowed=0)[-1].endswith('(limit 0).')
+
+def test_parse_mix():
+    assert parse_mix('borrow=3, return=2,search') == {'borrow': 3, 'return': 2, 'search': 1}
+    with pytest.raises(ValueError):
+        parse_mix('borrow=1,renew=1')
+    with pytest.raises(ValueError):
+        parse_mix('borrow=0')
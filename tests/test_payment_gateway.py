@@ -0,0 +1,217 @@
+import asyncio
+import threading
+import time
+
+import pytest
+from werkzeug.serving import make_server
+
+from services import payment_service
+from services.payment_service import (
+    AsyncPaymentGateway, CircuitBreaker, CircuitOpenError, PaymentGateway, ResilientPaymentGateway,
+    process_payments_concurrently
+)
+from services.payment_stub_server import create_stub_app
+
+
+@pytest.fixture
+def no_latency(monkeypatch):
+    monkeypatch.setattr(payment_service, 'SIMULATED_LATENCY', {'charge': 0, 'refund': 0, 'status': 0})
+
+@pytest.fixture
+def stub_server():
+    """Run the stand-in gateway on an ephemeral local port."""
+    server = make_server('127.0.0.1', 0, create_stub_app(latency_scale=0.1), threaded=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_port}"
+    server.shutdown()
+
+
+def test_simulated_gateway_rules(no_latency):
+    """Test that the in-process simulation keeps the original gateway rules."""
+    gateway = PaymentGateway()
+
+    assert gateway.process_payment("123456", 5.0)[0] is True
+    assert gateway.process_payment("123456", 0)[2] == "Invalid amount: must be greater than 0"
+    assert gateway.process_payment("123456", 1001)[2] == "Payment declined: amount exceeds limit"
+    assert gateway.refund_payment("bad", 5.0) == (False, "Invalid transaction ID")
+    assert gateway.verify_payment_status("txn_1")['status'] == "completed"
+
+def test_http_gateway_against_stub_server(stub_server):
+    """Test that the HTTP client path talks to the stand-in server."""
+    gateway = PaymentGateway(base_url=stub_server)
+
+    success, transaction_id, message = gateway.process_payment("123456", 12.5, "Late fees")
+    assert success is True
+    assert transaction_id.startswith("txn_123456_")
+    assert message == "Payment of $12.50 processed successfully"
+    assert gateway.process_payment("123456", 2000) == (False, "", "Payment declined: amount exceeds limit")
+    assert gateway.refund_payment(transaction_id, 12.5)[0] is True
+    assert gateway.verify_payment_status(transaction_id)['status'] == "completed"
+
+def test_http_gateway_times_out(stub_server):
+    """Test that a slow gateway call is abandoned after the configured timeout."""
+    gateway = PaymentGateway(base_url=stub_server, timeout=0.01)
+
+    with pytest.raises(Exception):
+        gateway.process_payment("123456", 5.0)
+
+def test_async_fan_out_runs_payments_concurrently(monkeypatch):
+    """Test that hundreds of simulated payments overlap instead of running back to back."""
+    monkeypatch.setattr(payment_service, 'SIMULATED_LATENCY', {'charge': 0.05, 'refund': 0, 'status': 0})
+    payments = [{'patron_id': f"{100000 + i}", 'amount': 1.0} for i in range(300)]
+
+    start = time.perf_counter()
+    results = process_payments_concurrently(payments, PaymentGateway(base_url=None), max_concurrency=100)
+    elapsed = time.perf_counter() - start
+
+    assert len(results) == 300
+    assert all(result[0] is True for result in results)
+    assert elapsed < 1.0  # 300 x 50 ms sequentially would take 15 s
+
+def test_async_http_fan_out(stub_server):
+    """Test the bounded fan-out over the pooled HTTP session."""
+    client = AsyncPaymentGateway(PaymentGateway(base_url=stub_server), max_concurrency=10)
+    payments = [{'patron_id': "123456", 'amount': 1.0}, {'patron_id': "1", 'amount': 1.0}]
+
+    results = asyncio.run(client.process_payments(payments))
+
+    assert results[0][0] is True
+    assert results[1] == (False, "", "Invalid patron ID format")
+
+def test_async_call_timeout(monkeypatch):
+    """Test that an async call longer than its timeout raises TimeoutError."""
+    monkeypatch.setattr(payment_service, 'SIMULATED_LATENCY', {'charge': 1.0, 'refund': 0, 'status': 0})
+    client = AsyncPaymentGateway(PaymentGateway(base_url=None), timeout=0.01)
+
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(client.process_payment("123456", 5.0))
+
+def test_async_calls_share_the_circuit_breaker(monkeypatch):
+    """Test that simulated async calls open the breaker the sync calls go through."""
+    monkeypatch.setattr(payment_service, 'SIMULATED_LATENCY', {'charge': 1.0, 'refund': 0, 'status': 0})
+    gateway = ResilientPaymentGateway(PaymentGateway(base_url=None), CircuitBreaker(failure_threshold=2))
+    client = AsyncPaymentGateway(gateway, timeout=0.01)
+
+    for _ in range(2):
+        with pytest.raises(asyncio.TimeoutError):
+            asyncio.run(client.process_payment("123456", 5.0))
+
+    assert gateway.breaker.state == CircuitBreaker.OPEN
+    with pytest.raises(CircuitOpenError):
+        asyncio.run(client.process_payment("123456", 5.0))
+    with pytest.raises(CircuitOpenError):
+        gateway.process_payment("123456", 5.0)
+    assert gateway.stats()['circuit']['rejected'] == 2
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+def test_circuit_breaker_opens_and_recovers(mocker):
+    """Test closed -> open -> half_open -> closed, and failing fast while open."""
+    clock = FakeClock()
+    inner = mocker.Mock(spec=PaymentGateway)
+    inner.refund_payment.side_effect = ConnectionError("gateway down")
+    gateway = ResilientPaymentGateway(inner, CircuitBreaker(failure_threshold=3, reset_timeout=10, clock=clock))
+
+    for _ in range(3):
+        with pytest.raises(ConnectionError):
+            gateway.refund_payment("txn_1", 5.0)
+    assert gateway.breaker.state == 'open'
+
+    with pytest.raises(CircuitOpenError):
+        gateway.refund_payment("txn_1", 5.0)
+    assert inner.refund_payment.call_count == 3
+
+    # After the reset timeout one trial call is let through
+    clock.now = 10
+    inner.refund_payment.side_effect = None
+    inner.refund_payment.return_value = (True, "Refund successful")
+    assert gateway.refund_payment("txn_1", 5.0) == (True, "Refund successful")
+
+    stats = gateway.stats()['circuit']
+    assert stats['state'] == 'closed'
+    assert (stats['opened'], stats['half_opened'], stats['closed'], stats['rejected']) == (1, 1, 1, 1)
+
+def test_circuit_breaker_reopens_when_trial_fails(mocker):
+    clock = FakeClock()
+    inner = mocker.Mock(spec=PaymentGateway)
+    inner.process_payment.side_effect = TimeoutError("slow gateway")
+    gateway = ResilientPaymentGateway(inner, CircuitBreaker(failure_threshold=1, reset_timeout=10, clock=clock))
+
+    with pytest.raises(TimeoutError):
+        gateway.process_payment("123456", 5.0)
+    clock.now = 10
+    with pytest.raises(TimeoutError):
+        gateway.process_payment("123456", 5.0)
+
+    assert gateway.breaker.state == 'open'
+    with pytest.raises(CircuitOpenError):
+        gateway.process_payment("123456", 5.0)
+    assert inner.process_payment.call_count == 2
+
+def test_terminal_statuses_are_cached(mocker):
+    inner = mocker.Mock(spec=PaymentGateway)
+    inner.verify_payment_status.side_effect = lambda txn: {
+        'transaction_id': txn, 'status': 'completed' if txn == "txn_done" else 'pending'}
+    gateway = ResilientPaymentGateway(inner)
+
+    for _ in range(3):
+        assert gateway.verify_payment_status("txn_done")['status'] == 'completed'
+        assert gateway.verify_payment_status("txn_open")['status'] == 'pending'
+
+    assert [c.args[0] for c in inner.verify_payment_status.call_args_list].count("txn_done") == 1
+    assert [c.args[0] for c in inner.verify_payment_status.call_args_list].count("txn_open") == 3
+
+def test_refund_drops_cached_status(mocker):
+    inner = mocker.Mock(spec=PaymentGateway)
+    inner.verify_payment_status.return_value = {'transaction_id': "txn_1", 'status': 'completed'}
+    inner.refund_payment.return_value = (True, "Refund successful")
+    gateway = ResilientPaymentGateway(inner)
+    assert gateway.verify_payment_status("txn_1")['status'] == 'completed'
+
+    inner.verify_payment_status.return_value = {'transaction_id': "txn_1", 'status': 'refunded'}
+    assert gateway.refund_payment("txn_1", 5.0)[0] is True
+
+    assert gateway.verify_payment_status("txn_1")['status'] == 'refunded'
+    assert inner.verify_payment_status.call_count == 2
+
+def test_concurrent_status_checks_share_one_call(mocker):
+    release = threading.Event()
+    inner = mocker.Mock(spec=PaymentGateway)
+
+    def slow_status(txn):
+        release.wait(5)
+        return {'transaction_id': txn, 'status': 'pending'}
+    inner.verify_payment_status.side_effect = slow_status
+    gateway = ResilientPaymentGateway(inner)
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(gateway.verify_payment_status("txn_1")))
+               for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    while gateway.stats()['coalesced'] < 4:
+        time.sleep(0.01)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+
+    assert len(results) == 5 and all(result['status'] == 'pending' for result in results)
+    inner.verify_payment_status.assert_called_once_with("txn_1")
+
+def test_payment_status_api(client, mocker):
+    gateway = mocker.Mock(spec=PaymentGateway)
+    gateway.verify_payment_status.return_value = {'transaction_id': "txn_1", 'status': 'completed'}
+    mocker.patch("services.library_service.get_payment_gateway", return_value=gateway)
+
+    assert client.get('/api/payments/txn_1').get_json()['status'] == 'completed'
+    assert client.get('/api/payments/abc').status_code == 400
+
+    gateway.verify_payment_status.side_effect = CircuitOpenError("Payment gateway unavailable (circuit open)")
+    assert client.get('/api/payments/txn_1').status_code == 503
@@ -1,6 +1,7 @@
 import pytest
 from services.library_service import (
     pay_late_fees,
+    pay_all_late_fees,
     refund_late_fee_payment,
 )
 from services.payment_service import PaymentGateway
@@ -175,3 +176,134 @@ def test_refund_late_fee_payment_invalid_refund_amount_exceeds_maximum(mocker):
 
     mock_gateway.refund_payment.assert_not_called()
 
+
+
+def _add_overdue_loans(patron_id, days_overdue_by_book):
+    from datetime import datetime, timedelta
+    import database
+    conn = database.get_db_connection()
+    for book_id, days_overdue in days_overdue_by_book.items():
+        due = datetime.now() - timedelta(days=days_overdue)
+        conn.execute('''
+            INSERT INTO borrow_records (patron_id, book_id, borrow_date, due_date)
+            VALUES (?, ?, ?, ?)
+        ''', (patron_id, book_id, (due - timedelta(days=14)).isoformat(), due.isoformat()))
+    conn.commit()
+    conn.close()
+
+def test_pay_all_late_fees_single_charge(temp_db, mocker):
+    _add_overdue_loans("777777", {1: 4, 2: 40, 3: 0})
+    mock_gateway = mocker.Mock(spec=PaymentGateway)
+    mock_gateway.process_payment.return_value = (True, "txn_777", "Success")
+
+    success, message, txn = pay_all_late_fees("777777", mock_gateway)
+
+    assert success is True
+    assert txn == "txn_777"
+    # One charge, itemized oldest loan first; the loan not yet overdue is left out
+    mock_gateway.process_payment.assert_called_once_with(
+        patron_id="777777",
+        amount=17.0,
+        description="Late fees: 'To Kill a Mockingbird' ($15.00); 'The Great Gatsby' ($2.00)"
+    )
+
+def test_pay_all_late_fees_does_not_charge_twice(temp_db, mocker):
+    _add_overdue_loans("777777", {1: 4})
+    mock_gateway = mocker.Mock(spec=PaymentGateway)
+    mock_gateway.process_payment.return_value = (True, "txn_777", "Success")
+
+    pay_all_late_fees("777777", mock_gateway)
+    success, message, txn = pay_all_late_fees("777777", mock_gateway)
+
+    assert success is False
+    assert message == "No late fees to pay."
+    mock_gateway.process_payment.assert_called_once()
+
+def test_pay_late_fees_charges_only_what_is_outstanding(temp_db, mocker):
+    import database
+    _add_overdue_loans("777777", {1: 16, 2: 6})
+    mock_gateway = mocker.Mock(spec=PaymentGateway)
+    mock_gateway.process_payment.return_value = (True, "txn_777", "Success")
+
+    assert pay_late_fees("777777", 1, mock_gateway)[0] is True
+    assert pay_late_fees("777777", 1, mock_gateway) == (False, "No late fees to pay for this book.", None)
+    assert pay_all_late_fees("777777", mock_gateway)[0] is True
+    assert pay_late_fees("777777", 2, mock_gateway) == (False, "No late fees to pay for this book.", None)
+
+    assert [c.kwargs['amount'] for c in mock_gateway.process_payment.call_args_list] == [8.0, 3.0]
+    assert database.get_patron_counters("777777")['fees_paid'] == 11.0
+
+def test_refunded_late_fees_are_owed_again(temp_db, mocker):
+    import database
+    _add_overdue_loans("777777", {1: 16, 2: 6})
+    mock_gateway = mocker.Mock(spec=PaymentGateway)
+    mock_gateway.process_payment.return_value = (True, "txn_777", "Success")
+    mock_gateway.refund_payment.return_value = (True, "Refund successful")
+
+    assert pay_all_late_fees("777777", mock_gateway)[0] is True
+    assert refund_late_fee_payment("txn_777", 5.5, mock_gateway)[0] is True
+
+    # Half the charge came back, so half of each loan's share is owed again
+    assert [loan['paid'] for loan in database.get_patron_fee_loans("777777")] == [4.0, 1.5]
+    assert database.get_patron_counters("777777")['fees_paid'] == 5.5
+
+    mock_gateway.process_payment.return_value = (True, "txn_778", "Success")
+    assert pay_all_late_fees("777777", mock_gateway)[0] is True
+    assert mock_gateway.process_payment.call_args.kwargs['amount'] == 5.5
+    assert database.get_patron_counters("777777")['fees_paid'] == 11.0
+
+def test_pay_all_late_fees_declined_records_nothing(temp_db, mocker):
+    _add_overdue_loans("777777", {1: 4})
+    mock_gateway = mocker.Mock(spec=PaymentGateway)
+    mock_gateway.process_payment.return_value = (False, None, "Card declined")
+
+    success, message, txn = pay_all_late_fees("777777", mock_gateway)
+    assert (success, message, txn) == (False, "Payment failed: Card declined", None)
+
+    mock_gateway.process_payment.return_value = (True, "txn_778", "Success")
+    assert pay_all_late_fees("777777", mock_gateway)[0] is True
+
+def test_pay_all_late_fees_same_key_charges_once(temp_db, mocker):
+    _add_overdue_loans("777777", {1: 4})
+    mock_gateway = mocker.Mock(spec=PaymentGateway)
+    mock_gateway.process_payment.return_value = (True, "txn_777", "Success")
+
+    first = pay_all_late_fees("777777", mock_gateway, idempotency_key="fees-1")
+    second = pay_all_late_fees("777777", mock_gateway, idempotency_key="fees-1")
+
+    assert first == second == (True, "Payment successful! Success", "txn_777")
+    mock_gateway.process_payment.assert_called_once()
+
+def test_pay_late_fees_failed_key_can_be_retried(temp_db, mocker):
+    _add_overdue_loans("777777", {1: 4})
+    mock_gateway = mocker.Mock(spec=PaymentGateway)
+    mock_gateway.process_payment.side_effect = Exception("Network error")
+
+    success, message, txn = pay_late_fees("777777", 1, mock_gateway, idempotency_key="fee-1")
+    assert (success, message, txn) == (False, "Payment processing error: Network error", None)
+
+    mock_gateway.process_payment.side_effect = None
+    mock_gateway.process_payment.return_value = (True, "txn_777", "Success")
+    assert pay_late_fees("777777", 1, mock_gateway, idempotency_key="fee-1")[0] is True
+    assert pay_late_fees("777777", 1, mock_gateway, idempotency_key="fee-1")[2] == "txn_777"
+    assert mock_gateway.process_payment.call_count == 2
+
+def test_idempotency_key_is_bound_to_its_patron(temp_db, mocker):
+    _add_overdue_loans("777777", {1: 4})
+    _add_overdue_loans("888888", {2: 4})
+    mock_gateway = mocker.Mock(spec=PaymentGateway)
+    mock_gateway.process_payment.return_value = (True, "txn_777", "Success")
+    pay_all_late_fees("777777", mock_gateway, idempotency_key="fees-1")
+
+    success, message, txn = pay_all_late_fees("888888", mock_gateway, idempotency_key="fees-1")
+
+    assert (success, message, txn) == (False, "Idempotency key was already used for a different payment.", None)
+    mock_gateway.process_payment.assert_called_once()
+
+def test_refund_same_key_refunds_once(temp_db, mocker):
+    mock_gateway = mocker.Mock(spec=PaymentGateway)
+    mock_gateway.refund_payment.return_value = (True, "Refund successful")
+
+    assert refund_late_fee_payment("txn_123", 5.0, mock_gateway, idempotency_key="refund-1") == (True, "Refund successful")
+    assert refund_late_fee_payment("txn_123", 5.0, mock_gateway, idempotency_key="refund-1") == (True, "Refund successful")
+    mock_gateway.refund_payment.assert_called_once_with("txn_123", 5.0)
@@ -0,0 +1,131 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+import database
+import query_trace
+from query_trace import QueryBudgetExceeded, query_budget, trace_queries
+from services.library_service import calculate_late_fee_for_book, get_patron_status_report, sweep_overdue_loans
+
+
+def test_trace_records_statement_shape_and_caller(temp_db):
+    with trace_queries('late fee') as trace:
+        calculate_late_fee_for_book("123456", 3)
+
+    assert trace.count == 1
+    query = trace.queries[0]
+    assert query.sql.startswith("SELECT br.*, b.title, b.author FROM borrow_records br")
+    assert query.shape == '(str)'
+    assert query.helper == 'get_patron_borrowed_books'
+    assert query.caller.startswith('library_service.py:') and query.caller.endswith(' calculate_late_fee_for_book')
+    assert query.seconds >= 0
+    assert "late fee" in trace.report()
+
+def test_listener_is_only_installed_while_tracing(temp_db):
+    with trace_queries():
+        assert database._query_listeners == (query_trace._record_query,)
+    assert database._query_listeners == ()
+
+def test_helper_called_in_a_loop_is_flagged(temp_db):
+    def fees_one_by_one():
+        return [calculate_late_fee_for_book("123456", book_id) for book_id in (1, 2, 3)]
+
+    with trace_queries() as trace:
+        fees_one_by_one()
+
+    (group,) = trace.repeated()
+    assert group['count'] == 3
+    assert group['callers'] == [group['callers'][0]]
+    assert group['callers'][0].endswith(' calculate_late_fee_for_book')
+    assert "repeated 3x" in trace.report()
+
+def test_nested_traces_both_record(temp_db):
+    with trace_queries() as outer:
+        database.get_book_by_id(1)
+        with trace_queries() as inner:
+            database.get_all_books()
+
+    assert (outer.count, inner.count) == (2, 1)
+
+def test_cursor_statements_are_traced(temp_db):
+    with trace_queries() as trace:
+        database.get_overdue_loans(datetime.now(), 10)
+
+    assert trace.count == 1
+    assert trace.queries[0].helper == 'get_overdue_loans'
+
+def test_query_budget_is_enforced(temp_db):
+    @query_budget(1)
+    def two_queries():
+        database.get_all_books()
+        database.get_patron_loans("123456")
+
+    @query_budget(5)
+    def repeats():
+        for book_id in (1, 2):
+            database.get_book_by_isbn(f"no-such-isbn-{book_id}")
+
+    with pytest.raises(QueryBudgetExceeded, match="ran 2 queries, over its budget of 1"):
+        two_queries()
+    with pytest.raises(QueryBudgetExceeded, match="possible N\\+1"):
+        repeats()
+    assert two_queries.query_budget == 1
+
+def test_query_budget_is_free_when_not_enforced(temp_db, monkeypatch):
+    monkeypatch.setattr(query_trace, 'ENFORCE_QUERY_BUDGETS', False)
+
+    @query_budget(0)
+    def one_query():
+        return database.get_all_books()
+
+    assert len(one_query()) == 3
+    assert database._query_listeners == ()
+
+def test_status_report_stays_one_query(temp_db):
+    now = datetime.now()
+    for book_id in (1, 2):
+        database.insert_borrow_record("123456", book_id, now - timedelta(days=30), now - timedelta(days=16))
+
+    with trace_queries() as trace:
+        report = get_patron_status_report("123456")
+
+    assert report['currently_borrowed'] == 3
+    assert trace.count == get_patron_status_report.query_budget == 1
+
+def test_instrumented_request_with_repeated_queries_is_counted(temp_db, caplog):
+    from app import create_app
+    from instrumentation import metrics
+    metrics.reset()
+    client = create_app({'DATABASE': temp_db, 'TESTING': True, 'INSTRUMENTATION': True}).test_client()
+    now = datetime.now()
+    for book_id in (1, 2):
+        database.insert_borrow_record("222222", book_id, now, now + timedelta(days=14))
+
+    client.post('/api/returns', json={'items': [{'patron_id': "222222", 'book_id': 1},
+                                                {'patron_id': "222222", 'book_id': 2}]})
+
+    text = client.get('/metrics').get_data(as_text=True)
+    assert 'library_http_repeated_query_requests_total{method="POST",route="/api/returns"} 1' in text
+    assert "Repeated queries (possible N+1)" in caplog.text
+    metrics.reset()
+
+def test_chunked_sweep_is_not_reported_as_repeated(temp_db, caplog, monkeypatch):
+    from functools import partial
+    from app import create_app
+    from instrumentation import metrics
+    metrics.reset()
+    monkeypatch.setattr('routes.api_routes.sweep_overdue_loans', partial(sweep_overdue_loans, chunk_size=1))
+    client = create_app({'DATABASE': temp_db, 'TESTING': True, 'INSTRUMENTATION': True}).test_client()
+    due = datetime.now() - timedelta(days=3)
+    for book_id in (1, 2):
+        database.insert_borrow_record("222222", book_id, due - timedelta(days=14), due)
+
+    with trace_queries() as trace:
+        assert len(client.get('/api/overdue').get_data(as_text=True).splitlines()) == 2
+
+    assert trace.count == 3 and trace.repeated() == []
+    text = client.get('/metrics').get_data(as_text=True)
+    assert 'library_http_requests_total{method="GET",route="/api/overdue",status="200"} 1' in text
+    assert 'library_http_repeated_query_requests_total{' not in text
+    assert "Repeated queries" not in caplog.text
+    metrics.reset()
@@ -0,0 +1,78 @@
+import importlib
+import os
+import runpy
+import time
+
+import pytest
+
+import database
+from services import job_queue
+from services.payment_service import get_payment_gateway
+
+CONFIG_PATH = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'gunicorn.conf.py')
+
+
+@pytest.fixture
+def wsgi(temp_db):
+    module = importlib.import_module('wsgi')
+    yield module
+    module.shutdown_worker()
+
+def test_gunicorn_config_reads_environment(monkeypatch, tmp_path):
+    monkeypatch.setenv('LIBRARY_WEB_WORKERS', '3')
+    monkeypatch.setenv('LIBRARY_WEB_THREADS', '2')
+    # Set here so the config's default does not outlive the test
+    monkeypatch.setenv('LIBRARY_METRICS_DIR', str(tmp_path))
+
+    config = runpy.run_path(CONFIG_PATH)
+
+    assert (config['workers'], config['threads']) == (3, 2)
+    assert os.environ['LIBRARY_METRICS_DIR'] == str(tmp_path)
+    assert config['preload_app'] is True
+    assert callable(config['post_worker_init']) and callable(config['worker_exit'])
+
+def test_master_starts_no_job_threads_and_worker_init_does(wsgi):
+    assert job_queue._worker is None
+    gateway = get_payment_gateway()
+
+    wsgi.init_worker(job_workers=1)
+
+    assert job_queue._worker is not None and job_queue._worker.workers == 1
+    assert get_payment_gateway() is not gateway
+
+    wsgi.shutdown_worker()
+    assert job_queue._worker is None
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason="needs fork")
+def test_forked_worker_serves_requests(wsgi):
+    response = wsgi.app.test_client().get('/api/search?q=gatsby')
+    assert response.get_json()['count'] == 1
+
+    pid = os.fork()
+    if pid == 0:
+        status = 1
+        try:
+            wsgi.init_worker(job_workers=1)
+            response = wsgi.app.test_client().post('/api/holds', json={'patron_id': '654321', 'book_id': 3})
+            status = 0 if response.status_code == 201 else 1
+            wsgi.shutdown_worker()
+        finally:
+            os._exit(status)
+
+    deadline = time.monotonic() + 30
+    while True:
+        done, status = os.waitpid(pid, os.WNOHANG)
+        if done or time.monotonic() > deadline:
+            break
+        time.sleep(0.05)
+    if not done:
+        os.kill(pid, 9)
+        os.waitpid(pid, 0)
+    assert done and os.waitstatus_to_exitcode(status) == 0
+
+    conn = database.get_db_connection()
+    try:
+        holds = conn.execute("SELECT patron_id FROM holds WHERE book_id = 3").fetchall()
+    finally:
+        conn.close()
+    assert [tuple(hold) for hold in holds] == [('654321',)]
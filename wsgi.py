@@ -0,0 +1,50 @@
+"""
+WSGI entry point for production servers
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+
+The app is created once, at import. With gunicorn's preload_app that happens
+in the master process, so the schema, migrations and sample data are set up a
+single time before any worker is forked. create_app starts no job worker
+threads (and they would not survive fork); each worker starts its own in
+init_worker(), along with its own database connections and payment clients,
+and, with LIBRARY_METRICS_DIR set, the thread writing its metrics for /metrics.
+"""
+
+from typing import Optional
+
+import database
+import instrumentation
+from app import create_app
+from services.job_queue import JOB_WORKERS, start_job_worker, stop_job_worker
+from services.payment_service import reset_payment_clients
+
+# Seconds a stopping worker waits for its job threads to finish the current job
+JOB_SHUTDOWN_TIMEOUT = 10.0
+
+app = create_app()
+
+# Connections opened while creating the app must not be inherited by workers
+database.close_pool()
+
+
+def init_worker(job_workers: Optional[int] = None):
+    """
+    Set up a freshly forked worker process: drop any connections, cached
+    books and payment clients copied from the master, then start this
+    process's job worker threads (JOB_WORKERS of them by default) and
+    metrics writer.
+    """
+    database.close_pool()
+    reset_payment_clients()
+    instrumentation.start_metrics_writer()
+    start_job_worker(app.config.get('JOB_WORKERS', JOB_WORKERS) if job_workers is None else job_workers)
+
+def shutdown_worker(timeout: float = JOB_SHUTDOWN_TIMEOUT):
+    """
+    Stop a worker's job threads after their current job, write its final
+    metrics and close its connections.
+    """
+    stop_job_worker(timeout)
+    instrumentation.stop_metrics_writer()
+    database.close_pool()